@@ -0,0 +1,242 @@
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs vtctl commands on one vtctld session, and times them.
+
+A VtctlRunner sends all its commands through a single dialed
+VtctlClient, instead of starting a vtctl process per command.
+Independent commands can be sent concurrently with run_all(). The
+latency of every command is recorded, per command name.
+
+API usage -
+
+runner = vtctl_runner.VtctlRunner(vtctl_client.connect('grpc', addr, 30))
+output = runner.run(['GetKeyspace', 'test_keyspace'])
+outputs = runner.run_all([['InitTablet', ...], ['InitTablet', ...]])
+for name, stats in runner.slowest_commands():
+  print name, stats.count, stats.total_time
+"""
+
+import logging
+import threading
+import time
+
+from concurrent import futures
+
+import vtctl_client
+
+# DEFAULT_NUM_THREADS is the maximum number of commands run_all() sends
+# at the same time.
+DEFAULT_NUM_THREADS = 8
+
+# BOOL_FLAGS are the vtctl flags that do not take a separate value.
+BOOL_FLAGS = frozenset([
+    'alsologtostderr', 'logtostderr', 'enable_queries', 'v',
+])
+
+
+class CommandError(Exception):
+  """Raised when a vtctl command fails.
+
+  Attributes:
+    command: the command line (list of strings).
+    error: the exception raised by the client.
+    log: the log messages of the command, one per line, as vtctl would
+      print them on stderr.
+  """
+
+  def __init__(self, command, error, log):
+    super(CommandError, self).__init__(
+        'vtctl %s failed: %s' % (' '.join(command), error))
+    self.command = command
+    self.error = error
+    self.log = log
+
+
+class CommandStats(object):
+  """The latency of the runs of one command."""
+
+  __slots__ = ('count', 'errors', 'total_time', 'max_time')
+
+  def __init__(self):
+    self.count = 0
+    self.errors = 0
+    self.total_time = 0.0
+    self.max_time = 0.0
+
+  def add(self, duration, failed=False):
+    self.count += 1
+    if failed:
+      self.errors += 1
+    self.total_time += duration
+    self.max_time = max(self.max_time, duration)
+
+  @property
+  def mean_time(self):
+    if not self.count:
+      return 0.0
+    return self.total_time / self.count
+
+
+def command_name(command):
+  """Returns the vtctl command name of a command line, e.g. 'InitTablet'.
+
+  The flags before the command name are skipped, with their value
+  ('-wait-time 3s' or '-wait-time=3s'), unless they are in BOOL_FLAGS.
+
+  Args:
+    command: the command line (list of strings).
+
+  Returns:
+    The command name, or '' if there is none.
+  """
+  args = iter(command)
+  for arg in args:
+    if not arg.startswith('-'):
+      return arg
+    flag = arg.lstrip('-')
+    if '=' not in flag and flag not in BOOL_FLAGS:
+      next(args, None)
+  return ''
+
+
+class VtctlRunner(object):
+  """Runs vtctl commands on one VtctlClient, see the module doc."""
+
+  def __init__(self, client, action_timeout=30.0,
+               num_threads=DEFAULT_NUM_THREADS, info_to_debug=False):
+    """Creates a VtctlRunner.
+
+    Args:
+      client: a dialed VtctlClient. It must allow concurrent calls to use
+        run_all() with more than one thread, as gRPC clients do.
+      action_timeout: the default timeout of a command, in seconds.
+      num_threads: the maximum number of concurrent commands in run_all().
+      info_to_debug: if set, changes the info messages to debug.
+    """
+    self.client = client
+    self.action_timeout = action_timeout
+    self.num_threads = num_threads
+    self.info_to_debug = info_to_debug
+    self._stats = {}
+    self._stats_lock = threading.Lock()
+
+  def run(self, command, action_timeout=None):
+    """Runs one command, and returns its console output.
+
+    The log messages of the command are sent to the logging module.
+
+    Args:
+      command: the command line (list of strings).
+      action_timeout: the timeout of the command, in seconds, if not the
+        default one.
+
+    Returns:
+      The console output of the command.
+
+    Raises:
+      CommandError: if the command failed.
+    """
+    if action_timeout is None:
+      action_timeout = self.action_timeout
+    console = []
+    log = []
+    start = time.time()
+    try:
+      for e in self.client.execute_vtctl_command(
+          command, action_timeout=action_timeout):
+        if e.level == vtctl_client.Event.CONSOLE:
+          console.append(e.value)
+          continue
+        if e.level == vtctl_client.Event.INFO:
+          if self.info_to_debug:
+            logging.debug('%s', e.value)
+          else:
+            logging.info('%s', e.value)
+        elif e.level == vtctl_client.Event.WARNING:
+          logging.warning('%s', e.value)
+        elif e.level == vtctl_client.Event.ERROR:
+          logging.error('%s', e.value)
+        log.append(e.value)
+    except Exception as e:  # pylint: disable=broad-except
+      self._record(command, time.time() - start, failed=True)
+      raise CommandError(command, e, '\n'.join(log + [str(e)]) + '\n')
+    self._record(command, time.time() - start)
+    return ''.join(console)
+
+  def run_all(self, commands, action_timeout=None):
+    """Runs independent commands concurrently.
+
+    All the commands are run, even if some of them fail.
+
+    Args:
+      commands: list of command lines.
+      action_timeout: the timeout of each command, in seconds, if not the
+        default one.
+
+    Returns:
+      The list of the console outputs, in the order of the commands.
+
+    Raises:
+      CommandError: the error of the first failed command, in the order
+        of the commands.
+    """
+    if len(commands) <= 1 or self.num_threads <= 1:
+      return [self.run(command, action_timeout) for command in commands]
+    executor = futures.ThreadPoolExecutor(
+        min(self.num_threads, len(commands)))
+    try:
+      results = [executor.submit(self.run, command, action_timeout)
+                 for command in commands]
+      return [result.result() for result in results]
+    finally:
+      executor.shutdown(wait=True)
+
+  def _record(self, command, duration, failed=False):
+    name = command_name(command)
+    with self._stats_lock:
+      stats = self._stats.get(name)
+      if stats is None:
+        stats = CommandStats()
+        self._stats[name] = stats
+      stats.add(duration, failed=failed)
+
+  def stats(self):
+    """Returns a dict of command name to a copy of its CommandStats."""
+    result = {}
+    with self._stats_lock:
+      for name, stats in self._stats.iteritems():
+        copy = CommandStats()
+        for attr in CommandStats.__slots__:
+          setattr(copy, attr, getattr(stats, attr))
+        result[name] = copy
+    return result
+
+  def slowest_commands(self, count=None):
+    """Returns (command name, CommandStats) pairs, by total time.
+
+    Args:
+      count: the maximum number of commands to return, or None for all.
+
+    Returns:
+      The list of pairs, the command with the largest total time first.
+    """
+    items = sorted(self.stats().iteritems(),
+                   key=lambda item: item[1].total_time, reverse=True)
+    if count is not None:
+      items = items[:count]
+    return items
+
+  def reset_stats(self):
+    with self._stats_lock:
+      self._stats.clear()
@@ -0,0 +1,358 @@
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Buffers single-row writes, and sends them per shard in large batches.
+
+Each write comes with its keyspace id. The writes are grouped by
+destination shard, using the SrvKeyspace of the keyspace, and a shard
+is flushed with a single ExecuteBatchKeyspaceIds call once it has
+max_rows buffered writes, or once its oldest write waited max_delay.
+Consecutive inserts into the same table with the same columns are
+merged into multi-row INSERT statements, other writes are sent as they
+are, in order.
+
+Each write returns a Write object, which records the outcome. When a
+shard batch is rejected by an error that proves nothing was applied (an
+IntegrityError, ProgrammingError or DataError), its writes are retried
+one by one, so each error is attributed to the write that caused it.
+This relies on the batch being atomic, so it is only done when
+as_transaction is set (the default). Any other error, like a timeout,
+may come after the commit: all the writes of the batch then fail with
+that error.
+
+API usage -
+
+writer = batch_writer.BatchWriter(conn, 'user', max_rows=500)
+for user in users:
+  writer.insert('user', {'id': user.id, 'name': user.name}, user.kid)
+writer.execute('update counts set n = n + 1 where id = :id', {'id': 1}, kid)
+writer.close()  # flushes, raises BatchWriteError if some writes failed.
+"""
+
+import logging
+import threading
+import time
+
+from vtdb import dbexceptions
+from vtdb import keyspace
+from vtdb import srv_keyspace_cache
+
+# DEFAULT_MAX_ROWS is the number of buffered writes that triggers the
+# flush of a shard.
+DEFAULT_MAX_ROWS = 500
+# DEFAULT_MAX_DELAY is the longest a write is buffered, in seconds.
+DEFAULT_MAX_DELAY = 0.1
+# DEFAULT_MAX_ROWS_PER_STATEMENT caps the size of the multi-row inserts.
+DEFAULT_MAX_ROWS_PER_STATEMENT = 100
+
+# _REJECTED_BATCH_ERRORS are the errors of a transactional batch which
+# prove it was not applied, so its writes can be replayed.
+_REJECTED_BATCH_ERRORS = (dbexceptions.IntegrityError,
+                          dbexceptions.ProgrammingError,
+                          dbexceptions.DataError)
+
+
+class BatchWriteError(dbexceptions.DatabaseError):
+  """Raised by flush when writes failed.
+
+  Attributes:
+    failed_writes: the list of the Write objects that failed. Their
+      error attribute is the exception of the write.
+  """
+
+  def __init__(self, failed_writes):
+    super(BatchWriteError, self).__init__(
+        '%d writes failed' % len(failed_writes), failed_writes[0].error)
+    self.failed_writes = failed_writes
+
+
+class Write(object):
+  """One buffered write, and its outcome.
+
+  Attributes:
+    shard: the destination shard.
+    keyspace_id: the packed keyspace id.
+    done: set once the write was sent, successfully or not.
+    error: the exception if the write failed, None otherwise.
+  """
+
+  def __init__(self, table, values, sql, bind_variables, keyspace_id, shard):
+    self.table = table
+    self.values = values
+    self.sql = sql
+    self.bind_variables = bind_variables
+    self.keyspace_id = keyspace_id
+    self.shard = shard
+    self.time = time.time()
+    self.done = False
+    self.error = None
+
+  def query(self):
+    """Returns the (sql, bind_variables) of this write alone."""
+    if self.sql is not None:
+      return self.sql, self.bind_variables
+    return _insert_query(self.table, sorted(self.values), [self])
+
+  def __repr__(self):
+    if self.sql is not None:
+      return 'Write(%r, %r)' % (self.sql, self.bind_variables)
+    return 'Write(insert into %s %r)' % (self.table, self.values)
+
+
+def _insert_query(table, columns, writes):
+  """Returns a multi-row INSERT for writes, as (sql, bind_variables)."""
+  bind_variables = {}
+  rows = []
+  for i, write in enumerate(writes):
+    names = []
+    for j, column in enumerate(columns):
+      name = 'v%d_%d' % (i, j)
+      bind_variables[name] = write.values[column]
+      names.append(':' + name)
+    rows.append('(%s)' % ', '.join(names))
+  sql = 'insert into %s(%s) values %s' % (
+      table, ', '.join(columns), ', '.join(rows))
+  return sql, bind_variables
+
+
+class BatchWriter(object):
+  """Groups single-row writes per shard, see the module doc."""
+
+  def __init__(self, conn, keyspace_name, tablet_type='master',
+               keyspace_cache=None, max_rows=DEFAULT_MAX_ROWS,
+               max_delay=DEFAULT_MAX_DELAY,
+               max_rows_per_statement=DEFAULT_MAX_ROWS_PER_STATEMENT,
+               as_transaction=True, effective_caller_id=None,
+               raise_on_error=True):
+    """Creates a BatchWriter.
+
+    Args:
+      conn: a dialed VTGateClient, not in a transaction.
+      keyspace_name: the keyspace to write to.
+      tablet_type: the (string) tablet type to write to.
+      keyspace_cache: the SrvKeyspaceCache to route writes with.
+        A new one is created if not set.
+      max_rows: number of buffered writes that triggers a shard flush.
+      max_delay: longest a write is buffered, in seconds.
+      max_rows_per_statement: max rows in a multi-row insert.
+      as_transaction: run each shard batch in a transaction.
+      effective_caller_id: CallerID object.
+      raise_on_error: if set, flush raises BatchWriteError when writes
+        fail. Otherwise, the errors are only in the Write objects.
+    """
+    self.conn = conn
+    self.keyspace_name = keyspace_name
+    self.tablet_type = tablet_type
+    self.keyspace_cache = (
+        keyspace_cache or srv_keyspace_cache.SrvKeyspaceCache(conn))
+    self.max_rows = max_rows
+    self.max_delay = max_delay
+    self.max_rows_per_statement = max_rows_per_statement
+    self.as_transaction = as_transaction
+    self.effective_caller_id = effective_caller_id
+    self.raise_on_error = raise_on_error
+    self.rpcs = 0
+    self.rows_sent = 0
+    # Map of shard name to its list of buffered Write objects.
+    self._buffers = {}
+    self._failed = []
+    self._lock = threading.Lock()
+    # Only one flush at a time, as they share the connection.
+    self._flush_lock = threading.Lock()
+    self._closed = threading.Event()
+    self._thread = None
+
+  def start(self):
+    """Starts a thread flushing the writes that waited max_delay.
+
+    Without it, buffered writes are only flushed by the next write, or
+    by flush() and close().
+    """
+    self._closed.clear()
+    self._thread = threading.Thread(target=self._flush_loop)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _flush_loop(self):
+    while not self._closed.wait(self.max_delay / 2.0):
+      try:
+        self.flush_due()
+      except Exception:  # pylint: disable=broad-except
+        logging.exception('background flush failed')
+
+  def insert(self, table, values, keyspace_id):
+    """Buffers the insert of one row.
+
+    Args:
+      table: the table name.
+      values: dict of column name to value.
+      keyspace_id: the uint64 or packed keyspace id of the row.
+
+    Returns:
+      The Write object.
+    """
+    return self._add(table, dict(values), None, None, keyspace_id)
+
+  def execute(self, sql, bind_variables, keyspace_id):
+    """Buffers a single-row statement.
+
+    Args:
+      sql: the statement, with :name bind variables.
+      bind_variables: the bind variables of the statement.
+      keyspace_id: the uint64 or packed keyspace id of the row.
+
+    Returns:
+      The Write object.
+    """
+    return self._add(None, None, sql, bind_variables, keyspace_id)
+
+  def _add(self, table, values, sql, bind_variables, keyspace_id):
+    if not isinstance(keyspace_id, str):
+      keyspace_id = keyspace.pack_keyspace_id(keyspace_id)
+    shard = self.keyspace_cache.keyspace_id_to_shard_name(
+        self.keyspace_name, keyspace_id, self.tablet_type)
+    write = Write(table, values, sql, bind_variables, keyspace_id, shard)
+    with self._lock:
+      buf = self._buffers.setdefault(shard, [])
+      buf.append(write)
+      full = len(buf) >= self.max_rows
+    if full:
+      self._flush_shards([shard])
+    else:
+      self.flush_due()
+    return write
+
+  def flush_due(self):
+    """Flushes the shards whose oldest write waited max_delay."""
+    deadline = time.time() - self.max_delay
+    with self._lock:
+      shards = [shard for shard, buf in self._buffers.iteritems()
+                if buf and buf[0].time <= deadline]
+    if shards:
+      self._flush_shards(shards)
+
+  def flush(self):
+    """Sends all the buffered writes.
+
+    Raises:
+      BatchWriteError: if raise_on_error is set, and writes failed
+        since the previous flush.
+    """
+    with self._lock:
+      shards = self._buffers.keys()
+    self._flush_shards(shards)
+    with self._lock:
+      failed = self._failed
+      self._failed = []
+    if failed and self.raise_on_error:
+      raise BatchWriteError(failed)
+
+  def close(self):
+    """Stops the flush thread, and flushes the buffered writes."""
+    self._closed.set()
+    if self._thread:
+      self._thread.join()
+      self._thread = None
+    self.flush()
+
+  def pending(self):
+    """Returns the number of buffered writes."""
+    with self._lock:
+      return sum(len(buf) for buf in self._buffers.itervalues())
+
+  def _flush_shards(self, shards):
+    with self._flush_lock:
+      for shard in shards:
+        with self._lock:
+          writes = self._buffers.pop(shard, None)
+        if writes:
+          self._send(writes)
+
+  def _statements(self, writes):
+    """Groups writes into statements, returns (sql, bvs, writes) tuples."""
+    # items holds Write objects for plain statements, and lists of
+    # Write objects for the inserts merged together.
+    items = []
+    inserts = {}
+    for write in writes:
+      if write.sql is not None:
+        items.append(write)
+        # Only consecutive inserts are merged, so the writes keep
+        # their order around the other statements.
+        inserts = {}
+        continue
+      key = (write.table, tuple(sorted(write.values)))
+      group = inserts.get(key)
+      if group is None or len(group) >= self.max_rows_per_statement:
+        group = []
+        inserts[key] = group
+        items.append(group)
+      group.append(write)
+    statements = []
+    for item in items:
+      if isinstance(item, Write):
+        statements.append((item.sql, item.bind_variables, [item]))
+      else:
+        sql, bind_variables = _insert_query(
+            item[0].table, sorted(item[0].values), item)
+        statements.append((sql, bind_variables, item))
+    return statements
+
+  def _execute_batch(self, statements):
+    self.rpcs += 1
+    return self.conn._execute_batch(  # pylint: disable=protected-access
+        sql_list=[sql for sql, _, _ in statements],
+        bind_variables_list=[bvs for _, bvs, _ in statements],
+        keyspace_list=[self.keyspace_name] * len(statements),
+        keyspace_ids_list=[[w.keyspace_id for w in writes]
+                           for _, _, writes in statements],
+        shards_list=None,
+        tablet_type=self.tablet_type,
+        as_transaction=self.as_transaction,
+        effective_caller_id=self.effective_caller_id)
+
+  def _send(self, writes):
+    """Sends the writes of one shard, and records their outcome."""
+    statements = self._statements(writes)
+    try:
+      self._execute_batch(statements)
+    except dbexceptions.DatabaseError as e:
+      if (not self.as_transaction or len(writes) == 1 or
+          not isinstance(e, _REJECTED_BATCH_ERRORS) or
+          isinstance(e, dbexceptions.PartialCommitError)):
+        # Part of the batch may be applied, the error cannot be
+        # narrowed down.
+        self._record(writes, e)
+        return
+      logging.warning('batch of %d writes to shard %s failed: %s, '
+                      'retrying them one by one', len(writes),
+                      writes[0].shard, e)
+      for write in writes:
+        sql, bind_variables = write.query()
+        try:
+          self._execute_batch([(sql, bind_variables, [write])])
+          self._record([write], None)
+        except dbexceptions.DatabaseError as e:
+          self._record([write], e)
+      return
+    self._record(writes, None)
+
+  def _record(self, writes, error):
+    for write in writes:
+      write.done = True
+      write.error = error
+    if error is None:
+      self.rows_sent += len(writes)
+    else:
+      with self._lock:
+        self._failed.extend(writes)
@@ -0,0 +1,301 @@
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A client-side circuit breaker per (keyspace, tablet type).
+
+While a keyspace is unavailable, for instance during a reparent, every
+call to it waits for its timeout. The CircuitBreaker sheds that load:
+it keeps the outcome of the recent calls of each (keyspace, tablet
+type), over a sliding window of window seconds. Once at least
+min_requests calls were made in the window, and failure_rate_threshold
+of them failed, the circuit opens, and the calls fail at once with
+dbexceptions.CircuitOpenError.
+
+After open_interval seconds, the circuit is half-open: up to
+half_open_probes calls go through, the other ones still fail fast. If
+a probe succeeds, the circuit closes. If it fails, the circuit opens
+again, for twice as long, up to max_open_interval.
+
+Only failure_exceptions count as failures. Other errors, like an
+IntegrityError, show that vtgate served the call, and count as
+successes.
+
+API usage -
+
+breaker = circuit_breaker.CircuitBreaker()
+conn = vtgate_client.connect('grpc', addr, 10, circuit_breaker=breaker)
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from vtdb import dbexceptions
+
+# DEFAULT_FAILURE_RATE_THRESHOLD is the failure rate that opens a circuit.
+DEFAULT_FAILURE_RATE_THRESHOLD = 0.5
+# DEFAULT_MIN_REQUESTS is the number of calls in the window below which a
+# circuit never opens.
+DEFAULT_MIN_REQUESTS = 20
+# DEFAULT_WINDOW is the duration of the sliding window, in seconds.
+DEFAULT_WINDOW = 10.0
+# Open time parameters, in seconds: a circuit stays open for
+# DEFAULT_OPEN_INTERVAL, doubled after each failed probe, up to
+# DEFAULT_MAX_OPEN_INTERVAL.
+DEFAULT_OPEN_INTERVAL = 1.0
+DEFAULT_MAX_OPEN_INTERVAL = 30.0
+# DEFAULT_HALF_OPEN_PROBES is the number of concurrent probe calls.
+DEFAULT_HALF_OPEN_PROBES = 1
+
+# The errors that count as failures.
+FAILURE_EXCEPTIONS = (dbexceptions.TransientError, dbexceptions.TimeoutError,
+                      dbexceptions.QueryNotServed)
+
+# Circuit states.
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# The window is split in _NUM_BUCKETS buckets, the oldest one is
+# dropped as time goes.
+_NUM_BUCKETS = 10
+
+
+class _Circuit(object):
+  """The state and recent outcomes of one (keyspace, tablet type)."""
+
+  def __init__(self, open_interval):
+    self.state = CLOSED
+    # Deque of [bucket index, successes, failures].
+    self.buckets = collections.deque()
+    self.open_interval = open_interval
+    self.opened_until = 0
+    self.probes = 0
+    self.rejected = 0
+    self.opened = 0
+
+  def counts(self):
+    successes = sum(b[1] for b in self.buckets)
+    failures = sum(b[2] for b in self.buckets)
+    return successes, failures
+
+
+class CircuitBreaker(object):
+  """Fails calls fast while their keyspace fails, see the module doc.
+
+  A CircuitBreaker is thread-safe, and can be shared by the connections
+  of a vtgate_pool.VTGatePool.
+  """
+
+  def __init__(self,
+               failure_rate_threshold=DEFAULT_FAILURE_RATE_THRESHOLD,
+               min_requests=DEFAULT_MIN_REQUESTS,
+               window=DEFAULT_WINDOW,
+               open_interval=DEFAULT_OPEN_INTERVAL,
+               max_open_interval=DEFAULT_MAX_OPEN_INTERVAL,
+               half_open_probes=DEFAULT_HALF_OPEN_PROBES,
+               failure_exceptions=FAILURE_EXCEPTIONS):
+    """Creates a CircuitBreaker.
+
+    Args:
+      failure_rate_threshold: the failure rate that opens a circuit.
+      min_requests: calls in the window below which a circuit never opens.
+      window: the duration of the sliding window, in seconds.
+      open_interval: how long a circuit first stays open, in seconds.
+      max_open_interval: the longest a circuit stays open, in seconds.
+      half_open_probes: the number of concurrent probe calls.
+      failure_exceptions: tuple of exceptions that count as failures.
+    """
+    self.failure_rate_threshold = failure_rate_threshold
+    self.min_requests = min_requests
+    self.bucket_duration = float(window) / _NUM_BUCKETS
+    self.open_interval = open_interval
+    self.max_open_interval = max_open_interval
+    self.half_open_probes = half_open_probes
+    self.failure_exceptions = failure_exceptions
+    self._circuits = {}
+    self._lock = threading.Lock()
+
+  def _circuit(self, key):
+    circuit = self._circuits.get(key)
+    if circuit is None:
+      circuit = _Circuit(self.open_interval)
+      self._circuits[key] = circuit
+    return circuit
+
+  def allow(self, keys):
+    """Checks that calls to all the keys can be made.
+
+    Args:
+      keys: list of (keyspace, tablet_type) tuples.
+
+    Returns:
+      The list of the keys the call is a probe for. They must be given
+      back to record.
+
+    Raises:
+      dbexceptions.CircuitOpenError: if one of the circuits is open.
+    """
+    now = time.time()
+    with self._lock:
+      probes = []
+      for key in keys:
+        circuit = self._circuit(key)
+        if circuit.state == OPEN and now >= circuit.opened_until:
+          logging.info('circuit %s is half-open', key)
+          circuit.state = HALF_OPEN
+        if circuit.state == CLOSED:
+          continue
+        if (circuit.state == HALF_OPEN and
+            circuit.probes < self.half_open_probes):
+          probes.append(key)
+          continue
+        circuit.rejected += 1
+        raise dbexceptions.CircuitOpenError(
+            'circuit open for keyspace %s, tablet type %s' % key)
+      for key in probes:
+        self._circuits[key].probes += 1
+      return probes
+
+  def record(self, keys, probes, error=None):
+    """Records the outcome of a call allowed by allow.
+
+    Args:
+      keys: the keys given to allow.
+      probes: the keys returned by allow.
+      error: the exception the call raised, if any.
+    """
+    failed = isinstance(error, self.failure_exceptions)
+    now = time.time()
+    bucket = int(now / self.bucket_duration)
+    with self._lock:
+      for key in keys:
+        circuit = self._circuit(key)
+        if key in probes:
+          circuit.probes -= 1
+          if failed:
+            circuit.open_interval = min(circuit.open_interval * 2,
+                                        self.max_open_interval)
+            self._open(key, circuit, now, error)
+          elif circuit.state == HALF_OPEN:
+            logging.info('circuit %s is closed again', key)
+            circuit.state = CLOSED
+            circuit.open_interval = self.open_interval
+            circuit.buckets.clear()
+          continue
+        buckets = circuit.buckets
+        if not buckets or buckets[-1][0] != bucket:
+          buckets.append([bucket, 0, 0])
+          while buckets[0][0] <= bucket - _NUM_BUCKETS:
+            buckets.popleft()
+        buckets[-1][2 if failed else 1] += 1
+        if not failed or circuit.state != CLOSED:
+          continue
+        successes, failures = circuit.counts()
+        total = successes + failures
+        if (total >= self.min_requests and
+            failures >= self.failure_rate_threshold * total):
+          self._open(key, circuit, now, error)
+
+  def _open(self, key, circuit, now, error):
+    logging.warning('opening circuit %s for %.1fs: %s', key,
+                    circuit.open_interval, error)
+    circuit.state = OPEN
+    circuit.opened += 1
+    circuit.opened_until = now + circuit.open_interval
+    circuit.buckets.clear()
+
+  def guard(self, keys):
+    """Returns a context manager running a call through the circuits.
+
+    Args:
+      keys: list of (keyspace, tablet_type) tuples.
+
+    Returns:
+      A context manager. Entering it raises CircuitOpenError if one of
+      the circuits is open, exiting it records the outcome.
+    """
+    return _Guard(self, keys)
+
+  def state(self, keyspace, tablet_type):
+    """Returns the state of a circuit, CLOSED, OPEN or HALF_OPEN."""
+    with self._lock:
+      circuit = self._circuits.get((keyspace, tablet_type))
+      if circuit is None:
+        return CLOSED
+      if circuit.state == OPEN and time.time() >= circuit.opened_until:
+        return HALF_OPEN
+      return circuit.state
+
+  def stats(self):
+    """Returns a dict of (keyspace, tablet_type) to a dict of counters."""
+    with self._lock:
+      result = {}
+      for key, circuit in self._circuits.iteritems():
+        successes, failures = circuit.counts()
+        result[key] = {
+            'state': circuit.state,
+            'successes': successes,
+            'failures': failures,
+            'rejected': circuit.rejected,
+            'opened': circuit.opened,
+        }
+      return result
+
+
+class _Guard(object):
+  """The context manager returned by CircuitBreaker.guard."""
+
+  def __init__(self, breaker, keys):
+    self.breaker = breaker
+    self.keys = keys
+    self.probes = None
+
+  def __enter__(self):
+    self.probes = self.breaker.allow(self.keys)
+    return self
+
+  def __exit__(self, exc_type, exc_value, unused_traceback):
+    self.breaker.record(self.keys, self.probes, exc_value)
+    return False
+
+
+class _NoGuard(object):
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, unused_traceback):
+    return False
+
+
+_NO_GUARD = _NoGuard()
+
+
+def guard(breaker, keyspaces, tablet_type):
+  """Returns breaker.guard for the keyspaces, or a no-op if breaker is None.
+
+  Args:
+    breaker: a CircuitBreaker, or None.
+    keyspaces: list of keyspace names, None for v3 queries.
+    tablet_type: the (string) tablet type of the call.
+
+  Returns:
+    A context manager, see CircuitBreaker.guard.
+  """
+  if breaker is None:
+    return _NO_GUARD
+  tablet_type = tablet_type.lower() if tablet_type else tablet_type
+  return breaker.guard([(keyspace, tablet_type)
+                        for keyspace in sorted(set(keyspaces))])
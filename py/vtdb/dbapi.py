@@ -12,6 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import re
+import threading
+
 from vtdb import dbexceptions
 
 
@@ -41,6 +44,13 @@ class BindVarsProxy(object):
 # convert bind style from %(name)s to :name and export only the
 # variables bound.
 def prepare_query_bind_vars(query, bind_vars):
+  prepared = prepared_query_cache.get(query)
+  if prepared is None:
+    return _prepare_query_bind_vars_uncached(query, bind_vars)
+  return prepared.bind(bind_vars)
+
+
+def _prepare_query_bind_vars_uncached(query, bind_vars):
   bind_vars_proxy = BindVarsProxy(bind_vars)
   try:
     query %= bind_vars_proxy
@@ -48,3 +58,202 @@ def prepare_query_bind_vars(query, bind_vars):
     raise dbexceptions.InterfaceError(e[0], query, bind_vars)
 
   return query, bind_vars_proxy.export_bind_vars()
+
+
+# The size of the process-wide cache of prepared queries.
+DEFAULT_PREPARED_QUERY_CACHE_SIZE = 1000
+
+# Placeholders are replaced by this marker while parsing a query.
+_MARKER = '\x00'
+_marker_re = re.compile(r'\x00(\d+)\x00')
+
+
+class _BindNameRecorder(object):
+  """A mapping recording the names a query references, in order."""
+
+  def __init__(self):
+    self.names = []
+
+  def __getitem__(self, name):
+    self.names.append(name)
+    return '%s%d%s' % (_MARKER, len(self.names) - 1, _MARKER)
+
+
+class PreparedQuery(object):
+  """A %(name)s query, parsed once and bound many times.
+
+  Parsing runs the python % formatting once, and splits the result
+  around the bind variable placeholders. Binding then only looks up the
+  referenced variables. The rewritten text depends on which variables
+  are lists (::name instead of :name): the text without lists is built
+  when parsing, the other ones once per such shape.
+
+  Attributes:
+    query: the original query.
+    bind_names: the tuple of the referenced bind variable names.
+  """
+
+  def __init__(self, query):
+    """Parses a query.
+
+    Args:
+      query: the query, with %(name)s bind variables.
+
+    Raises:
+      ValueError: if the query contains the marker character, or uses
+        conversions other than %(name)s, like %(name)r.
+    """
+    if _MARKER in query:
+      raise ValueError('query cannot be prepared', query)
+    recorder = _BindNameRecorder()
+    parts = _marker_re.split(query % recorder)
+    if len(parts) != 2 * len(recorder.names) + 1:
+      raise ValueError('query cannot be prepared', query)
+    self.query = query
+    # parts alternates literal text and placeholder indexes.
+    self._literals = parts[0::2]
+    self._names = [recorder.names[int(i)] for i in parts[1::2]]
+    self.bind_names = tuple(sorted(set(self._names)))
+    self._scalar_text = self._text(frozenset())
+    self._texts = {}
+
+  def _text(self, list_names):
+    pieces = [self._literals[0]]
+    for name, literal in zip(self._names, self._literals[1:]):
+      pieces.append((name in list_names and '::' or ':') + name)
+      pieces.append(literal)
+    return ''.join(pieces)
+
+  def bind(self, bind_vars):
+    """Returns the :name query and the referenced bind variables.
+
+    This is equivalent to prepare_query_bind_vars(query, bind_vars).
+
+    Args:
+      bind_vars: the map of bind variables.
+
+    Returns:
+      The rewritten query and the dict of the referenced bind variables.
+
+    Raises:
+      dbexceptions.InterfaceError: if a referenced variable is missing.
+    """
+    try:
+      exported = {name: bind_vars[name] for name in self.bind_names}
+    except KeyError as e:
+      raise dbexceptions.InterfaceError(e[0], self.query, bind_vars)
+    except TypeError:
+      # bind_vars is None, and names are referenced.
+      raise dbexceptions.InterfaceError(
+          self.bind_names[0], self.query, bind_vars)
+    for value in exported.itervalues():
+      if isinstance(value, (list, set, tuple)):
+        break
+    else:
+      return self._scalar_text, exported
+    list_names = frozenset(
+        name for name, value in exported.iteritems()
+        if isinstance(value, (list, set, tuple)))
+    text = self._texts.get(list_names)
+    if text is None:
+      text = self._text(list_names)
+      self._texts[list_names] = text
+    return text, exported
+
+
+# _UNPREPARED is cached for the queries that cannot be prepared.
+_UNPREPARED = object()
+
+
+class PreparedQueryCache(object):
+  """An LRU cache of PreparedQuery objects, keyed by query text.
+
+  The queries that cannot be prepared are cached too, so they are not
+  parsed again. The entries are kept in a circular doubly linked list of
+  [prev, next, query, prepared] links, most recently used last: moving
+  a link on a hit costs a few assignments, a fraction of the pop and
+  insert of an OrderedDict.
+  """
+
+  def __init__(self, capacity=DEFAULT_PREPARED_QUERY_CACHE_SIZE):
+    self.capacity = capacity
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._links = {}
+    self._root = []
+    self._root[:] = [self._root, self._root, None, None]
+    self._lock = threading.Lock()
+
+  def get(self, query):
+    """Returns the PreparedQuery for a query.
+
+    Args:
+      query: the query, with %(name)s bind variables.
+
+    Returns:
+      The PreparedQuery, or None if the query cannot be prepared.
+    """
+    with self._lock:
+      link = self._links.get(query)
+      if link is not None:
+        self.hits += 1
+        prev, nxt, _, prepared = link
+        prev[1] = nxt
+        nxt[0] = prev
+        root = self._root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+      else:
+        self.misses += 1
+    if link is None:
+      try:
+        prepared = PreparedQuery(query)
+      except ValueError:
+        prepared = _UNPREPARED
+      self._add(query, prepared)
+    if prepared is _UNPREPARED:
+      return None
+    return prepared
+
+  def _add(self, query, prepared):
+    with self._lock:
+      if query in self._links:
+        # Another thread prepared it meanwhile.
+        return
+      root = self._root
+      last = root[0]
+      link = [last, root, query, prepared]
+      last[1] = root[0] = link
+      self._links[query] = link
+      while len(self._links) > self.capacity:
+        oldest = root[1]
+        root[1] = oldest[1]
+        oldest[1][0] = root
+        del self._links[oldest[2]]
+        self.evictions += 1
+
+  def clear(self):
+    with self._lock:
+      self._links.clear()
+      self._root[:] = [self._root, self._root, None, None]
+
+  def stats(self):
+    """Returns a dict with the size and the hit / miss counters."""
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {
+          'size': len(self._links),
+          'capacity': self.capacity,
+          'hits': self.hits,
+          'misses': self.misses,
+          'evictions': self.evictions,
+          'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+      }
+
+
+# prepared_query_cache is the process-wide cache used by
+# prepare_query_bind_vars.
+prepared_query_cache = PreparedQueryCache()
@@ -106,3 +106,10 @@ class ThrottledError(DatabaseError):
 # binlogs on the server.
 class QueryNotServed(DatabaseError):
   pass
+
+
+# CircuitOpenError is raised without calling vtgate, when the client-side
+# circuit breaker of the keyspace and tablet type is open because too many
+# recent calls failed. See circuit_breaker.
+class CircuitOpenError(OperationalError):
+  pass
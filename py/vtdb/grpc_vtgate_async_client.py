@@ -0,0 +1,459 @@
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A non-blocking gRPC connection to vtgate, returning futures.
+
+Every *_async method returns a concurrent.futures.Future right away,
+without blocking the calling thread: unary RPCs use the gRPC future API,
+and retries are scheduled on a shared timer thread instead of sleeping.
+The blocking methods of GRPCVTGateConnection are unchanged.
+Event loops can wait on these futures directly (for instance with
+asyncio.wrap_future, or by yielding them in a tornado coroutine), so one
+process can have thousands of queries in flight.
+
+Streaming calls return a future of a StreamReader, whose next_chunk()
+returns a future of the next decoded chunk. Reading a stream needs a
+blocking gRPC call, so these reads run on a shared thread pool. Opening
+a stream, which waits for its first response, runs on another pool: the
+reads of idle update or message streams cannot delay new streams.
+
+As for the blocking connection, the transaction state is per object:
+calls inside a transaction must not overlap.
+
+Usage:
+  conn = grpc_vtgate_async_client.connect('localhost:15991', 30.0)
+  future = conn.execute_async('select id from user where id = :id', {'id': 1},
+                        'replica', keyspace_name='user')
+  results, rowcount, lastrowid, fields = future.result()
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from concurrent import futures
+
+from vtdb import dbexceptions
+from vtdb import grpc_vtgate_client
+from vtdb import vtgate_utils
+
+# DEFAULT_STREAM_WORKERS is the number of threads reading streams.
+DEFAULT_STREAM_WORKERS = 16
+# DEFAULT_OPEN_WORKERS is the number of threads opening streams.
+DEFAULT_OPEN_WORKERS = 8
+
+RETRY_EXCEPTIONS = (dbexceptions.ThrottledError, dbexceptions.TransientError)
+
+_stream_executor = None
+_open_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_stream_executor():
+  """Returns the process-wide executor used to read streams."""
+  global _stream_executor
+  with _executor_lock:
+    if _stream_executor is None:
+      _stream_executor = futures.ThreadPoolExecutor(DEFAULT_STREAM_WORKERS)
+    return _stream_executor
+
+
+def get_open_executor():
+  """Returns the process-wide executor used to open streams."""
+  global _open_executor
+  with _executor_lock:
+    if _open_executor is None:
+      _open_executor = futures.ThreadPoolExecutor(DEFAULT_OPEN_WORKERS)
+    return _open_executor
+
+
+def connect(addr, timeout, **kwargs):
+  """Returns a dialed AsyncGRPCVTGateConnection.
+
+  Args:
+    addr: address to connect to.
+    timeout: RPC timeout, float in seconds.
+    **kwargs: passed to the AsyncGRPCVTGateConnection constructor.
+
+  Returns:
+    A dialed AsyncGRPCVTGateConnection.
+  """
+  conn = AsyncGRPCVTGateConnection(addr, timeout, **kwargs)
+  conn.dial()
+  return conn
+
+
+class _Scheduler(object):
+  """Runs functions after a delay, on a single daemon thread."""
+
+  def __init__(self):
+    self._queue = []
+    self._counter = itertools.count()
+    self._cond = threading.Condition()
+    self._thread = None
+
+  def call_later(self, delay, func):
+    with self._cond:
+      heapq.heappush(
+          self._queue, (time.time() + delay, next(self._counter), func))
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+      self._cond.notify()
+
+  def _run(self):
+    while True:
+      with self._cond:
+        while not self._queue:
+          self._cond.wait()
+        when, _, func = self._queue[0]
+        now = time.time()
+        if when > now:
+          self._cond.wait(when - now)
+          continue
+        heapq.heappop(self._queue)
+      try:
+        func()
+      except Exception:  # pylint: disable=broad-except
+        logging.exception('scheduled function failed')
+
+
+_scheduler = _Scheduler()
+
+
+class StreamReader(object):
+  """Reads the responses of a gRPC stream without blocking the caller.
+
+  Attributes:
+    fields: the fields of the result, for query streams.
+  """
+
+  def __init__(self, it, decode, fields=None, first_chunk=None,
+               executor=None):
+    self.fields = fields
+    self._it = it
+    self._decode = decode
+    self._first_chunk = first_chunk
+    self._executor = executor or get_stream_executor()
+
+  def next_chunk(self):
+    """Returns a future of the next list of items, or of None at the end."""
+    if self._first_chunk is not None:
+      result = futures.Future()
+      result.set_result(self._first_chunk)
+      self._first_chunk = None
+      return result
+    return self._executor.submit(self._read)
+
+  def _read(self):
+    try:
+      response = next(self._it)
+    except StopIteration:
+      return None
+    except Exception as e:
+      raise grpc_vtgate_client._convert_exception(e)  # pylint: disable=protected-access
+    return self._decode(response)
+
+  def cancel(self):
+    self._it.cancel()
+
+
+class AsyncGRPCVTGateConnection(grpc_vtgate_client.GRPCVTGateConnection):
+  """A GRPCVTGateConnection with non-blocking, future-returning methods.
+
+  The future-returning methods are named after the blocking ones, with an
+  _async suffix. The blocking methods of GRPCVTGateConnection are still
+  available, and unchanged.
+  """
+
+  def __init__(self, addr, timeout, num_retries=vtgate_utils.NUM_RETRIES,
+               initial_delay_ms=vtgate_utils.INITIAL_DELAY_MS,
+               backoff_multiplier=vtgate_utils.BACKOFF_MULTIPLIER,
+               max_delay_ms=vtgate_utils.MAX_DELAY_MS,
+               stream_executor=None, open_executor=None, **kwargs):
+    """Creates a new AsyncGRPCVTGateConnection.
+
+    Args:
+      addr: address to connect to.
+      timeout: RPC timeout, float in seconds.
+      num_retries: max number of retries on transient errors.
+      initial_delay_ms: initial delay between retries in ms.
+      backoff_multiplier: multiplier for each retry delay.
+      max_delay_ms: upper bound on retry delay.
+      stream_executor: executor to read streams with, defaults to
+        the process-wide one.
+      open_executor: executor to open streams with, defaults to the
+        process-wide one.
+      **kwargs: passed up.
+    """
+    super(AsyncGRPCVTGateConnection, self).__init__(addr, timeout, **kwargs)
+    self.num_retries = num_retries
+    self.initial_delay_ms = initial_delay_ms
+    self.backoff_multiplier = backoff_multiplier
+    self.max_delay_ms = max_delay_ms
+    self.stream_executor = stream_executor or get_stream_executor()
+    self.open_executor = open_executor or get_open_executor()
+
+  def _call(self, build_request, start, process_response, exc_kwargs,
+            private_data=None, retry=True):
+    """Runs an RPC, with retries, and returns a future of its result.
+
+    Args:
+      build_request: function returning a (method_name, request) pair.
+        It is called again for each retry.
+      start: function taking (method_name, request), returning a future
+        of the raw response.
+      process_response: function taking (method_name, response), returning
+        the result. Raises VitessError for application errors.
+      exc_kwargs: keyword args for _convert_exception.
+      private_data: logged with log_private_data on errors.
+      retry: False to never retry.
+
+    Returns:
+      A concurrent.futures.Future.
+    """
+    result = futures.Future()
+    state = {'attempt': 0, 'delay': self.initial_delay_ms}
+
+    def attempt():
+      method_name = None
+      try:
+        method_name, request = build_request()
+        call = start(method_name, request)
+      except Exception as e:  # pylint: disable=broad-except
+        fail(method_name, e)
+        return
+      call.add_done_callback(lambda call: done(method_name, call))
+
+    def done(method_name, call):
+      try:
+        value = process_response(method_name, call.result())
+      except Exception as e:  # pylint: disable=broad-except
+        fail(method_name, e)
+        return
+      result.set_result(value)
+
+    def fail(method_name, e):
+      if private_data is not None:
+        self.logger_object.log_private_data(private_data)
+      exc = grpc_vtgate_client._convert_exception(  # pylint: disable=protected-access
+          e, method_name, **exc_kwargs)
+      if (retry and isinstance(exc, RETRY_EXCEPTIONS) and
+          state['attempt'] < self.num_retries and not self.session):
+        state['attempt'] += 1
+        logging.error(
+            'retryable error: %s, retrying in %d ms, attempt %d of %d', exc,
+            state['delay'], state['attempt'], self.num_retries)
+        _scheduler.call_later(state['delay'] / 1000.0, attempt)
+        state['delay'] = min(self.max_delay_ms,
+                             state['delay'] * self.backoff_multiplier)
+        return
+      result.set_exception(exc)
+
+    attempt()
+    return result
+
+  def _start_unary(self, method_name, request):
+    return getattr(self.stub, method_name).future(request, self.timeout)
+
+  def _start_stream(self, method_name, request):
+    """Opens a stream, and reads its first response, on open_executor."""
+    def open_stream():
+      it = getattr(self.stub, method_name)(request, self.timeout)
+      return it, next(it)
+    return self.open_executor.submit(open_stream)
+
+  def begin_async(self, effective_caller_id=None, single_db=False):
+    """Starts a transaction. Returns a future of None."""
+    def process(unused_method_name, response):
+      self.update_session(response)
+    return self._call(
+        lambda: ('Begin', self.begin_request(effective_caller_id, single_db)),
+        self._start_unary, process, {}, retry=False)
+
+  def commit_async(self, twopc=False):
+    """Commits the current transaction. Returns a future of None."""
+    return self._end_transaction('Commit', lambda: self.commit_request(twopc))
+
+  def rollback_async(self):
+    """Rolls back the current transaction. Returns a future of None."""
+    return self._end_transaction('Rollback', self.rollback_request)
+
+  def _end_transaction(self, method_name, build):
+    def clear_session(unused_future):
+      self.session = None
+    future = self._call(
+        lambda: (method_name, build()),
+        self._start_unary, lambda name, response: None, {}, retry=False)
+    future.add_done_callback(clear_session)
+    return future
+
+  def execute_async(
+      self, sql, bind_variables, tablet_type, keyspace_name=None,
+      shards=None, keyspace_ids=None, keyranges=None,
+      entity_keyspace_id_map=None, entity_column_name=None,
+      not_in_transaction=False, effective_caller_id=None,
+      include_event_token=False, compare_event_token=None, columnar=False,
+      views=False, **kwargs):
+    """Executes a query, see VTGateClient._execute for the args.
+
+    Returns:
+      A future of the (results, rowcount, lastrowid, fields) tuple.
+    """
+    exc_kwargs = dict(sql=sql, keyspace=keyspace_name,
+                      tablet_type=tablet_type,
+                      not_in_transaction=not_in_transaction)
+
+    def build():
+      request, routing_kwargs, method_name = self.execute_request_and_name(
+          sql, bind_variables, tablet_type,
+          keyspace_name, shards, keyspace_ids, keyranges,
+          entity_column_name, entity_keyspace_id_map,
+          not_in_transaction, effective_caller_id, include_event_token,
+          compare_event_token)
+      exc_kwargs.update(routing_kwargs)
+      return method_name, request
+
+    def process(method_name, response):
+      return self.process_execute_response(
+          method_name, response, columnar=columnar, views=views)
+
+    return self._call(build, self._start_unary, process, exc_kwargs,
+                      private_data=bind_variables)
+
+  def execute_batch_async(
+      self, sql_list, bind_variables_list, keyspace_list, keyspace_ids_list,
+      shards_list, tablet_type, as_transaction, effective_caller_id=None,
+      **kwargs):
+    """Executes a batch, see VTGateClient._execute_batch for the args.
+
+    Returns:
+      A future of the list of (results, rowcount, lastrowid, fields).
+    """
+    def build():
+      request, method_name = self.execute_batch_request_and_name(
+          sql_list, bind_variables_list, keyspace_list,
+          keyspace_ids_list, shards_list,
+          tablet_type, as_transaction, effective_caller_id)
+      return method_name, request
+
+    return self._call(
+        build, self._start_unary, self.process_execute_batch_response,
+        dict(sqls=sql_list, tablet_type=tablet_type,
+             as_transaction=as_transaction),
+        private_data=bind_variables_list)
+
+  def stream_execute_async(
+      self, sql, bind_variables, tablet_type, keyspace_name=None,
+      shards=None, keyspace_ids=None, keyranges=None,
+      effective_caller_id=None, views=False,
+      **kwargs):
+    """Starts a streaming query, see VTGateClient._stream_execute.
+
+    Returns:
+      A future of a StreamReader, with fields set. Its chunks are
+      lists of row tuples.
+    """
+    def build():
+      request, _, method_name = self.stream_execute_request_and_name(
+          sql, bind_variables, tablet_type,
+          keyspace_name, shards, keyspace_ids, keyranges,
+          effective_caller_id)
+      return method_name, request
+
+    def process(method_name, response):
+      return self._query_stream_reader(method_name, response, views=views)
+
+    return self._call(
+        build, self._start_stream, process,
+        dict(sql=sql, keyspace=keyspace_name, tablet_type=tablet_type),
+        private_data=bind_variables)
+
+  def message_stream_async(
+      self, keyspace, name,
+      shard=None, key_range=None,
+      effective_caller_id=None,
+      **kwargs):
+    """Starts a message stream, see VTGateClient.message_stream.
+
+    Returns:
+      A future of a StreamReader, with fields set. Its chunks are
+      lists of row tuples.
+    """
+    def build():
+      return 'MessageStream', self.message_stream_request(
+          keyspace, shard, key_range, name, effective_caller_id)
+
+    return self._call(
+        build, self._start_stream, self._query_stream_reader,
+        dict(name=name, keyspace=keyspace))
+
+  def _query_stream_reader(self, unused_method_name, response, views=False):
+    it, first_response = response
+    fields, decoder = self.build_row_decoder(
+        first_response.result.fields, views=views)
+
+    def decode(response):
+      return [decoder(row) for row in response.result.rows]
+    return StreamReader(it, decode, fields=fields,
+                        first_chunk=decode(first_response),
+                        executor=self.stream_executor)
+
+  def update_stream_async(
+      self, keyspace_name, tablet_type,
+      timestamp=None, event=None,
+      shard=None, key_range=None,
+      effective_caller_id=None,
+      **kwargs):
+    """Starts an update stream, see VTGateClient.update_stream.
+
+    Returns:
+      A future of a StreamReader. Its chunks are lists of
+      (event, resume_timestamp) tuples.
+    """
+    def build():
+      return 'UpdateStream', self.update_stream_request(
+          keyspace_name, shard, key_range, tablet_type,
+          timestamp, event, effective_caller_id)
+
+    def process(unused_method_name, response):
+      it, first_response = response
+
+      def decode(response):
+        return [(response.event, response.resume_timestamp)]
+      return StreamReader(it, decode, first_chunk=decode(first_response),
+                          executor=self.stream_executor)
+
+    return self._call(
+        build, self._start_stream, process,
+        dict(keyspace=keyspace_name, tablet_type=tablet_type))
+
+  def message_ack_async(
+      self,
+      name, ids,
+      keyspace=None, effective_caller_id=None,
+      **kwargs):
+    """Acks messages, see VTGateClient.message_ack.
+
+    Returns:
+      A future of the number of rows acked.
+    """
+    return self._call(
+        lambda: ('MessageAck', self.message_ack_request(
+            keyspace, name, ids, effective_caller_id)),
+        self._start_unary,
+        lambda name, response: response.result.rows_affected,
+        dict(name=name, ids=ids, keyspace=keyspace))
@@ -13,10 +13,14 @@
 # limitations under the License.
 
 """A simple, direct connection to the vtgate proxy server, using gRPC.
+
+While rpc_stats observers are registered, the begin, commit, rollback,
+execute and stream execute calls are timed, and reported to them.
 """
 
 import logging
 import re
+import time
 from urlparse import urlparse
 
 from vtdb import prefer_vtroot_imports  # pylint: disable=unused-import
@@ -26,8 +30,11 @@ import grpc
 from vtproto import vtgate_pb2
 from vtproto import vtgateservice_pb2_grpc
 
+from vtdb import circuit_breaker as circuit_breaker_lib
 from vtdb import dbexceptions
 from vtdb import proto3_encoding
+from vtdb import retry_policy
+from vtdb import rpc_stats
 from vtdb import vtdb_logger
 from vtdb import vtgate_client
 from vtdb import vtgate_cursor
@@ -46,7 +53,7 @@ class GRPCVTGateConnection(vtgate_client.VTGateClient,
 
   def __init__(self, addr, timeout,
                root_certificates=None, private_key=None, certificate_chain=None,
-               auth_static_client_creds=None,
+               auth_static_client_creds=None, circuit_breaker=None,
                **kwargs):
     """Creates a new GRPCVTGateConnection.
 
@@ -57,6 +64,8 @@ class GRPCVTGateConnection(vtgate_client.VTGateClient,
       private_key: PEM-encoded private key.
       certificate_chain: PEM-encoded certificate chain.
       auth_static_client_creds: basic auth credentials file path.
+      circuit_breaker: optional circuit_breaker.CircuitBreaker, used by
+        the execute calls. It can be shared by many connections.
       **kwargs: passed up.
     """
     super(GRPCVTGateConnection, self).__init__(addr, timeout, **kwargs)
@@ -66,6 +75,14 @@ class GRPCVTGateConnection(vtgate_client.VTGateClient,
     self.certificate_chain = certificate_chain
     self.auth_static_client_creds = auth_static_client_creds
     self.logger_object = vtdb_logger.get_logger()
+    self.circuit_breaker = circuit_breaker
+    # Counters of the calls made with reuse_session set.
+    self.rpc_count = 0
+    self.bytes_sent = 0
+    self.bytes_received = 0
+    self._channel = None
+    # Map of method name to its callable sending and returning bytes.
+    self._raw_methods = {}
 
   def dial(self):
     if self.stub:
@@ -84,6 +101,8 @@ class GRPCVTGateConnection(vtgate_client.VTGateClient,
       channel = grpc_with_metadata.GRPCWithMetadataChannel(
           channel,
           self.get_auth_static_client_creds)
+    self._channel = channel
+    self._raw_methods = {}
     self.stub = vtgateservice_pb2_grpc.VitessStub(channel)
 
   def close(self):
@@ -113,139 +132,274 @@ class GRPCVTGateConnection(vtgate_client.VTGateClient,
     cursorclass = kwargs.pop('cursorclass', None) or vtgate_cursor.VTGateCursor
     return cursorclass(self, *pargs, **kwargs)
 
+  def _rpc_timeout(self):
+    """Returns the timeout of an RPC, see retry_policy.rpc_timeout."""
+    return retry_policy.rpc_timeout(self.timeout)
+
+  def _invoke(self, method_name, request, timer=None):
+    """Calls a unary method of the vtgate service.
+
+    With reuse_session set, the request is sent already serialized,
+    with the serialized session of the previous response appended to
+    it, and the session of the response is kept serialized for the next
+    call. This saves copying and serializing the session on every call,
+    which matters for transactions spanning many shards.
+
+    Args:
+      method_name: the name of the vtgate method, e.g. 'Execute'.
+      request: the vtgate_pb2 request, without its session.
+      timer: the _RpcTimer of the call, if any. The request must be built.
+
+    Returns:
+      The vtgate_pb2 response.
+    """
+    timer = timer or _NO_TIMER
+    if not self.reuse_session:
+      response = getattr(self.stub, method_name)(request, self._rpc_timeout())
+      timer.lap('wire_time')
+      timer.count_messages(request, response)
+      return response
+    data = request.SerializeToString()
+    request_class = type(request)
+    if proto3_encoding.has_session_field(request_class):
+      session_bytes = self._session_bytes()
+      if session_bytes is not None:
+        data += proto3_encoding.session_field(request_class, session_bytes)
+    method = self._raw_methods.get(method_name)
+    if method is None:
+      # Without serializers, the channel sends and returns bytes as is.
+      method = self._channel.unary_unary(
+          '/vtgateservice.Vitess/' + method_name)
+      self._raw_methods[method_name] = method
+    self.rpc_count += 1
+    self.bytes_sent += len(data)
+    timer.lap('build_time')
+    response_data = method(data, self._rpc_timeout())
+    timer.lap('wire_time')
+    timer.add_bytes(len(data), len(response_data))
+    self.bytes_received += len(response_data)
+    response_class = getattr(vtgate_pb2, method_name + 'Response')
+    response = response_class.FromString(response_data)
+    if (proto3_encoding.has_session_field(response_class) and
+        response.HasField('session')):
+      session_bytes = proto3_encoding.extract_session_bytes(
+          response_class, response_data)
+      if session_bytes is not None:
+        self._raw_session = (response.session, session_bytes)
+    return response
+
   def begin(self, effective_caller_id=None, single_db=False):
+    timer = _start_timer()
     try:
       request = self.begin_request(effective_caller_id, single_db)
-      response = self.stub.Begin(request, self.timeout)
+      timer.built('Begin')
+      response = self._invoke('Begin', request, timer)
       self.update_session(response)
+      timer.lap('decode_time')
+      timer.done()
     except (grpc.RpcError, vtgate_utils.VitessError) as e:
-      raise _convert_exception(e, 'Begin')
+      raise timer.done(_convert_exception(e, 'Begin'))
 
   def commit(self, twopc=False):
+    timer = _start_timer()
     try:
       request = self.commit_request(twopc)
-      self.stub.Commit(request, self.timeout)
+      timer.built('Commit')
+      self._invoke('Commit', request, timer)
+      timer.done()
     except (grpc.RpcError, vtgate_utils.VitessError) as e:
-      raise _convert_exception(e, 'Commit')
+      raise timer.done(_convert_exception(e, 'Commit'))
     finally:
       self.session = None
 
   def rollback(self):
+    timer = _start_timer()
     try:
       request = self.rollback_request()
-      self.stub.Rollback(request, self.timeout)
+      timer.built('Rollback')
+      self._invoke('Rollback', request, timer)
+      timer.done()
     except (grpc.RpcError, vtgate_utils.VitessError) as e:
-      raise _convert_exception(e, 'Rollback')
+      raise timer.done(_convert_exception(e, 'Rollback'))
     finally:
       self.session = None
 
-  @vtgate_utils.exponential_backoff_retry((dbexceptions.ThrottledError,
-                                           dbexceptions.TransientError))
+  @retry_policy.retry((dbexceptions.ThrottledError,
+                       dbexceptions.TransientError))
   def _execute(
       self, sql, bind_variables, tablet_type, keyspace_name=None,
       shards=None, keyspace_ids=None, keyranges=None,
       entity_keyspace_id_map=None, entity_column_name=None,
       not_in_transaction=False, effective_caller_id=None,
-      include_event_token=False, compare_event_token=None, **kwargs):
+      include_event_token=False, compare_event_token=None, columnar=False,
+      views=False, **kwargs):
 
     # FIXME(alainjobart): keyspace should be in routing_kwargs,
     # as it's not used for v3.
 
-    try:
-      request, routing_kwargs, method_name = self.execute_request_and_name(
-          sql, bind_variables, tablet_type,
-          keyspace_name, shards, keyspace_ids, keyranges,
-          entity_column_name, entity_keyspace_id_map,
-          not_in_transaction, effective_caller_id, include_event_token,
-          compare_event_token)
-      method = getattr(self.stub, method_name)
-      response = method(request, self.timeout)
-      return self.process_execute_response(method_name, response)
-
-    except (grpc.RpcError, vtgate_utils.VitessError) as e:
-      self.logger_object.log_private_data(bind_variables)
-      raise _convert_exception(
-          e, method_name,
-          sql=sql, keyspace=keyspace_name, tablet_type=tablet_type,
-          not_in_transaction=not_in_transaction,
-          **routing_kwargs)
-
-  @vtgate_utils.exponential_backoff_retry((dbexceptions.ThrottledError,
-                                           dbexceptions.TransientError))
+    with circuit_breaker_lib.guard(
+        self.circuit_breaker, [keyspace_name], tablet_type):
+      timer = _start_timer(keyspace_name, tablet_type)
+      try:
+        request, routing_kwargs, method_name = self.execute_request_and_name(
+            sql, bind_variables, tablet_type,
+            keyspace_name, shards, keyspace_ids, keyranges,
+            entity_column_name, entity_keyspace_id_map,
+            not_in_transaction, effective_caller_id, include_event_token,
+            compare_event_token)
+        timer.built(method_name)
+        response = self._invoke(method_name, request, timer)
+        result = self.process_execute_response(
+            method_name, response, columnar=columnar, views=views)
+        timer.lap('decode_time')
+        timer.done(rows=len(response.result.rows))
+        return result
+
+      except (grpc.RpcError, vtgate_utils.VitessError) as e:
+        self.logger_object.log_private_data(bind_variables)
+        raise timer.done(_convert_exception(
+            e, method_name,
+            sql=sql, keyspace=keyspace_name, tablet_type=tablet_type,
+            not_in_transaction=not_in_transaction,
+            **routing_kwargs))
+
+  @retry_policy.retry((dbexceptions.ThrottledError,
+                       dbexceptions.TransientError))
   def _execute_batch(
       self, sql_list, bind_variables_list, keyspace_list, keyspace_ids_list,
       shards_list, tablet_type, as_transaction, effective_caller_id=None,
       **kwargs):
 
-    try:
-      request, method_name = self.execute_batch_request_and_name(
-          sql_list, bind_variables_list, keyspace_list,
-          keyspace_ids_list, shards_list,
-          tablet_type, as_transaction, effective_caller_id)
-      method = getattr(self.stub, method_name)
-      response = method(request, self.timeout)
-      return self.process_execute_batch_response(method_name, response)
-
-    except (grpc.RpcError, vtgate_utils.VitessError) as e:
-      self.logger_object.log_private_data(bind_variables_list)
-      raise _convert_exception(
-          e, method_name,
-          sqls=sql_list, tablet_type=tablet_type,
-          as_transaction=as_transaction)
-
-  @vtgate_utils.exponential_backoff_retry((dbexceptions.ThrottledError,
-                                           dbexceptions.TransientError))
+    with circuit_breaker_lib.guard(
+        self.circuit_breaker, keyspace_list or [None], tablet_type):
+      keyspaces = sorted(set(keyspace_list or []))
+      timer = _start_timer(','.join(keyspaces) or None, tablet_type)
+      try:
+        request, method_name = self.execute_batch_request_and_name(
+            sql_list, bind_variables_list, keyspace_list,
+            keyspace_ids_list, shards_list,
+            tablet_type, as_transaction, effective_caller_id)
+        timer.built(method_name)
+        response = self._invoke(method_name, request, timer)
+        rowsets = self.process_execute_batch_response(method_name, response)
+        timer.lap('decode_time')
+        timer.done(rows=sum(len(r.rows) for r in response.results))
+        return rowsets
+
+      except (grpc.RpcError, vtgate_utils.VitessError) as e:
+        self.logger_object.log_private_data(bind_variables_list)
+        raise timer.done(_convert_exception(
+            e, method_name,
+            sqls=sql_list, tablet_type=tablet_type,
+            as_transaction=as_transaction))
+
+  @retry_policy.retry((dbexceptions.ThrottledError,
+                       dbexceptions.TransientError))
   def _stream_execute(
       self, sql, bind_variables, tablet_type, keyspace_name=None,
       shards=None, keyspace_ids=None, keyranges=None,
-      effective_caller_id=None,
+      effective_caller_id=None, chunked=False, views=False,
       **kwargs):
 
-    try:
-      request, routing_kwargs, method_name = (
-          self.stream_execute_request_and_name(
-              sql, bind_variables, tablet_type,
-              keyspace_name,
-              shards,
-              keyspace_ids,
-              keyranges,
-              effective_caller_id))
-      method = getattr(self.stub, method_name)
-      it = method(request, self.timeout)
-      first_response = it.next()
-    except (grpc.RpcError, vtgate_utils.VitessError) as e:
-      self.logger_object.log_private_data(bind_variables)
-      raise _convert_exception(
-          e, method_name,
-          sql=sql, keyspace=keyspace_name, tablet_type=tablet_type,
-          **routing_kwargs)
-
-    fields, convs = self.build_conversions(first_response.result.fields)
-
-    def row_generator():
+    # Only the start of the stream goes through the circuit breaker.
+    with circuit_breaker_lib.guard(
+        self.circuit_breaker, [keyspace_name], tablet_type):
+      timer = _start_timer(keyspace_name, tablet_type)
+      try:
+        request, routing_kwargs, method_name = (
+            self.stream_execute_request_and_name(
+                sql, bind_variables, tablet_type,
+                keyspace_name,
+                shards,
+                keyspace_ids,
+                keyranges,
+                effective_caller_id))
+        timer.built(method_name)
+        method = getattr(self.stub, method_name)
+        it = method(request, self._rpc_timeout())
+        first_response = it.next()
+        timer.lap('wire_time')
+        timer.count_messages(request, first_response)
+      except (grpc.RpcError, vtgate_utils.VitessError) as e:
+        self.logger_object.log_private_data(bind_variables)
+        raise timer.done(_convert_exception(
+            e, method_name,
+            sql=sql, keyspace=keyspace_name, tablet_type=tablet_type,
+            **routing_kwargs))
+
+    fields, decoder = self.build_row_decoder(
+        first_response.result.fields, views=views)
+    timer.lap('decode_time')
+
+    stream = _CancellableStream(it)
+
+    # The stream is reported to the observers once it ends. The time the
+    # caller spends between two chunks is not counted.
+    def chunk_generator():
+      error = None
       try:
         for response in it:
-          for row in response.result.rows:
-            yield tuple(proto3_encoding.make_row(row, convs))
-      except Exception:
-        logging.exception('gRPC low-level error')
+          timer.lap('wire_time')
+          timer.count_messages(None, response)
+          if response.result.rows:
+            chunk = [decoder(row) for row in response.result.rows]
+            timer.lap('decode_time')
+            timer.add_rows(len(chunk))
+            yield chunk
+            timer.pause()
+      except Exception as e:
+        if not stream.cancelled:
+          logging.exception('gRPC low-level error')
+        error = e
         raise
+      finally:
+        timer.done(error)
 
-    return row_generator(), fields
+    def row_generator():
+      for chunk in chunk_generator():
+        for row in chunk:
+          yield row
+
+    if chunked:
+      stream.items = chunk_generator()
+    else:
+      stream.items = row_generator()
+    return stream, fields
 
   def get_srv_keyspace(self, name):
     try:
       request = vtgate_pb2.GetSrvKeyspaceRequest(
           keyspace=name,
       )
-      response = self.stub.GetSrvKeyspace(request, self.timeout)
+      response = self.stub.GetSrvKeyspace(request, self._rpc_timeout())
       return self.keyspace_from_response(name, response)
 
     except (grpc.RpcError, vtgate_utils.VitessError) as e:
       raise _convert_exception(e, keyspace=name)
 
-  @vtgate_utils.exponential_backoff_retry((dbexceptions.ThrottledError,
-                                           dbexceptions.TransientError))
+  @retry_policy.retry((dbexceptions.ThrottledError,
+                       dbexceptions.TransientError))
+  def split_query(
+      self, sql, keyspace, bind_variables=None,
+      split_columns=None, split_count=0,
+      num_rows_per_query_part=0, algorithm=None,
+      effective_caller_id=None,
+      **kwargs):
+
+    try:
+      request = self.split_query_request(
+          sql, keyspace, bind_variables, split_columns, split_count,
+          num_rows_per_query_part, algorithm, effective_caller_id)
+      response = self.stub.SplitQuery(request, self._rpc_timeout())
+      return self.query_splits_from_response(response)
+
+    except (grpc.RpcError, vtgate_utils.VitessError) as e:
+      self.logger_object.log_private_data(bind_variables)
+      raise _convert_exception(
+          e, 'SplitQuery', sql=sql, keyspace=keyspace)
+
+  @retry_policy.retry((dbexceptions.ThrottledError,
+                       dbexceptions.TransientError))
   def update_stream(
       self, keyspace_name, tablet_type,
       timestamp=None, event=None,
@@ -257,7 +411,7 @@ class GRPCVTGateConnection(vtgate_client.VTGateClient,
       request = self.update_stream_request(
           keyspace_name, shard, key_range, tablet_type,
           timestamp, event, effective_caller_id)
-      it = self.stub.UpdateStream(request, self.timeout)
+      it = self.stub.UpdateStream(request, self._rpc_timeout())
     except (grpc.RpcError, vtgate_utils.VitessError) as e:
       raise _convert_exception(
           e, 'UpdateStream',
@@ -272,8 +426,37 @@ class GRPCVTGateConnection(vtgate_client.VTGateClient,
 
     return row_generator()
 
-  @vtgate_utils.exponential_backoff_retry((dbexceptions.ThrottledError,
-                                           dbexceptions.TransientError))
+  def vstream(
+      self, tablet_type, vgtid,
+      filter_rules=None, batch=False,
+      effective_caller_id=None,
+      **kwargs):
+
+    try:
+      request = self.vstream_request(
+          tablet_type, vgtid, filter_rules, effective_caller_id)
+      it = self.stub.VStream(request, self._rpc_timeout())
+    except (grpc.RpcError, vtgate_utils.VitessError) as e:
+      raise _convert_exception(
+          e, 'VStream', tablet_type=tablet_type)
+
+    decoder = proto3_encoding.VStreamDecoder(request.vgtid)
+
+    def event_generator():
+      try:
+        if batch:
+          for transaction in decoder.transactions(it):
+            yield transaction
+        else:
+          for row_change in decoder.rows(it):
+            yield row_change
+      except Exception as e:
+        raise _convert_exception(e)
+
+    return event_generator()
+
+  @retry_policy.retry((dbexceptions.ThrottledError,
+                       dbexceptions.TransientError))
   def message_stream(
       self, keyspace, name,
       shard=None, key_range=None,
@@ -284,28 +467,28 @@ class GRPCVTGateConnection(vtgate_client.VTGateClient,
       request = self.message_stream_request(
           keyspace, shard, key_range,
           name, effective_caller_id)
-      it = self.stub.MessageStream(request, self.timeout)
+      it = self.stub.MessageStream(request, self._rpc_timeout())
       first_response = it.next()
     except (grpc.RpcError, vtgate_utils.VitessError) as e:
       raise _convert_exception(
           e, 'MessageStream', name=name,
           keyspace=keyspace)
 
-    fields, convs = self.build_conversions(first_response.result.fields)
+    fields, decoder = self.build_row_decoder(first_response.result.fields)
 
     def row_generator():
       try:
         for response in it:
           for row in response.result.rows:
-            yield tuple(proto3_encoding.make_row(row, convs))
+            yield decoder(row)
       except Exception:
         logging.exception('gRPC low-level error')
         raise
 
     return row_generator(), fields
 
-  @vtgate_utils.exponential_backoff_retry((dbexceptions.ThrottledError,
-                                           dbexceptions.TransientError))
+  @retry_policy.retry((dbexceptions.ThrottledError,
+                       dbexceptions.TransientError))
   def message_ack(
       self,
       name, ids,
@@ -315,7 +498,7 @@ class GRPCVTGateConnection(vtgate_client.VTGateClient,
     try:
       request = self.message_ack_request(
           keyspace, name, ids, effective_caller_id)
-      response = self.stub.MessageAck(request, self.timeout)
+      response = self.stub.MessageAck(request, self._rpc_timeout())
     except (grpc.RpcError, vtgate_utils.VitessError) as e:
       raise _convert_exception(
           e, 'MessageAck', name=name, ids=ids,
@@ -323,11 +506,154 @@ class GRPCVTGateConnection(vtgate_client.VTGateClient,
 
     return response.result.rows_affected
 
+  @retry_policy.retry((dbexceptions.ThrottledError,
+                       dbexceptions.TransientError))
+  def message_ack_keyspace_ids(
+      self,
+      name, id_keyspace_ids,
+      keyspace=None, effective_caller_id=None,
+      **kwargs):
+
+    try:
+      request = self.message_ack_keyspace_ids_request(
+          keyspace, name, id_keyspace_ids, effective_caller_id)
+      response = self.stub.MessageAckKeyspaceIds(request, self._rpc_timeout())
+    except (grpc.RpcError, vtgate_utils.VitessError) as e:
+      raise _convert_exception(
+          e, 'MessageAckKeyspaceIds', name=name,
+          ids=[message_id for message_id, _ in id_keyspace_ids],
+          keyspace=keyspace)
+
+    return response.result.rows_affected
+
   def get_warnings(self):
     if self.session:
       return self.session.warnings
     return []
 
+class _CancellableStream(object):
+  """The row or chunk iterator of a stream, see _stream_execute.
+
+  Unlike a generator, it can be cancelled from another thread while a
+  thread is blocked reading it: the pending read then raises.
+  """
+
+  def __init__(self, call):
+    self.call = call
+    self.items = None
+    self.cancelled = False
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    return self.items.next()
+
+  def close(self):
+    self.items.close()
+
+  def cancel(self):
+    """Cancels the RPC."""
+    self.cancelled = True
+    cancel = getattr(self.call, 'cancel', None)
+    if cancel:
+      cancel()
+
+
+class _RpcTimer(object):
+  """Measures the phases of one RPC, and reports it to rpc_stats.
+
+  The time between two calls to lap is added to the given phase. Time
+  spent by the caller, between pause and the next lap, is not counted.
+  """
+
+  def __init__(self, keyspace, tablet_type):
+    if tablet_type is not None and not isinstance(tablet_type, basestring):
+      tablet_type = str(tablet_type)
+    self.event = rpc_stats.RpcEvent(
+        None, keyspace=keyspace,
+        tablet_type=tablet_type.lower() if tablet_type else tablet_type,
+        retries=retry_policy.current_attempt())
+    self.rows = 0
+    self._last = time.time()
+    self._paused = False
+    self._done = False
+
+  def built(self, method_name):
+    self.event.method = method_name
+    self.lap('build_time')
+
+  def lap(self, phase):
+    now = time.time()
+    if not self._paused:
+      setattr(self.event, phase, getattr(self.event, phase) + now - self._last)
+    self._paused = False
+    self._last = now
+
+  def pause(self):
+    self._paused = True
+
+  def add_rows(self, rows):
+    self.rows += rows
+
+  def add_bytes(self, sent, received):
+    self.event.bytes_sent += sent
+    self.event.bytes_received += received
+
+  def count_messages(self, request, response):
+    """Adds the size of proto messages, the time taken is not counted."""
+    if request is not None:
+      self.event.bytes_sent += request.ByteSize()
+    if response is not None:
+      self.event.bytes_received += response.ByteSize()
+    self._last = time.time()
+
+  def done(self, error=None, rows=None):
+    """Reports the RPC to the observers, once, and returns error."""
+    if not self._done:
+      self._done = True
+      self.event.rows = self.rows if rows is None else rows
+      self.event.error = error
+      if self.event.method is not None:
+        rpc_stats.notify(self.event)
+    return error
+
+
+class _NoTimer(object):
+  """The _RpcTimer used while no rpc_stats observer is registered."""
+
+  def built(self, method_name):
+    pass
+
+  def lap(self, phase):
+    pass
+
+  def pause(self):
+    pass
+
+  def add_rows(self, rows):
+    pass
+
+  def add_bytes(self, sent, received):
+    pass
+
+  def count_messages(self, request, response):
+    pass
+
+  def done(self, error=None, rows=None):
+    return error
+
+
+_NO_TIMER = _NoTimer()
+
+
+def _start_timer(keyspace=None, tablet_type=None):
+  """Returns an _RpcTimer, or a no-op if there is no observer."""
+  if not rpc_stats.observers:
+    return _NO_TIMER
+  return _RpcTimer(keyspace, tablet_type)
+
+
 def _convert_exception(exc, *args, **kwargs):
   """This parses the protocol exceptions to the api interface exceptions.
 
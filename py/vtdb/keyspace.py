@@ -14,6 +14,7 @@
 
 """A Vitess keyspace represents a sharded MySQL database."""
 
+import bisect
 import struct
 
 from vtdb import keyrange_constants
@@ -36,6 +37,8 @@ class Keyspace(object):
     self.sharding_col_type = data.get(
         'ShardingColumnType', keyrange_constants.KIT_UNSET)
     self.served_from = data.get('ServedFrom', None)
+    # Map of db_type to its _ShardMap, built on first use.
+    self._shard_maps = {}
 
   def get_shards(self, db_type):
     if not db_type:
@@ -57,13 +60,21 @@ class Keyspace(object):
     shards = self.get_shards(db_type)
     return [shard['Name'] for shard in shards]
 
+  def _get_shard_map(self, db_type):
+    shard_map = self._shard_maps.get(db_type)
+    if shard_map is None:
+      shard_map = _ShardMap(self.get_shards(db_type))
+      self._shard_maps[db_type] = shard_map
+    return shard_map
+
   def keyspace_id_to_shard_name_for_db_type(self, keyspace_id, db_type):
     """Finds the shard for a keyspace_id.
 
-    WARNING: this only works for KIT_UINT64 keyspace ids.
+    WARNING: this only works for KIT_UINT64 keyspace ids, or keyspace
+    ids that are already packed.
 
     Args:
-      keyspace_id: A uint64 keyspace_id.
+      keyspace_id: A uint64 keyspace_id, or a packed keyspace_id string.
       db_type: Str tablet type (master, rdonly, or replica).
 
     Returns:
@@ -76,20 +87,68 @@ class Keyspace(object):
       raise ValueError('keyspace_id is not set')
     if not db_type:
       raise ValueError('db_type is not set')
-    # Pack this into big-endian and do a byte-wise comparison.
-    pkid = pack_keyspace_id(keyspace_id)
-    shards = self.get_shards(db_type)
+    return self._get_shard_map(db_type).find(keyspace_id)
+
+  def keyspace_ids_to_shard_names_for_db_type(self, keyspace_ids, db_type):
+    """Finds the shards for many keyspace_ids at once.
+
+    Args:
+      keyspace_ids: A list of keyspace_ids, see
+        keyspace_id_to_shard_name_for_db_type.
+      db_type: Str tablet type (master, rdonly, or replica).
+
+    Returns:
+      The list of the shard names, in the order of keyspace_ids.
+
+    Raises:
+      ValueError: On invalid keyspace_id.
+    """
+    if not db_type:
+      raise ValueError('db_type is not set')
+    shard_map = self._get_shard_map(db_type)
+    find = shard_map.find
+    names = []
+    for keyspace_id in keyspace_ids:
+      if not keyspace_id:
+        raise ValueError('keyspace_id is not set')
+      names.append(find(keyspace_id))
+    return names
+
+
+class _ShardMap(object):
+  """The shards of a partition, sorted by start, to find them by bisection.
+
+  Packed keyspace ids are compared byte-wise with the sorted start
+  boundaries, then with the end of the shard found.
+  """
+
+  def __init__(self, shards):
+    self.shards = shards
+    entries = []
     for shard in shards:
       if 'KeyRange' not in shard or not shard['KeyRange']:
         # this keyrange is covering the full space
-        return shard['Name']
-      if _shard_contain_kid(pkid,
-                            shard['KeyRange']['Start'],
-                            shard['KeyRange']['End']):
-        return shard['Name']
+        entries.append((keyrange_constants.MIN_KEY,
+                        keyrange_constants.MAX_KEY, shard['Name']))
+      else:
+        entries.append((shard['KeyRange']['Start'],
+                        shard['KeyRange']['End'], shard['Name']))
+    entries.sort()
+    self.starts = [start for start, _, _ in entries]
+    self.ends = [end for _, end, _ in entries]
+    self.names = [name for _, _, name in entries]
+
+  def find(self, keyspace_id):
+    if isinstance(keyspace_id, str):
+      pkid = keyspace_id
+    else:
+      # Pack this into big-endian and do a byte-wise comparison.
+      pkid = pack_keyspace_id(keyspace_id)
+    i = bisect.bisect_right(self.starts, pkid) - 1
+    if i >= 0:
+      end = self.ends[i]
+      if end == keyrange_constants.MAX_KEY or pkid < end:
+        return self.names[i]
     raise ValueError(
-        'cannot find shard for keyspace_id %s in %s' % (keyspace_id, shards))
-
-
-def _shard_contain_kid(pkid, start, end):
-  return start <= pkid and (end == keyrange_constants.MAX_KEY or pkid < end)
+        'cannot find shard for keyspace_id %s in %s' % (
+            keyspace_id, self.shards))
@@ -0,0 +1,362 @@
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Consumes the messages of a message table, and acks them in batches.
+
+MessageConsumer opens one VTGateClient.message_stream per shard, each
+in its own thread. The received rows go through a bounded queue to a
+pool of worker threads, which call the handler. The ids of the
+messages handled successfully are acked by num_ack_threads dedicated
+threads, with a single MessageAck RPC for up to max_ack_batch ids, sent
+once the batch is full or once its oldest id waited max_ack_delay, so
+up to num_ack_threads ack RPCs are in flight. The readers and the
+workers never wait for an ack RPC. If the acks fall behind, up to
+max_pending_acks ids are buffered, after which the workers wait for
+the acks to catch up, and the streams stall in turn.
+
+If the message table has no id_column, the consumer stops, and error
+is set to a ProgrammingError.
+
+If keyspace_id_func is set, it returns the packed keyspace id of a
+message row, and the acks are sent with MessageAckKeyspaceIds, so each
+shard only receives the acks of its own messages.
+
+Messages whose handler raised are not acked, and neither are the ones
+still in the queue when the consumer is closed: vttablet sends them
+again once their ack wait expires. Handlers must therefore be
+idempotent.
+
+API usage -
+
+def handle(row):
+  send_email(row[1])
+
+consumer = message_consumer.MessageConsumer(conn, 'user', 'emails', handle)
+consumer.start()
+...
+consumer.close()
+"""
+
+import logging
+import Queue
+import threading
+import time
+
+from vtdb import dbexceptions
+from vtdb import vtgate_utils
+
+# DEFAULT_NUM_WORKERS is the number of threads calling the handler.
+DEFAULT_NUM_WORKERS = 8
+# DEFAULT_MAX_PENDING is the number of received messages buffered before
+# the streams stall.
+DEFAULT_MAX_PENDING = 1000
+# DEFAULT_MAX_ACK_BATCH is the most ids sent in one ack RPC.
+DEFAULT_MAX_ACK_BATCH = 500
+# DEFAULT_MAX_ACK_DELAY is the longest an ack is buffered, in seconds.
+DEFAULT_MAX_ACK_DELAY = 0.05
+# DEFAULT_MAX_PENDING_ACKS is the number of ids buffered before the
+# workers wait for the acks.
+DEFAULT_MAX_PENDING_ACKS = 5000
+# DEFAULT_NUM_ACK_THREADS is the number of threads sending ack RPCs.
+DEFAULT_NUM_ACK_THREADS = 4
+# MAX_RECONNECT_DELAY_MS is the longest wait between two attempts to
+# open the stream of a shard.
+MAX_RECONNECT_DELAY_MS = 5000
+
+# How often blocked threads check if the consumer was closed.
+_POLL_INTERVAL = 0.1
+# How long close() waits for the stream threads, in seconds.
+_CLOSE_TIMEOUT = 1.0
+
+
+class MessageConsumer(object):
+  """Streams, handles and acks messages, see the module doc."""
+
+  def __init__(self, conn, keyspace_name, name, handler,
+               shards=None, tablet_type='master',
+               num_workers=DEFAULT_NUM_WORKERS,
+               max_pending=DEFAULT_MAX_PENDING,
+               max_ack_batch=DEFAULT_MAX_ACK_BATCH,
+               max_ack_delay=DEFAULT_MAX_ACK_DELAY,
+               max_pending_acks=DEFAULT_MAX_PENDING_ACKS,
+               num_ack_threads=DEFAULT_NUM_ACK_THREADS,
+               id_column='id', keyspace_id_func=None,
+               effective_caller_id=None):
+    """Creates a MessageConsumer.
+
+    Args:
+      conn: a dialed VTGateClient. Its message_stream and message_ack
+        are called from several threads at once.
+      keyspace_name: the keyspace of the message table.
+      name: the name of the message table.
+      handler: called with each message row, from the worker threads.
+        The message is acked if it returns, and not if it raises.
+      shards: the list of shards to stream. Defaults to all the shards
+        of the keyspace for tablet_type.
+      tablet_type: the (string) tablet type used to list the shards.
+      num_workers: number of threads calling the handler.
+      max_pending: number of messages buffered before the streams stall.
+      max_ack_batch: most ids sent in one ack RPC.
+      max_ack_delay: longest an ack is buffered, in seconds.
+      max_pending_acks: number of ids buffered before the workers wait
+        for the acks.
+      num_ack_threads: number of threads sending ack RPCs, and so the
+        most ack RPCs in flight.
+      id_column: the name of the message id column.
+      keyspace_id_func: if set, returns the packed keyspace id of a
+        message row, and acks are routed to the shard of each message.
+      effective_caller_id: CallerID object.
+    """
+    self.conn = conn
+    self.keyspace_name = keyspace_name
+    self.name = name
+    self.handler = handler
+    self.shards = shards
+    self.tablet_type = tablet_type
+    self.num_workers = num_workers
+    self.max_ack_batch = max_ack_batch
+    self.max_ack_delay = max_ack_delay
+    self.max_pending_acks = max_pending_acks
+    self.num_ack_threads = num_ack_threads
+    self.id_column = id_column
+    self.keyspace_id_func = keyspace_id_func
+    self.effective_caller_id = effective_caller_id
+    self.received = 0
+    self.handled = 0
+    self.handler_errors = 0
+    self.acked = 0
+    self.ack_rpcs = 0
+    self.ack_errors = 0
+    self.reconnects = 0
+    # error is the exception that stopped the consumer, if any.
+    self.error = None
+    self._queue = Queue.Queue(max_pending)
+    self._closed = threading.Event()
+    self._stats_lock = threading.Lock()
+    self._stream_threads = []
+    self._worker_threads = []
+    self._ack_threads = []
+    # Acks waiting to be sent, as (time, id, keyspace_id) tuples.
+    # _acks_ready is notified when a batch may be ready, _acks_space when
+    # acks were taken out.
+    self._acks = []
+    self._acks_lock = threading.Lock()
+    self._acks_ready = threading.Condition(self._acks_lock)
+    self._acks_space = threading.Condition(self._acks_lock)
+
+  def start(self):
+    """Starts the streams, the workers and the ack thread."""
+    if self.shards is None:
+      self.shards = self.conn.get_srv_keyspace(
+          self.keyspace_name).get_shard_names(self.tablet_type)
+    for _ in xrange(self.num_ack_threads):
+      t = threading.Thread(target=self._ack_loop)
+      t.daemon = True
+      t.start()
+      self._ack_threads.append(t)
+    for _ in xrange(self.num_workers):
+      t = threading.Thread(target=self._work_loop)
+      t.daemon = True
+      t.start()
+      self._worker_threads.append(t)
+    for shard in self.shards:
+      t = threading.Thread(target=self._stream_shard, args=(shard,))
+      t.daemon = True
+      t.start()
+      self._stream_threads.append(t)
+
+  def close(self):
+    """Stops the streams and the workers, and sends the pending acks.
+
+    The threads waiting for a message on a quiet stream stop at the next
+    message, or when the RPC times out, they are only waited for up to
+    _CLOSE_TIMEOUT.
+    """
+    self._closed.set()
+    deadline = time.time() + _CLOSE_TIMEOUT
+    for t in self._stream_threads:
+      t.join(max(0, deadline - time.time()))
+    for t in self._worker_threads:
+      t.join()
+    with self._acks_lock:
+      self._acks_ready.notify_all()
+    for t in self._ack_threads:
+      t.join()
+    self._ack_threads = []
+
+  def stats(self):
+    """Returns a dict with the message and ack counters."""
+    with self._stats_lock:
+      return {
+          'received': self.received,
+          'handled': self.handled,
+          'handler_errors': self.handler_errors,
+          'acked': self.acked,
+          'ack_rpcs': self.ack_rpcs,
+          'ack_errors': self.ack_errors,
+          'reconnects': self.reconnects,
+          'pending': self._queue.qsize(),
+          'pending_acks': len(self._acks),
+      }
+
+  def _put(self, item):
+    while not self._closed.is_set():
+      try:
+        self._queue.put(item, timeout=_POLL_INTERVAL)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def _stream_shard(self, shard):
+    """Streams the messages of one shard, reopening it until closed."""
+    delay = vtgate_utils.INITIAL_DELAY_MS
+    while not self._closed.is_set():
+      rows = None
+      try:
+        rows, fields = self.conn.message_stream(
+            self.keyspace_name, self.name, shard=shard,
+            effective_caller_id=self.effective_caller_id)
+        id_index = _id_index(fields, self.id_column)
+        for row in rows:
+          if not self._put((row, id_index)):
+            return
+          with self._stats_lock:
+            self.received += 1
+          delay = vtgate_utils.INITIAL_DELAY_MS
+        logging.info('message stream %s of shard %s ended, reopening',
+                     self.name, shard)
+      except dbexceptions.ProgrammingError as e:
+        # Reopening the stream would not help.
+        logging.error('message stream %s of shard %s: %s, stopping',
+                      self.name, shard, e)
+        self.error = e
+        self._closed.set()
+        return
+      except Exception as e:  # pylint: disable=broad-except
+        logging.warning('message stream %s of shard %s failed: %s, '
+                        'reopening in %d ms', self.name, shard, e, delay)
+      finally:
+        if rows is not None and hasattr(rows, 'close'):
+          rows.close()
+      with self._stats_lock:
+        self.reconnects += 1
+      if self._closed.wait(delay / 1000.0):
+        return
+      delay = min(delay * vtgate_utils.BACKOFF_MULTIPLIER,
+                  MAX_RECONNECT_DELAY_MS)
+
+  def _work_loop(self):
+    while not self._closed.is_set():
+      try:
+        row, id_index = self._queue.get(timeout=_POLL_INTERVAL)
+      except Queue.Empty:
+        continue
+      try:
+        self.handler(row)
+      except Exception:  # pylint: disable=broad-except
+        logging.exception('message handler failed, message %r not acked',
+                          row[id_index])
+        with self._stats_lock:
+          self.handler_errors += 1
+        continue
+      keyspace_id = None
+      if self.keyspace_id_func:
+        keyspace_id = self.keyspace_id_func(row)
+      with self._stats_lock:
+        self.handled += 1
+      with self._acks_lock:
+        # Waits for the acks to catch up. Once closed, the ack threads
+        # still drain the acks, so this ends.
+        while len(self._acks) >= self.max_pending_acks:
+          self._acks_space.wait(_POLL_INTERVAL)
+        self._acks.append((time.time(), row[id_index], keyspace_id))
+        if len(self._acks) >= self.max_ack_batch:
+          self._acks_ready.notify()
+
+  def _next_ack_batch(self):
+    """Waits for a full or overdue batch of acks, and returns it.
+
+    Returns an empty list when the consumer is closed and no ack is
+    left.
+    """
+    with self._acks_lock:
+      while True:
+        if len(self._acks) >= self.max_ack_batch:
+          break
+        if self._acks:
+          wait = self._acks[0][0] + self.max_ack_delay - time.time()
+          if wait <= 0 or self._closed.is_set():
+            break
+        else:
+          if self._closed.is_set() and not any(
+              t.is_alive() for t in self._worker_threads):
+            return []
+          wait = _POLL_INTERVAL
+        self._acks_ready.wait(wait)
+      batch = self._acks[:self.max_ack_batch]
+      del self._acks[:self.max_ack_batch]
+      self._acks_space.notify_all()
+      if len(self._acks) >= self.max_ack_batch:
+        # Another batch is ready for another ack thread.
+        self._acks_ready.notify()
+      return batch
+
+  def _ack_loop(self):
+    while True:
+      batch = self._next_ack_batch()
+      if not batch:
+        return
+      try:
+        if self.keyspace_id_func:
+          count = self.conn.message_ack_keyspace_ids(
+              self.name, [(message_id, keyspace_id)
+                          for _, message_id, keyspace_id in batch],
+              keyspace=self.keyspace_name,
+              effective_caller_id=self.effective_caller_id)
+        else:
+          count = self.conn.message_ack(
+              self.name, [message_id for _, message_id, _ in batch],
+              keyspace=self.keyspace_name,
+              effective_caller_id=self.effective_caller_id)
+        with self._stats_lock:
+          self.ack_rpcs += 1
+          self.acked += count
+      except Exception as e:  # pylint: disable=broad-except
+        # The messages will be sent again, and acked then.
+        logging.warning('cannot ack %d messages of %s: %s', len(batch),
+                        self.name, e)
+        with self._stats_lock:
+          self.ack_rpcs += 1
+          self.ack_errors += 1
+
+
+def _id_index(fields, id_column):
+  """Returns the index of the id column in the fields of a message stream.
+
+  Args:
+    fields: the (name, type) fields of the stream.
+    id_column: the name of the message id column.
+
+  Returns:
+    The index of the id column.
+
+  Raises:
+    dbexceptions.ProgrammingError: if there is no such column.
+  """
+  for i, (field_name, _) in enumerate(fields):
+    if field_name == id_column:
+      return i
+  raise dbexceptions.ProgrammingError(
+      'message stream has no id column %r' % id_column,
+      [field_name for field_name, _ in fields])
@@ -0,0 +1,366 @@
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs a streaming query over many keyranges in parallel.
+
+The keyspace is split with vtrouting.create_parallel_task_keyrange_map,
+one StreamExecuteKeyRanges query is run per keyrange on a bounded pool
+of threads, and the rows are merged into a single generator, in no
+particular order.
+
+API usage -
+
+scanner = parallel_scanner.ParallelScanner(
+    conn, 'user', 'rdonly', num_tasks=64, shard_count=16)
+for row in scanner.scan('SELECT id, name FROM user', where_clause='id > 10'):
+  ...
+
+The streams of all the tasks share a bounded queue of row chunks, so a
+slow consumer stalls the streams instead of buffering the whole table.
+Cancelling the scan cancels the RPCs of the open streams, if their
+generators have a cancel() method, as the gRPC client ones do.
+"""
+
+import logging
+import Queue
+import threading
+import time
+
+from vtdb import dbapi
+from vtdb import dbexceptions
+from vtdb import keyrange
+from vtdb import vtgate_utils
+from vtdb import vtrouting
+
+DEFAULT_NUM_THREADS = 8
+# Number of rows sent at once from a stream thread to the consumer.
+DEFAULT_CHUNK_SIZE = 500
+# Number of chunks buffered, across all streams, before they stall.
+DEFAULT_MAX_PENDING_CHUNKS = 16
+DEFAULT_NUM_RETRIES = vtgate_utils.NUM_RETRIES
+RETRY_EXCEPTIONS = (dbexceptions.TransientError,
+                    dbexceptions.ThrottledError,
+                    dbexceptions.TimeoutError)
+
+# How often blocked threads check for cancellation, in seconds.
+_POLL_INTERVAL = 0.1
+
+# Queue item kinds.
+_ROWS = 'rows'
+_DONE = 'done'
+_ERROR = 'error'
+
+
+class TaskStats(object):
+  """Statistics for one task of a StreamMerger run."""
+
+  def __init__(self, task_id):
+    self.task_id = task_id
+    self.rows = 0
+    self.retries = 0
+    self.start_time = None
+    self.end_time = None
+
+  @property
+  def elapsed(self):
+    if self.start_time is None:
+      return 0.0
+    return (self.end_time or time.time()) - self.start_time
+
+  @property
+  def rows_per_second(self):
+    elapsed = self.elapsed
+    if not elapsed:
+      return 0.0
+    return self.rows / elapsed
+
+  def __repr__(self):
+    return 'TaskStats(%r, rows=%d, retries=%d, elapsed=%.3f)' % (
+        self.task_id, self.rows, self.retries, self.elapsed)
+
+
+class Cancelled(dbexceptions.OperationalError):
+  """Raised in the stream threads when the run is cancelled."""
+  pass
+
+
+def _cancel_stream(generator):
+  """Cancels the RPC of a stream, if its generator supports it."""
+  cancel = getattr(generator, 'cancel', None)
+  if cancel:
+    try:
+      cancel()
+    except Exception:  # pylint: disable=broad-except
+      logging.exception('cannot cancel a stream')
+
+
+class StreamMerger(object):
+  """Runs streaming tasks on a thread pool and merges their rows.
+
+  A task is a (task_id, open_stream) pair, where open_stream() returns a
+  (row generator, fields) pair, like VTGateClient._stream_execute.
+  A task that fails with one of retry_exceptions before any of its rows
+  were handed to the consumer is started again, up to num_retries times.
+  Once rows were handed out, the task cannot be retried without returning
+  duplicate rows, so the error is raised to the consumer.
+  """
+
+  def __init__(self, num_threads=DEFAULT_NUM_THREADS,
+               chunk_size=DEFAULT_CHUNK_SIZE,
+               max_pending_chunks=DEFAULT_MAX_PENDING_CHUNKS,
+               num_retries=DEFAULT_NUM_RETRIES,
+               retry_exceptions=RETRY_EXCEPTIONS):
+    self.num_threads = num_threads
+    self.chunk_size = chunk_size
+    self.max_pending_chunks = max_pending_chunks
+    self.num_retries = num_retries
+    self.retry_exceptions = retry_exceptions
+    self.fields = None
+    self.stats = {}
+    self._cancelled = threading.Event()
+    # The generators of the open streams, by task id.
+    self._streams = {}
+    self._streams_lock = threading.Lock()
+
+  def cancel(self):
+    """Stops all the streams. The consumer generator stops too.
+
+    The RPCs of the open streams are cancelled, so the stream threads
+    blocked on a read stop right away.
+    """
+    self._cancelled.set()
+    with self._streams_lock:
+      streams = self._streams.values()
+    for generator in streams:
+      _cancel_stream(generator)
+
+  def run(self, tasks, on_task_done=None):
+    """Runs the tasks, and yields their rows as they arrive.
+
+    Args:
+      tasks: list of (task_id, open_stream) pairs.
+      on_task_done: optional function called with the TaskStats of each
+        task, in the consumer thread, after all its rows were yielded.
+
+    Yields:
+      (task_id, rows) pairs, rows being a list of up to chunk_size rows.
+
+    Raises:
+      The first error of a task that could not be retried.
+    """
+    self._cancelled.clear()
+    self._streams = {}
+    self.stats = dict((task_id, TaskStats(task_id)) for task_id, _ in tasks)
+    task_queue = Queue.Queue()
+    for task in tasks:
+      task_queue.put(task)
+    out = Queue.Queue(self.max_pending_chunks)
+    threads = []
+    for _ in xrange(min(self.num_threads, len(tasks))):
+      t = threading.Thread(target=self._worker, args=(task_queue, out))
+      t.daemon = True
+      t.start()
+      threads.append(t)
+
+    remaining = len(tasks)
+    try:
+      while remaining and not self._cancelled.is_set():
+        try:
+          kind, task_id, value = out.get(timeout=_POLL_INTERVAL)
+        except Queue.Empty:
+          continue
+        if kind == _ROWS:
+          yield task_id, value
+        elif kind == _DONE:
+          remaining -= 1
+          if on_task_done:
+            on_task_done(self.stats[task_id])
+        else:
+          raise value
+    finally:
+      # On error, or if the consumer closed the generator, this cancels
+      # the streams that are still running. Their threads are not
+      # waited for, they exit on their own once their read fails.
+      self.cancel()
+    if not remaining:
+      for t in threads:
+        t.join()
+
+  def _put(self, out, item):
+    """Puts an item in the output queue, unless the run is cancelled."""
+    while True:
+      if self._cancelled.is_set():
+        raise Cancelled()
+      try:
+        out.put(item, timeout=_POLL_INTERVAL)
+        return
+      except Queue.Full:
+        pass
+
+  def _worker(self, task_queue, out):
+    while not self._cancelled.is_set():
+      try:
+        task_id, open_stream = task_queue.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        self._run_task(task_id, open_stream, out)
+        self._put(out, (_DONE, task_id, None))
+      except Cancelled:
+        return
+      except Exception as e:  # pylint: disable=broad-except
+        try:
+          self._put(out, (_ERROR, task_id, e))
+        except Cancelled:
+          pass
+        return
+
+  def _run_task(self, task_id, open_stream, out):
+    stats = self.stats[task_id]
+    stats.start_time = time.time()
+    delay = vtgate_utils.INITIAL_DELAY_MS
+    while True:
+      generator = None
+      try:
+        generator, fields = open_stream()
+        with self._streams_lock:
+          self._streams[task_id] = generator
+        # cancel() may have run before the stream was registered.
+        if self._cancelled.is_set():
+          raise Cancelled()
+        if self.fields is None:
+          self.fields = fields
+        chunk = []
+        for row in generator:
+          chunk.append(row)
+          if len(chunk) >= self.chunk_size:
+            self._put(out, (_ROWS, task_id, chunk))
+            stats.rows += len(chunk)
+            chunk = []
+        if chunk:
+          self._put(out, (_ROWS, task_id, chunk))
+          stats.rows += len(chunk)
+        stats.end_time = time.time()
+        return
+      except self.retry_exceptions as e:
+        if stats.rows or stats.retries >= self.num_retries:
+          raise
+        stats.retries += 1
+        logging.warning('task %s failed: %s, retrying in %d ms, attempt %d',
+                        task_id, e, delay, stats.retries)
+        if self._cancelled.wait(delay / 1000.0):
+          raise Cancelled()
+        delay = min(delay * vtgate_utils.BACKOFF_MULTIPLIER,
+                    vtgate_utils.MAX_DELAY_MS)
+      finally:
+        if generator is not None:
+          with self._streams_lock:
+            self._streams.pop(task_id, None)
+          generator.close()
+
+
+
+class ParallelScanner(object):
+  """Runs a streaming query in parallel over the keyranges of a keyspace."""
+
+  def __init__(self, conn, keyspace_name, tablet_type, num_tasks,
+               shard_count=None, effective_caller_id=None, **kwargs):
+    """Creates a ParallelScanner.
+
+    Args:
+      conn: a dialed VTGateClient. Its _stream_execute is called from
+        several threads at once.
+      keyspace_name: the keyspace to scan.
+      tablet_type: the (string) tablet type to scan.
+      num_tasks: number of keyranges to split the keyspace into.
+      shard_count: shard count of the keyspace, see
+        vtrouting.create_parallel_task_keyrange_map. Defaults to num_tasks.
+      effective_caller_id: CallerID object.
+      **kwargs: passed to StreamMerger (num_threads, chunk_size,
+        max_pending_chunks, num_retries, retry_exceptions).
+    """
+    self.conn = conn
+    self.keyspace_name = keyspace_name
+    self.tablet_type = tablet_type
+    self.effective_caller_id = effective_caller_id
+    self.task_map = vtrouting.create_parallel_task_keyrange_map(
+        num_tasks, shard_count or num_tasks)
+    self.merger = StreamMerger(**kwargs)
+
+  @property
+  def fields(self):
+    """The fields of the result, once the first stream is open."""
+    return self.merger.fields
+
+  @property
+  def stats(self):
+    """A map of keyrange to TaskStats."""
+    return self.merger.stats
+
+  def cancel(self):
+    self.merger.cancel()
+
+  def tasks(self, sql, bind_variables=None, where_clause=''):
+    """Returns the list of (keyrange, open_stream) tasks for a query.
+
+    Args:
+      sql: the query, without the WHERE clause.
+      bind_variables: the bind variables for sql and where_clause.
+      where_clause: optional WHERE clause, without the WHERE keyword.
+
+    Returns:
+      The list of tasks to feed to StreamMerger.run.
+    """
+    tasks = []
+    for kr in self.task_map.keyrange_list:
+      routing = vtrouting.create_vt_routing_info(kr, self.keyspace_name)
+      task_where, task_bind_vars = routing.update_where_clause(
+          where_clause, dict(bind_variables or {}))
+      task_sql = sql
+      if task_where:
+        task_sql += ' WHERE ' + task_where
+      task_sql, task_bind_vars = dbapi.prepare_query_bind_vars(
+          task_sql, task_bind_vars)
+      tasks.append((kr, self._open_stream_func(
+          task_sql, task_bind_vars, keyrange.KeyRange(kr))))
+    return tasks
+
+  def _open_stream_func(self, sql, bind_variables, key_range):
+    def open_stream():
+      return self.conn._stream_execute(  # pylint: disable=protected-access
+          sql, bind_variables,
+          tablet_type=self.tablet_type,
+          keyspace_name=self.keyspace_name,
+          keyranges=[key_range],
+          effective_caller_id=self.effective_caller_id)
+    return open_stream
+
+  def scan(self, sql, bind_variables=None, where_clause=''):
+    """Runs the query on all the keyranges, and yields the rows.
+
+    Bind variables use the python %(name)s format, in both sql and
+    where_clause. The where clause for each keyrange is added to
+    where_clause, so the query must not have its own WHERE.
+
+    Args:
+      sql: the query, without the WHERE clause.
+      bind_variables: the bind variables for sql and where_clause.
+      where_clause: optional WHERE clause, without the WHERE keyword.
+
+    Yields:
+      The rows of all the keyranges, in no particular order.
+    """
+    for _, rows in self.merger.run(
+        self.tasks(sql, bind_variables, where_clause)):
+      for row in rows:
+        yield row
@@ -18,18 +18,30 @@ and utility methods / classes to convert requests / responses for any
 python connector using the proto3 requests / responses.
 """
 
+import collections
 import datetime
+import itertools
 from decimal import Decimal
+import threading
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+from vtproto import binlogdata_pb2
 from vtproto import query_pb2
 from vtproto import topodata_pb2
 from vtproto import vtgate_pb2
 from vtproto import vtrpc_pb2
 
+from vtdb import dbexceptions
 from vtdb import field_types
+from vtdb import keyrange
 from vtdb import keyrange_constants
 from vtdb import keyspace
 from vtdb import times
+from vtdb import vtgate_client
 from vtdb import vtgate_utils
 
 # conversions is a map of type to the conversion function that needs
@@ -67,6 +79,20 @@ conversions = {
     # query_pb2.TUPLE: no conversion
 }
 
+# buffer_conversions are the conversion functions that can parse a
+# value from a buffer() over the row values, without copying it first.
+buffer_conversions = frozenset([int, long, float])
+
+# columnar_dtypes maps the types that the columnar decoding mode returns
+# as native NumPy arrays to the matching NumPy dtype. Columns of any
+# other type, or columns that contain NULL values, are returned as
+# object arrays of converted python values.
+columnar_dtypes = {
+    query_pb2.INT64: 'int64',
+    query_pb2.UINT64: 'uint64',
+    query_pb2.FLOAT64: 'float64',
+}
+
 # legacy_code_to_code_map maps legacy error codes
 # to the new code that matches grpc's canonical error codes.
 legacy_code_to_code_map = {
@@ -88,31 +114,470 @@ legacy_code_to_code_map = {
 
 INT_UPPERBOUND_PLUS_ONE = 1<<63
 
+# DEFAULT_ROW_DECODER_CACHE_SIZE is the number of distinct result shapes
+# the row decoder cache keeps.
+DEFAULT_ROW_DECODER_CACHE_SIZE = 1000
+
 
-def make_row(row, convs):
+def make_row(row, convs, views=False):
   """Builds a python native row from proto3 row, and conversion array.
 
+  In views mode, the values without conversion are returned as
+  memoryview slices of the row values, instead of copied strings, and
+  the numeric values are parsed in place, see buffer_conversions. A
+  memoryview keeps the values of its whole row alive, and is copied
+  only when its tobytes() method is called.
+
   Args:
     row: proto3 query.Row object
     convs: conversion function array
+    views: if set, returns memoryview cells, see above.
 
   Returns:
     an array of converted rows.
   """
   converted_row = []
   offset = 0
+  values = row.values
+  view = memoryview(values) if views else None
   for i, l in enumerate(row.lengths):
     if l == -1:
       converted_row.append(None)
-    elif convs[i]:
-      converted_row.append(convs[i](row.values[offset:offset+l]))
-      offset += l
+      continue
+    conv = convs[i]
+    if not conv:
+      if views:
+        converted_row.append(view[offset:offset+l])
+      else:
+        converted_row.append(values[offset:offset+l])
+    elif views and conv in buffer_conversions:
+      converted_row.append(conv(buffer(values, offset, l)))
     else:
-      converted_row.append(row.values[offset:offset+l])
-      offset += l
+      converted_row.append(conv(values[offset:offset+l]))
+    offset += l
   return converted_row
 
 
+def compile_row_decoder(convs, views=False):
+  """Compiles a row decoder function specialized for a conversion array.
+
+  The returned function is equivalent to tuple(make_row(row, convs,
+  views)), but the loop over the columns is unrolled and the conversion
+  lookup is done once here instead of once per cell.
+
+  Args:
+    convs: conversion function array.
+    views: if set, the decoder returns memoryview cells, see make_row.
+
+  Returns:
+    a function that takes a proto3 query.Row and returns a tuple.
+  """
+  if not convs:
+    return lambda row: ()
+  n = len(convs)
+  lines = [
+      'def decode_row(row):',
+      '  %s, = row.lengths' % ', '.join('l%d' % i for i in xrange(n)),
+      '  values = row.values',
+      '  o0 = 0',
+  ]
+  if views and not all(convs):
+    lines.append('  view = memoryview(values)')
+  namespace = {}
+  for i, conv in enumerate(convs):
+    lines.append('  o%d = o%d + l%d if l%d > 0 else o%d' % (
+        i + 1, i, i, i, i))
+    if not conv:
+      value = '%s[o%d:o%d]' % ('view' if views else 'values', i, i + 1)
+    elif views and conv in buffer_conversions:
+      namespace['c%d' % i] = conv
+      value = 'c%d(buffer(values, o%d, l%d))' % (i, i, i)
+    else:
+      namespace['c%d' % i] = conv
+      value = 'c%d(values[o%d:o%d])' % (i, i, i + 1)
+    lines.append('  v%d = None if l%d == -1 else %s' % (i, i, value))
+  lines.append('  return (%s,)' % ', '.join('v%d' % i for i in xrange(n)))
+  exec '\n'.join(lines) in namespace  # pylint: disable=exec-used
+  return namespace['decode_row']
+
+
+class RowDecoderCache(object):
+  """An LRU cache of compiled row decoders, keyed by result shape.
+
+  The shape of a result is the list of its (name, type) fields. Each
+  shape is compiled once by compile_row_decoder, and the decoder is then
+  reused by every query and stream chunk that returns the same shape.
+  """
+
+  def __init__(self, capacity=DEFAULT_ROW_DECODER_CACHE_SIZE):
+    self.capacity = capacity
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._decoders = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, qr_fields, views=False):
+    """Returns the fields and the row decoder for query result fields.
+
+    Args:
+      qr_fields: query result fields.
+      views: if set, the decoder returns memoryview cells, see make_row.
+
+    Returns:
+      fields: array of (name, type) tuples.
+      decoder: the compiled row decoder, see compile_row_decoder.
+    """
+    shape = tuple((field.name, field.type) for field in qr_fields)
+    key = (shape, bool(views))
+    with self._lock:
+      decoder = self._decoders.pop(key, None)
+      if decoder is not None:
+        self.hits += 1
+        self._decoders[key] = decoder
+        return list(shape), decoder
+      self.misses += 1
+    decoder = compile_row_decoder([conversions.get(t) for _, t in shape],
+                                  views=views)
+    with self._lock:
+      self._decoders[key] = decoder
+      while len(self._decoders) > self.capacity:
+        self._decoders.popitem(last=False)
+        self.evictions += 1
+    return list(shape), decoder
+
+  def clear(self):
+    with self._lock:
+      self._decoders.clear()
+
+  def stats(self):
+    """Returns a dict with the size and the hit / miss counters."""
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {
+          'size': len(self._decoders),
+          'capacity': self.capacity,
+          'hits': self.hits,
+          'misses': self.misses,
+          'evictions': self.evictions,
+          'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+      }
+
+
+# row_decoder_cache is the process-wide cache used by Proto3Connection.
+row_decoder_cache = RowDecoderCache()
+
+
+def make_columns(rows, types, convs):
+  """Builds per-column arrays from a list of proto3 rows.
+
+  This is the columnar counterpart of make_row. With NumPy, the lengths
+  and the values of all the rows are gathered in two arrays, and the
+  cell offsets are computed from them in bulk. INT64, UINT64 and FLOAT64
+  columns without NULL values are then parsed with a single NumPy call
+  per column, into native arrays. The other columns become object
+  arrays of converted python values. If NumPy is not installed, python
+  lists are returned instead.
+
+  Args:
+    rows: list of proto3 query.Row objects.
+    types: array of query_pb2 types, one per column.
+    convs: conversion function array.
+
+  Returns:
+    an array of columns, each with one value per row.
+  """
+  if not numpy:
+    raw_columns = [[] for _ in types]
+    appends = [c.append for c in raw_columns]
+    for row in rows:
+      values = row.values
+      offset = 0
+      for append, l in zip(appends, row.lengths):
+        if l == -1:
+          append(None)
+        else:
+          append(values[offset:offset+l])
+          offset += l
+    return [_convert_column(raw, conv)
+            for raw, conv in zip(raw_columns, convs)]
+
+  if not len(rows):
+    return [numpy.array([], dtype=columnar_dtypes.get(t, object))
+            for t in types]
+  lengths = numpy.fromiter(
+      itertools.chain.from_iterable([row.lengths for row in rows]),
+      dtype='int64', count=len(rows) * len(types)).reshape(
+          len(rows), len(types))
+  data = ''.join([row.values for row in rows])
+  sizes = numpy.maximum(lengths, 0).ravel()
+  starts = (numpy.cumsum(sizes) - sizes).reshape(lengths.shape)
+  columns = []
+  for i, (field_type, conv) in enumerate(zip(types, convs)):
+    column_lengths = lengths[:, i]
+    dtype = columnar_dtypes.get(field_type)
+    if dtype and column_lengths.min() > 0:
+      column = _parse_column(data, starts[:, i], column_lengths, dtype)
+      if column is not None:
+        columns.append(column)
+        continue
+    raw = [None if l < 0 else data[o:o+l]
+           for o, l in zip(starts[:, i].tolist(), column_lengths.tolist())]
+    if (conv is times.DateTimeOrNone and
+        column_lengths.min() == column_lengths.max() == _DATETIME_LENGTH):
+      column = _parse_datetime_column(raw)
+      if column is not None:
+        columns.append(column)
+        continue
+    column = numpy.empty(len(raw), dtype=object)
+    column[:] = _convert_column(raw, conv)
+    columns.append(column)
+  return columns
+
+
+def _convert_column(raw, conv):
+  if not conv:
+    return raw
+  return [None if v is None else conv(v) for v in raw]
+
+
+# _DATETIME_LENGTH is the length of a 'YYYY-MM-DD HH:MM:SS' value.
+_DATETIME_LENGTH = 19
+
+
+def _parse_datetime_column(raw):
+  """Parses 'YYYY-MM-DD HH:MM:SS' values with a single NumPy call.
+
+  Args:
+    raw: the list of the values, without NULL values.
+
+  Returns:
+    An object array of datetime values, or None if some values are not
+    valid dates, like '0000-00-00 00:00:00'. times.DateTimeOrNone
+    converts those to None.
+  """
+  try:
+    return numpy.array(raw, dtype='datetime64[s]').astype(object)
+  except ValueError:
+    return None
+
+
+def _parse_column(data, starts, lengths, dtype):
+  """Parses the numbers of one column in a single NumPy call.
+
+  The cells are copied to a buffer, separated by spaces, with NumPy
+  fancy indexing, and the buffer is parsed by numpy.fromstring.
+
+  Args:
+    data: the concatenated values of all the rows.
+    starts: the offsets of the cells of the column in data.
+    lengths: the lengths of the cells, all positive.
+    dtype: the NumPy dtype of the column.
+
+  Returns:
+    The NumPy array, or None if the values could not all be parsed.
+  """
+  # Each cell is followed by a separator in the buffer.
+  buffer_starts = numpy.cumsum(lengths + 1) - (lengths + 1)
+  num_bytes = int(lengths.sum())
+  # cell_offsets is the offset of each byte within its cell.
+  cell_offsets = numpy.arange(num_bytes) - numpy.repeat(
+      numpy.cumsum(lengths) - lengths, lengths)
+  text = numpy.empty(num_bytes + len(lengths), dtype='uint8')
+  text.fill(ord(' '))
+  text[numpy.repeat(buffer_starts, lengths) + cell_offsets] = (
+      numpy.frombuffer(data, dtype='uint8')[
+          numpy.repeat(starts, lengths) + cell_offsets])
+  column = numpy.fromstring(text.tostring(), dtype=dtype, sep=' ')
+  if len(column) != len(lengths):
+    return None
+  return column
+
+
+class RowChange(object):
+  """One decoded row change of a VStream.
+
+  Attributes:
+    table_name: the table of the row.
+    fields: array of (name, type) tuples of the table.
+    before: the row before the change as a tuple, None for inserts.
+    after: the row after the change as a tuple, None for deletes.
+    vgtid: the binlogdata_pb2.VGtid of the last transaction committed
+      before this change. Restarting the stream from it replays this
+      change.
+  """
+
+  __slots__ = ('table_name', 'fields', 'before', 'after', 'vgtid')
+
+  def __init__(self, table_name, fields, before, after, vgtid):
+    self.table_name = table_name
+    self.fields = fields
+    self.before = before
+    self.after = after
+    self.vgtid = vgtid
+
+  @property
+  def op(self):
+    """Returns 'insert', 'update' or 'delete'."""
+    if self.before is None:
+      return 'insert'
+    if self.after is None:
+      return 'delete'
+    return 'update'
+
+  def __repr__(self):
+    return 'RowChange(%r, %s, before=%r, after=%r)' % (
+        self.table_name, self.op, self.before, self.after)
+
+
+class TableChanges(object):
+  """The row changes of one table in a transaction, per column.
+
+  Attributes:
+    table_name: the table of the rows.
+    fields: array of (name, type) tuples of the table.
+    before: array of columns of the rows before the changes, see
+      make_columns. Inserts have NULL values.
+    after: array of columns of the rows after the changes. Deletes
+      have NULL values.
+    ops: the list of 'insert', 'update' or 'delete', one per change.
+  """
+
+  def __init__(self, table_name, fields, before, after, ops):
+    self.table_name = table_name
+    self.fields = fields
+    self.before = before
+    self.after = after
+    self.ops = ops
+
+  def __len__(self):
+    return len(self.ops)
+
+
+class Transaction(object):
+  """The row changes of one VStream transaction, grouped per table.
+
+  Attributes:
+    tables: list of TableChanges, in the order the tables first changed.
+    vgtid: the binlogdata_pb2.VGtid right after this transaction.
+      Restarting the stream from it skips this transaction.
+    timestamp: the commit time of the transaction, in seconds since
+      Epoch.
+  """
+
+  def __init__(self, tables, vgtid, timestamp):
+    self.tables = tables
+    self.vgtid = vgtid
+    self.timestamp = timestamp
+
+  def __len__(self):
+    return sum(len(t) for t in self.tables)
+
+
+class _TableDecoder(object):
+  """The cached conversions of one table of a VStream."""
+
+  def __init__(self, qr_fields):
+    self.fields, self.decoder = row_decoder_cache.get(qr_fields)
+    self.types = [t for _, t in self.fields]
+    self.convs = [conversions.get(t) for t in self.types]
+    # Stands for the missing image of inserts and deletes in batches.
+    self.null_row = query_pb2.Row(lengths=[-1] * len(self.fields))
+
+
+class VStreamDecoder(object):
+  """Decodes the VEvents of a VStream into row changes.
+
+  The FIELD event of a table comes before its first ROW event, and after
+  each DDL on it. The conversions of the table are built then, and used
+  for all its rows.
+  """
+
+  def __init__(self, vgtid=None):
+    self.vgtid = vgtid
+    self._tables = {}
+
+  def _table(self, table_name):
+    try:
+      return self._tables[table_name]
+    except KeyError:
+      raise dbexceptions.ProgrammingError(
+          'VStream row event for table %s without field event' % table_name)
+
+  def _decode(self, event):
+    """Handles a VEvent, yields the (table decoder, RowChange) it holds."""
+    event_type = event.type
+    if event_type == binlogdata_pb2.ROW:
+      table_name = event.row_event.table_name
+      table = self._table(table_name)
+      decoder = table.decoder
+      for change in event.row_event.row_changes:
+        before = decoder(change.before) if change.HasField('before') else None
+        after = decoder(change.after) if change.HasField('after') else None
+        yield table, change, RowChange(
+            table_name, table.fields, before, after, self.vgtid)
+    elif event_type == binlogdata_pb2.FIELD:
+      self._tables[event.field_event.table_name] = _TableDecoder(
+          event.field_event.fields)
+    elif event_type == binlogdata_pb2.VGTID:
+      self.vgtid = event.vgtid
+
+  def rows(self, responses):
+    """Yields the RowChange objects of a stream of VStreamResponse."""
+    for response in responses:
+      for event in response.events:
+        for _, _, row_change in self._decode(event):
+          yield row_change
+
+  def transactions(self, responses):
+    """Yields the Transaction objects of a stream of VStreamResponse.
+
+    The row changes of a transaction are only decoded at its COMMIT,
+    one column at a time, see make_columns.
+    """
+    # Map of table name to (table decoder, [before], [after], [ops]),
+    # and the table names in order.
+    pending = {}
+    order = []
+    for response in responses:
+      for event in response.events:
+        event_type = event.type
+        if event_type == binlogdata_pb2.ROW:
+          table_name = event.row_event.table_name
+          entry = pending.get(table_name)
+          if entry is None:
+            entry = (self._table(table_name), [], [], [])
+            pending[table_name] = entry
+            order.append(table_name)
+          table, befores, afters, ops = entry
+          for change in event.row_event.row_changes:
+            has_before = change.HasField('before')
+            has_after = change.HasField('after')
+            befores.append(change.before if has_before else table.null_row)
+            afters.append(change.after if has_after else table.null_row)
+            if not has_before:
+              ops.append('insert')
+            elif not has_after:
+              ops.append('delete')
+            else:
+              ops.append('update')
+        elif event_type == binlogdata_pb2.COMMIT:
+          if order:
+            tables = []
+            for table_name in order:
+              table, befores, afters, ops = pending[table_name]
+              tables.append(TableChanges(
+                  table_name, table.fields,
+                  make_columns(befores, table.types, table.convs),
+                  make_columns(afters, table.types, table.convs), ops))
+            yield Transaction(tables, self.vgtid, event.timestamp)
+            pending = {}
+            order = []
+        else:
+          for _ in self._decode(event):
+            pass
+
+
 def build_value(v):
   """Build a proto value from any valid input."""
   val = query_pb2.Value()
@@ -120,6 +585,108 @@ def build_value(v):
   return val
 
 
+def _encode_bool(value):
+  return query_pb2.INT64, str(int(value))
+
+
+def _encode_int(value):
+  return query_pb2.INT64, str(value)
+
+
+def _encode_long(value):
+  if value < INT_UPPERBOUND_PLUS_ONE:
+    return query_pb2.INT64, str(value)
+  return query_pb2.UINT64, str(value)
+
+
+def _encode_float(value):
+  return query_pb2.FLOAT64, str(value)
+
+
+def _encode_sql_literal(value):
+  return query_pb2.VARBINARY, str(value.__sql_literal__())
+
+
+def _encode_datetime(value):
+  return query_pb2.VARBINARY, times.DateTimeToString(value)
+
+
+def _encode_date(value):
+  return query_pb2.VARBINARY, times.DateToString(value)
+
+
+def _encode_str(value):
+  return query_pb2.VARBINARY, value
+
+
+def _encode_none(unused_value):
+  return query_pb2.NULL_TYPE, None
+
+
+def _encode_default(value):
+  # __sql_literal__ can also be set on the object itself.
+  if hasattr(value, '__sql_literal__'):
+    return _encode_sql_literal(value)
+  return query_pb2.VARBINARY, str(value)
+
+
+# value_encoders maps a python type to the function encoding its values,
+# which returns a (query_pb2 type, string value) pair. The string value
+# is None for NULL_TYPE. Subclasses use the encoder of their closest
+# registered base class, except that classes with a __sql_literal__
+# method use it, unless they are numbers. Use register_encoder to add
+# encoders for custom types.
+value_encoders = {
+    bool: _encode_bool,
+    int: _encode_int,
+    long: _encode_long,
+    float: _encode_float,
+    datetime.datetime: _encode_datetime,
+    datetime.date: _encode_date,
+    str: _encode_str,
+    field_types.NoneType: _encode_none,
+}
+
+# _resolved_encoders caches the encoder found for each type seen.
+_resolved_encoders = dict(value_encoders)
+
+_list_types = (list, set, tuple)
+
+
+def register_encoder(python_type, encoder):
+  """Registers the encoder for a python type and its subclasses.
+
+  Args:
+    python_type: the python type.
+    encoder: function taking a value, returning a (query_pb2 type, string
+      value) pair.
+  """
+  value_encoders[python_type] = encoder
+  _resolved_encoders.clear()
+  _resolved_encoders.update(value_encoders)
+
+
+def _find_encoder(python_type):
+  """Returns the encoder for a python type, see value_encoders."""
+  encoder = _resolved_encoders.get(python_type)
+  if encoder is not None:
+    return encoder
+  if (hasattr(python_type, '__sql_literal__') and
+      not issubclass(python_type, (int, long, float))):
+    encoder = _encode_sql_literal
+  else:
+    encoder = _encode_default
+    for base in python_type.__mro__:
+      if base in value_encoders:
+        encoder = value_encoders[base]
+        break
+  # Lists are TUPLE bind variables when lists are allowed, so their
+  # encoder cannot be cached.
+  if not issubclass(python_type, _list_types):
+    _resolved_encoders[python_type] = encoder
+  return encoder
+
+
 def convert_value(value, proto_value, allow_lists=False):
   """Convert a variable from python type to proto type+value.
 
@@ -128,44 +695,102 @@ def convert_value(value, proto_value, allow_lists=False):
     proto_value: the proto3 object, needs a type and value field.
     allow_lists: allows the use of python lists.
   """
-  if isinstance(value, bool):
-    proto_value.type = query_pb2.INT64
-    proto_value.value = str(int(value))
-  elif isinstance(value, int):
-    proto_value.type = query_pb2.INT64
-    proto_value.value = str(value)
-  elif isinstance(value, long):
-    if value < INT_UPPERBOUND_PLUS_ONE:
-      proto_value.type = query_pb2.INT64
+  encoder = _resolved_encoders.get(type(value))
+  if encoder is None:
+    if (allow_lists and isinstance(value, _list_types) and
+        not hasattr(value, '__sql_literal__')):
+      # this only works for bind variables, not for entities.
+      proto_value.type = query_pb2.TUPLE
+      _convert_tuple_values(list(value), proto_value)
+      return
+    encoder = _find_encoder(type(value))
+  proto_value.type, encoded = encoder(value)
+  if encoded is not None:
+    proto_value.value = encoded
+
+
+# _fast_tuple_encoders maps the encoders whose lists are encoded in a
+# single pass to their query_pb2 type. _encode_long is used only when
+# all the values fit in an INT64.
+_fast_tuple_encoders = {
+    _encode_int: query_pb2.INT64,
+    _encode_long: query_pb2.INT64,
+    _encode_float: query_pb2.FLOAT64,
+    _encode_str: query_pb2.VARBINARY,
+}
+
+# _value_headers caches the serialized header of a query.Value in a
+# repeated field, keyed by (type, value length).
+_value_headers = {}
+
+
+def _varint(n):
+  """Returns the protobuf varint encoding of a non-negative integer."""
+  out = []
+  while n > 0x7f:
+    out.append(chr((n & 0x7f) | 0x80))
+    n >>= 7
+  out.append(chr(n))
+  return ''.join(out)
+
+
+def _value_header(value_type, length):
+  """Returns the bytes preceding a value in BindVariable.values."""
+  header = _value_headers.get((value_type, length))
+  if header is None:
+    # Value.type is field 1 (varint), Value.value is field 2 (bytes),
+    # BindVariable.values is field 3 (message).
+    value = '\x08' + _varint(value_type) + '\x12' + _varint(length)
+    header = '\x1a' + _varint(len(value) + length) + value
+    if len(_value_headers) < 10000:
+      _value_headers[(value_type, length)] = header
+  return header
+
+
+def _convert_tuple_values(values, proto_value):
+  """Adds the values of a TUPLE bind variable to proto_value.values.
+
+  Lists of a single type are encoded in one pass: the values are
+  converted to strings together, serialized straight to the protobuf
+  wire format, and merged into proto_value at once. This is much faster
+  than adding the values one by one for long IN (...) lists.
+
+  Args:
+    values: list of python values.
+    proto_value: the proto3 BindVariable to add the values to.
+  """
+  if not values:
+    return
+  value_types = set(map(type, values))
+  if len(value_types) != 1:
+    for v in values:
+      convert_value(v, proto_value.values.add())
+    return
+  encoder = _find_encoder(value_types.pop())
+  value_type = _fast_tuple_encoders.get(encoder)
+  if encoder is _encode_long and max(values) >= INT_UPPERBOUND_PLUS_ONE:
+    value_type = None
+  if value_type is not None:
+    if encoder is _encode_str:
+      strs = values
     else:
-      proto_value.type = query_pb2.UINT64
-    proto_value.value = str(value)
-  elif isinstance(value, float):
-    proto_value.type = query_pb2.FLOAT64
-    proto_value.value = str(value)
-  elif hasattr(value, '__sql_literal__'):
-    proto_value.type = query_pb2.VARBINARY
-    proto_value.value = str(value.__sql_literal__())
-  elif isinstance(value, datetime.datetime):
-    proto_value.type = query_pb2.VARBINARY
-    proto_value.value = times.DateTimeToString(value)
-  elif isinstance(value, datetime.date):
-    proto_value.type = query_pb2.VARBINARY
-    proto_value.value = times.DateToString(value)
-  elif isinstance(value, str):
-    proto_value.type = query_pb2.VARBINARY
-    proto_value.value = value
-  elif isinstance(value, field_types.NoneType):
-    proto_value.type = query_pb2.NULL_TYPE
-  elif allow_lists and isinstance(value, (set, tuple, list)):
-    # this only works for bind variables, not for entities.
-    proto_value.type = query_pb2.TUPLE
-    for v in list(value):
-      proto_v = proto_value.values.add()
-      convert_value(v, proto_v)
+      strs = map(str, values)
+    lengths = map(len, strs)
+    by_length = dict((n, _value_header(value_type, n)) for n in set(lengths))
+    headers = map(by_length.__getitem__, lengths)
   else:
-    proto_value.type = query_pb2.VARBINARY
-    proto_value.value = str(value)
+    encoded = map(encoder, values)
+    if any(e is None for _, e in encoded):
+      # NULL values have no value field, add them one by one.
+      for v in values:
+        convert_value(v, proto_value.values.add())
+      return
+    headers = [_value_header(t, len(e)) for t, e in encoded]
+    strs = [e for _, e in encoded]
+  parts = [None] * (2 * len(strs))
+  parts[0::2] = headers
+  parts[1::2] = strs
+  proto_value.MergeFromString(''.join(parts))
 
 
 def convert_bind_vars(bind_variables, request_bind_variables):
@@ -181,6 +806,122 @@ def convert_bind_vars(bind_variables, request_bind_variables):
     convert_value(val, request_bind_variables[key], allow_lists=True)
 
 
+# Cache of message class to the key of its session field, the field
+# number and the wire type 2 (length-delimited) of messages.
+_session_keys = {}
+
+
+def _session_key(message_class):
+  """Returns the wire key of the session field of a message class.
+
+  Returns None if the message class has no session field.
+  """
+  try:
+    return _session_keys[message_class]
+  except KeyError:
+    pass
+  field = message_class.DESCRIPTOR.fields_by_name.get('session')
+  key = field.number << 3 | 2 if field else None
+  _session_keys[message_class] = key
+  return key
+
+
+def has_session_field(message_class):
+  """Returns True if a vtgate_pb2 message class has a session field."""
+  return _session_key(message_class) is not None
+
+
+def _read_varint(data, pos):
+  """Decodes the varint at data[pos:], returns (value, next position)."""
+  result = 0
+  shift = 0
+  while True:
+    b = ord(data[pos])
+    pos += 1
+    result |= (b & 0x7f) << shift
+    if b < 0x80:
+      return result, pos
+    shift += 7
+
+
+def session_field(request_class, session_bytes):
+  """Returns the wire format of a session field of a request.
+
+  Appending it to a serialized request is the same as setting its
+  session field, without copying the session message.
+
+  Args:
+    request_class: the vtgate_pb2 request class.
+    session_bytes: the serialized vtgate_pb2.Session.
+
+  Returns:
+    The encoded session field.
+  """
+  return (_varint(_session_key(request_class)) +
+          _varint(len(session_bytes)) + session_bytes)
+
+
+def extract_session_bytes(response_class, data):
+  """Returns the serialized session of a serialized response.
+
+  Only the top-level fields of the response are scanned, the other
+  fields are skipped without being decoded.
+
+  Args:
+    response_class: the vtgate_pb2 response class.
+    data: the serialized response.
+
+  Returns:
+    The serialized vtgate_pb2.Session, or None if the response has no
+    session, or has it in several parts.
+  """
+  session_key = _session_key(response_class)
+  session_bytes = None
+  pos = 0
+  end = len(data)
+  while pos < end:
+    key, pos = _read_varint(data, pos)
+    wire_type = key & 7
+    if wire_type == 0:
+      _, pos = _read_varint(data, pos)
+    elif wire_type == 1:
+      pos += 8
+    elif wire_type == 5:
+      pos += 4
+    elif wire_type == 2:
+      length, pos = _read_varint(data, pos)
+      if key == session_key:
+        if session_bytes is not None:
+          return None
+        session_bytes = data[pos:pos + length]
+      pos += length
+    else:
+      return None
+  return session_bytes
+
+
+def convert_bind_variable(bind_variable):
+  """Converts a proto3 query.BindVariable or query.Value to a python value.
+
+  This is the reverse of convert_value, used for the bind variables
+  vtgate sends back, for instance in SplitQuery responses.
+
+  Args:
+    bind_variable: the proto3 object, with a type and value field.
+
+  Returns:
+    The python value.
+  """
+  if bind_variable.type == query_pb2.TUPLE:
+    return [convert_bind_variable(v) for v in bind_variable.values]
+  if bind_variable.type == query_pb2.NULL_TYPE:
+    return None
+  conv = conversions.get(bind_variable.type)
+  if conv:
+    return conv(bind_variable.value)
+  return bind_variable.value
+
+
 def convert_stream_event_statement(statement):
   """Converts encoded rows inside a StreamEvent.Statement to native types.
 
@@ -216,6 +957,12 @@ class Proto3Connection(object):
     self._effective_caller_id = None
     self.event_token = None
     self.fresher = None
+    # If set, _add_session leaves the session out of the requests, and
+    # the implementation appends it already serialized, see
+    # session_field. Used by transaction_manager.
+    self.reuse_session = False
+    # The (session, serialized session) pair of the last response.
+    self._raw_session = None
 
   def _add_caller_id(self, request, caller_id):
     """Adds the vtgate_client.CallerID to the proto3 request, if any.
@@ -238,9 +985,23 @@ class Proto3Connection(object):
     Args:
       request: the proto3 request to add session to.
     """
-    if self.session:
+    if self.session and not self.reuse_session:
       request.session.CopyFrom(self.session)
 
+  def _session_bytes(self):
+    """Returns self.session serialized, None if there is no session.
+
+    The session of the last response is kept in its serialized form,
+    so it is only serialized here if it was set from somewhere else.
+    """
+    if not self.session:
+      return None
+    if self._raw_session and self._raw_session[0] is self.session:
+      return self._raw_session[1]
+    session_bytes = self.session.SerializeToString()
+    self._raw_session = (self.session, session_bytes)
+    return session_bytes
+
   def update_session(self, response):
     """Updates the current session from the response, if it has one.
 
@@ -258,9 +1019,10 @@ class Proto3Connection(object):
       request_eki: destination proto3 list.
     """
     for xid, kid in entity_keyspace_ids.iteritems():
-      eid = request_eki.add()
-      eid.keyspace_id = kid
-      convert_value(xid, eid, allow_lists=False)
+      entity_type, encoded = _find_encoder(type(xid))(xid)
+      eid = request_eki.add(type=entity_type, keyspace_id=kid)
+      if encoded is not None:
+        eid.value = encoded
 
   def _add_key_ranges(self, request, key_ranges):
     """Adds the provided keyrange.KeyRange objects to the proto3 request.
@@ -309,11 +1071,25 @@ class Proto3Connection(object):
       convs.append(conversions.get(field.type))
     return fields, convs
 
-  def _get_rowset_from_query_result(self, query_result):
+  def build_row_decoder(self, qr_fields, views=False):
+    """Returns an array of fields and a cached row decoder for result fields.
+
+    Args:
+      qr_fields: query result fields
+      views: if set, the decoder returns memoryview cells, see make_row.
+
+    Returns:
+      fields: array of fields
+      decoder: function that converts a proto3 row to a tuple.
+    """
+    return row_decoder_cache.get(qr_fields, views=views)
+
+  def _get_rowset_from_query_result(self, query_result, views=False):
     """Builds a python rowset from proto3 response.
 
     Args:
       query_result: proto3 query.QueryResult object.
+      views: if set, rows hold memoryview cells, see make_row.
 
     Returns:
       Array of rows
@@ -323,14 +1099,33 @@ class Proto3Connection(object):
     """
     if not query_result:
       return [], 0, 0, []
-    fields, convs = self.build_conversions(query_result.fields)
-    results = []
-    for row in query_result.rows:
-      results.append(tuple(make_row(row, convs)))
+    fields, decoder = self.build_row_decoder(query_result.fields, views=views)
+    results = [decoder(row) for row in query_result.rows]
     rowcount = query_result.rows_affected
     lastrowid = query_result.insert_id
     return results, rowcount, lastrowid, fields
 
+  def _get_columns_from_query_result(self, query_result):
+    """Builds a columnar python rowset from proto3 response.
+
+    Args:
+      query_result: proto3 query.QueryResult object.
+
+    Returns:
+      Array of columns, see make_columns
+      Number of modified rows
+      Last insert ID
+      Fields array of (name, type) tuples.
+    """
+    if not query_result:
+      return [], 0, 0, []
+    fields, convs = self.build_conversions(query_result.fields)
+    columns = make_columns(
+        query_result.rows, [t for _, t in fields], convs)
+    rowcount = query_result.rows_affected
+    lastrowid = query_result.insert_id
+    return columns, rowcount, lastrowid, fields
+
   def begin_request(self, effective_caller_id, single_db):
     """Builds a vtgate_pb2.BeginRequest object.
 
@@ -464,14 +1259,17 @@ class Proto3Connection(object):
     self.fresher = None
     return request, routing_kwargs, method_name
 
-  def process_execute_response(self, exec_method, response):
+  def process_execute_response(self, exec_method, response, columnar=False,
+                               views=False):
     """Processes an Execute* response, and returns the rowset.
 
     Args:
       exec_method: name of the method called.
       response: proto3 response returned.
+      columnar: if set, results are decoded per column, see make_columns.
+      views: if set, rows hold memoryview cells, see make_row.
     Returns:
-      results: list of rows.
+      results: list of rows, or list of columns if columnar is set.
       rowcount: how many rows were affected.
       lastrowid: auto-increment value for the last row inserted.
       fields: describes the field names and types.
@@ -481,7 +1279,9 @@ class Proto3Connection(object):
     if response.result.extras:
       self.event_token = response.result.extras.event_token
       self.fresher = response.result.extras.fresher
-    return self._get_rowset_from_query_result(response.result)
+    if columnar:
+      return self._get_columns_from_query_result(response.result)
+    return self._get_rowset_from_query_result(response.result, views=views)
 
   def execute_batch_request_and_name(self, sql_list, bind_variables_list,
                                      keyspace_list,
@@ -640,6 +1440,60 @@ class Proto3Connection(object):
     self._add_caller_id(request, effective_caller_id)
     return request
 
+  def message_ack_keyspace_ids_request(self,
+                                       keyspace_name,
+                                       name,
+                                       id_keyspace_ids,
+                                       effective_caller_id):
+    """Builds the right vtgate_pb2 MessageAckKeyspaceIdsRequest.
+
+    Args:
+      keyspace_name: keyspace to apply the query to.
+      name: message table name.
+      id_keyspace_ids: list of (message id, packed keyspace id) pairs.
+      effective_caller_id: optional vtgate_client.CallerID.
+
+    Returns:
+      A vtgate_pb2.MessageAckKeyspaceIdsRequest object.
+    """
+    request = vtgate_pb2.MessageAckKeyspaceIdsRequest(keyspace=keyspace_name,
+                                                      name=name)
+    for message_id, keyspace_id in id_keyspace_ids:
+      id_keyspace_id = request.id_keyspace_ids.add(keyspace_id=keyspace_id)
+      convert_value(message_id, id_keyspace_id.id)
+    self._add_caller_id(request, effective_caller_id)
+    return request
+
+  def vstream_request(self,
+                      tablet_type,
+                      vgtid,
+                      filter_rules,
+                      effective_caller_id):
+    """Builds the right vtgate_pb2 VStreamRequest.
+
+    Args:
+      tablet_type: string tablet type.
+      vgtid: binlogdata_pb2.VGtid, or list of (keyspace, shard, gtid)
+        tuples, where to start the stream from.
+      filter_rules: optional list of (match, filter) pairs.
+      effective_caller_id: optional vtgate_client.CallerID.
+
+    Returns:
+      A vtgate_pb2.VStreamRequest object.
+    """
+    request = vtgate_pb2.VStreamRequest()
+    request.tablet_type = topodata_pb2.TabletType.Value(tablet_type.upper())
+    if isinstance(vgtid, binlogdata_pb2.VGtid):
+      request.vgtid.CopyFrom(vgtid)
+    else:
+      for keyspace_name, shard, gtid in vgtid:
+        request.vgtid.shard_gtids.add(keyspace=keyspace_name, shard=shard,
+                                      gtid=gtid)
+    for match, filter_sql in filter_rules or []:
+      request.filter.rules.add(match=match, filter=filter_sql)
+    self._add_caller_id(request, effective_caller_id)
+    return request
+
   def stream_execute_request_and_name(self, sql, bind_variables, tablet_type,
                                       keyspace_name,
                                       shards,
@@ -696,6 +1550,66 @@ class Proto3Connection(object):
     self._add_caller_id(request, effective_caller_id)
     return request, routing_kwargs, method_name
 
+  def split_query_request(self, sql, keyspace_name, bind_variables,
+                          split_columns, split_count, num_rows_per_query_part,
+                          algorithm, effective_caller_id):
+    """Builds the right vtgate_pb2 SplitQueryRequest.
+
+    Args:
+      sql: the query to split.
+      keyspace_name: keyspace of the table.
+      bind_variables: python map of bind variables.
+      split_columns: optional list of columns to split on.
+      split_count: approximate number of parts to return.
+      num_rows_per_query_part: approximate number of rows per part.
+      algorithm: optional query_pb2.SplitQueryRequest algorithm.
+      effective_caller_id: optional vtgate_client.CallerID.
+
+    Returns:
+      A vtgate_pb2.SplitQueryRequest object.
+    """
+    request = vtgate_pb2.SplitQueryRequest(
+        keyspace=keyspace_name,
+        split_count=split_count,
+        num_rows_per_query_part=num_rows_per_query_part)
+    request.query.sql = sql
+    convert_bind_vars(bind_variables, request.query.bind_variables)
+    if split_columns:
+      request.split_column.extend(split_columns)
+    if algorithm is not None:
+      request.algorithm = algorithm
+    self._add_caller_id(request, effective_caller_id)
+    return request
+
+  def query_splits_from_response(self, response):
+    """Builds the list of query splits from a SplitQuery response.
+
+    Args:
+      response: a vtgate_pb2.SplitQueryResponse object.
+
+    Returns:
+      A list of vtgate_client.QuerySplit objects.
+    """
+    splits = []
+    for part in response.splits:
+      bind_variables = dict(
+          (name, convert_bind_variable(bv))
+          for name, bv in part.query.bind_variables.iteritems())
+      if part.HasField('key_range_part'):
+        splits.append(vtgate_client.QuerySplit(
+            part.query.sql, bind_variables, part.key_range_part.keyspace,
+            keyranges=[
+                keyrange.KeyRange((kr.start.encode('hex'),
+                                   kr.end.encode('hex')))
+                for kr in part.key_range_part.key_ranges],
+            size=part.size))
+      else:
+        splits.append(vtgate_client.QuerySplit(
+            part.query.sql, bind_variables, part.shard_part.keyspace,
+            shards=list(part.shard_part.shards),
+            size=part.size))
+    return splits
+
   def srv_keyspace_proto3_to_old(self, sk):
     """Converts a proto3 SrvKeyspace.
 
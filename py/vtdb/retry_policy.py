@@ -0,0 +1,315 @@
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Retry policies for the VTGateClient methods.
+
+The retry decorator replaces vtgate_utils.exponential_backoff_retry for
+the gRPC client. When a decorated method raises one of its retryable
+exceptions, the RetryPolicy of the connection decides whether and when
+to try again:
+
+- The delays use decorrelated jitter: each delay is drawn at random
+  between the initial delay and three times the previous one, so
+  clients throttled at the same time do not retry in lockstep.
+- ThrottledError waits at least throttled_delay_ms.
+- Each connection has a RetryBudget, a token bucket: a retry takes a
+  token, and tokens come back over time and with each successful call.
+  When the budget is empty the error is raised at once, so a server in
+  trouble does not receive more retries than regular traffic.
+- The whole call, retries included, has a deadline: the caller's
+  'deadline' keyword argument (in seconds since Epoch), or the
+  connection timeout. A retry that would start after the deadline is
+  not made, and rpc_timeout() caps the timeout of each RPC to the time
+  left.
+- As before, a call in a transaction is never retried.
+
+A connection uses DEFAULT_POLICY, unless its retry_policy attribute is
+set. All retries are counted in the module-level retry_stats.
+"""
+
+import logging
+import random
+import threading
+import time
+
+from vtdb import dbexceptions
+from vtdb import vtgate_utils
+
+# DEFAULT_THROTTLED_DELAY_MS is the shortest wait after a ThrottledError.
+DEFAULT_THROTTLED_DELAY_MS = 50
+# Retry budget parameters: a connection can make RETRY_BUDGET_TOKENS
+# retries in a burst. It gets a token back every 1 / tokens_per_second
+# seconds, and RETRY_BUDGET_SUCCESS_CREDIT tokens per successful call.
+RETRY_BUDGET_TOKENS = 10.0
+RETRY_BUDGET_TOKENS_PER_SECOND = 1.0
+RETRY_BUDGET_SUCCESS_CREDIT = 0.1
+
+# Holds the deadline and the attempt number of the retried call running
+# in the current thread.
+_local = threading.local()
+
+
+def rpc_timeout(timeout):
+  """Returns the timeout for an RPC, capped by the current call deadline.
+
+  Args:
+    timeout: the timeout of the connection, in seconds.
+
+  Returns:
+    The timeout to use, in seconds.
+  """
+  deadline = getattr(_local, 'deadline', None)
+  if deadline is None:
+    return timeout
+  remaining = max(0.0, deadline - time.time())
+  if timeout is None:
+    return remaining
+  return min(timeout, remaining)
+
+
+def current_attempt():
+  """Returns the number of retries made so far by the current call."""
+  return getattr(_local, 'attempt', 0)
+
+
+class RetryBudget(object):
+  """A token bucket limiting the retries of a connection."""
+
+  def __init__(self, max_tokens=RETRY_BUDGET_TOKENS,
+               tokens_per_second=RETRY_BUDGET_TOKENS_PER_SECOND,
+               success_credit=RETRY_BUDGET_SUCCESS_CREDIT):
+    self.max_tokens = max_tokens
+    self.tokens_per_second = tokens_per_second
+    self.success_credit = success_credit
+    self._tokens = max_tokens
+    self._last_refill = time.time()
+    self._lock = threading.Lock()
+
+  def _refill(self, now):
+    self._tokens = min(
+        self.max_tokens,
+        self._tokens + (now - self._last_refill) * self.tokens_per_second)
+    self._last_refill = now
+
+  def try_acquire(self):
+    """Takes a token for a retry, returns False if there is none left."""
+    with self._lock:
+      self._refill(time.time())
+      if self._tokens < 1:
+        return False
+      self._tokens -= 1
+      return True
+
+  def record_success(self):
+    with self._lock:
+      self._tokens = min(self.max_tokens, self._tokens + self.success_credit)
+
+  def tokens(self):
+    with self._lock:
+      self._refill(time.time())
+      return self._tokens
+
+
+class RetryPolicy(object):
+  """Decides when to retry, with decorrelated jitter, see the module doc.
+
+  Subclasses can override next_delay_ms, or new_budget.
+  """
+
+  def __init__(self, num_retries=vtgate_utils.NUM_RETRIES,
+               initial_delay_ms=vtgate_utils.INITIAL_DELAY_MS,
+               max_delay_ms=vtgate_utils.MAX_DELAY_MS,
+               throttled_delay_ms=DEFAULT_THROTTLED_DELAY_MS,
+               rand=None):
+    """Creates a RetryPolicy.
+
+    Args:
+      num_retries: max number of retries of a call.
+      initial_delay_ms: the shortest delay before a retry.
+      max_delay_ms: the longest delay before a retry.
+      throttled_delay_ms: the shortest delay after a ThrottledError.
+      rand: the random.Random to draw the delays from.
+    """
+    self.num_retries = num_retries
+    self.initial_delay_ms = initial_delay_ms
+    self.max_delay_ms = max_delay_ms
+    self.throttled_delay_ms = throttled_delay_ms
+    self.rand = rand or random.Random()
+
+  def next_delay_ms(self, previous_delay_ms, exc):
+    """Returns the delay before the next retry.
+
+    Args:
+      previous_delay_ms: the previous delay, 0 before the first retry.
+      exc: the exception raised by the last attempt.
+
+    Returns:
+      The delay in ms.
+    """
+    upper = max(self.initial_delay_ms, previous_delay_ms * 3)
+    delay = min(self.max_delay_ms,
+                self.rand.uniform(self.initial_delay_ms, upper))
+    if isinstance(exc, dbexceptions.ThrottledError):
+      delay = max(delay, self.throttled_delay_ms)
+    return delay
+
+  def new_budget(self):
+    """Returns the RetryBudget of a new connection, or None for no limit."""
+    return RetryBudget()
+
+
+class ExponentialBackoffPolicy(RetryPolicy):
+  """The delays of vtgate_utils.exponential_backoff_retry, without jitter."""
+
+  def __init__(self, backoff_multiplier=vtgate_utils.BACKOFF_MULTIPLIER,
+               **kwargs):
+    super(ExponentialBackoffPolicy, self).__init__(**kwargs)
+    self.backoff_multiplier = backoff_multiplier
+
+  def next_delay_ms(self, previous_delay_ms, exc):
+    if not previous_delay_ms:
+      return self.initial_delay_ms
+    return min(self.max_delay_ms, previous_delay_ms * self.backoff_multiplier)
+
+  def new_budget(self):
+    return None
+
+
+# DEFAULT_POLICY is used by the connections without a retry_policy.
+DEFAULT_POLICY = RetryPolicy()
+
+
+class RetryStats(object):
+  """Process-wide retry counters, per method name."""
+
+  COUNTERS = ('retries', 'recovered', 'exhausted', 'budget_exhausted',
+              'deadline_exceeded', 'delay_ms')
+
+  def __init__(self):
+    self._counters = {}
+    self._lock = threading.Lock()
+
+  def add(self, method_name, counter, value=1):
+    with self._lock:
+      counters = self._counters.get(method_name)
+      if counters is None:
+        counters = dict.fromkeys(self.COUNTERS, 0)
+        self._counters[method_name] = counters
+      counters[counter] += value
+
+  def stats(self):
+    """Returns a dict of method name to a dict of its counters."""
+    with self._lock:
+      return dict((name, dict(counters))
+                  for name, counters in self._counters.iteritems())
+
+  def clear(self):
+    with self._lock:
+      self._counters.clear()
+
+
+# retry_stats counts the retries of all the connections.
+retry_stats = RetryStats()
+
+
+def _get_budget(conn, policy):
+  """Returns the RetryBudget of a connection, creating it on first use."""
+  budget = getattr(conn, '_retry_budget', None)
+  if budget is None or budget[0] is not policy:
+    budget = (policy, policy.new_budget())
+    conn._retry_budget = budget  # pylint: disable=protected-access
+  return budget[1]
+
+
+def _in_transaction(session):
+  if not session:
+    return False
+  return getattr(session, 'in_transaction', True)
+
+
+def retry(retry_exceptions, sleep=time.sleep):
+  """Decorator retrying a VTGateClient method, see the module doc.
+
+  The connection must have the session and timeout attributes. The
+  decorated method accepts an extra 'deadline' keyword argument.
+
+  Args:
+    retry_exceptions: tuple of the exceptions to retry on.
+    sleep: the function waiting between the attempts.
+
+  Returns:
+    A decorator method that returns wrapped method.
+  """
+  def decorator(method):
+    """Returns wrapper that calls method and retries on retry_exceptions."""
+    method_name = method.__name__
+
+    def wrapper(self, *args, **kwargs):
+      policy = getattr(self, 'retry_policy', None) or DEFAULT_POLICY
+      deadline = kwargs.pop('deadline', None)
+      if deadline is None and self.timeout is not None:
+        deadline = time.time() + self.timeout
+      outer_deadline = getattr(_local, 'deadline', None)
+      if outer_deadline is not None:
+        deadline = min(deadline or outer_deadline, outer_deadline)
+      _local.deadline = deadline
+      outer_attempt = current_attempt()
+      attempt = 0
+      delay = 0
+      try:
+        while True:
+          _local.attempt = attempt
+          try:
+            result = method(self, *args, **kwargs)
+          except retry_exceptions as e:
+            attempt += 1
+            reason = None
+            if attempt > policy.num_retries:
+              reason = 'exhausted'
+            elif _in_transaction(self.session):
+              reason = 'in_transaction'
+            else:
+              delay = policy.next_delay_ms(delay, e)
+              budget = _get_budget(self, policy)
+              if (deadline is not None and
+                  time.time() + delay / 1000.0 >= deadline):
+                reason = 'deadline_exceeded'
+              elif budget is not None and not budget.try_acquire():
+                reason = 'budget_exhausted'
+            if reason:
+              if reason != 'in_transaction':
+                retry_stats.add(method_name, reason)
+              # In this case it is hard to discern keyspace
+              # and tablet_type from exception.
+              vtgate_utils.log_exception(e)
+              raise e
+            logging.warning(
+                'retryable error: %s, retrying in %d ms, attempt %d of %d',
+                e, delay, attempt, policy.num_retries)
+            retry_stats.add(method_name, 'retries')
+            retry_stats.add(method_name, 'delay_ms', delay)
+            sleep(delay / 1000.0)
+            continue
+          budget = _get_budget(self, policy)
+          if budget is not None:
+            budget.record_success()
+          if attempt:
+            retry_stats.add(method_name, 'recovered')
+          return result
+      finally:
+        _local.deadline = outer_deadline
+        _local.attempt = outer_attempt
+    wrapper.__name__ = method_name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+  return decorator
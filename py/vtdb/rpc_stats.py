@@ -0,0 +1,292 @@
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Per-RPC timing and payload instrumentation for the vtgate clients.
+
+grpc_vtgate_client reports each execute, batch, stream and transaction
+RPC to the registered RpcObserver objects, as an RpcEvent. The time of
+a call is split in three parts, so a slow query can be attributed:
+
+- build_time: building the request, mostly bind variable encoding.
+- wire_time: waiting for vtgate, including the network.
+- decode_time: converting the response to python rows.
+
+Nothing is measured while no observer is registered.
+
+HistogramObserver aggregates the events per (method, keyspace, tablet
+type) into histograms, and exports them in the Prometheus text format.
+
+API usage -
+
+observer = rpc_stats.HistogramObserver()
+rpc_stats.register_observer(observer)
+...
+print observer.prometheus_text()
+"""
+
+import bisect
+import threading
+
+# DEFAULT_TIME_BUCKETS are the upper bounds of the time histograms, in
+# seconds.
+DEFAULT_TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                        0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# DEFAULT_SIZE_BUCKETS are the upper bounds of the rows and bytes
+# histograms.
+DEFAULT_SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+class RpcEvent(object):
+  """The measures of one RPC.
+
+  Attributes:
+    method: the vtgate method name, e.g. 'ExecuteShards'.
+    keyspace: the keyspace, or None.
+    tablet_type: the (string) tablet type, or None.
+    build_time: time to build the request, in seconds.
+    wire_time: time waiting for vtgate, in seconds.
+    decode_time: time to decode the response, in seconds.
+    rows: the number of rows returned.
+    bytes_sent: the size of the request.
+    bytes_received: the size of the response, summed over the chunks of
+      a stream.
+    retries: how many times the call was retried before this attempt.
+    error: the exception, if the RPC failed.
+  """
+
+  __slots__ = ('method', 'keyspace', 'tablet_type', 'build_time',
+               'wire_time', 'decode_time', 'rows', 'bytes_sent',
+               'bytes_received', 'retries', 'error')
+
+  def __init__(self, method, keyspace=None, tablet_type=None, build_time=0.0,
+               wire_time=0.0, decode_time=0.0, rows=0, bytes_sent=0,
+               bytes_received=0, retries=0, error=None):
+    self.method = method
+    self.keyspace = keyspace
+    self.tablet_type = tablet_type
+    self.build_time = build_time
+    self.wire_time = wire_time
+    self.decode_time = decode_time
+    self.rows = rows
+    self.bytes_sent = bytes_sent
+    self.bytes_received = bytes_received
+    self.retries = retries
+    self.error = error
+
+  @property
+  def total_time(self):
+    return self.build_time + self.wire_time + self.decode_time
+
+  def __repr__(self):
+    return ('RpcEvent(%s, keyspace=%r, tablet_type=%r, build=%.6f, '
+            'wire=%.6f, decode=%.6f, rows=%d, sent=%d, received=%d, '
+            'retries=%d, error=%r)' % (
+                self.method, self.keyspace, self.tablet_type,
+                self.build_time, self.wire_time, self.decode_time, self.rows,
+                self.bytes_sent, self.bytes_received, self.retries,
+                self.error))
+
+
+class RpcObserver(object):
+  """Receives the RpcEvent of every RPC, from the calling thread."""
+
+  def observe(self, event):
+    raise NotImplementedError('Child class needs to implement this')
+
+
+# observers is the list of the registered RpcObserver objects. The
+# clients only measure the RPCs when it is not empty.
+observers = []
+_observers_lock = threading.Lock()
+
+
+def register_observer(observer):
+  global observers
+  with _observers_lock:
+    observers = observers + [observer]
+
+
+def unregister_observer(observer):
+  global observers
+  with _observers_lock:
+    observers = [o for o in observers if o is not observer]
+
+
+def notify(event):
+  """Sends an RpcEvent to all the registered observers."""
+  for observer in observers:
+    observer.observe(event)
+
+
+class Histogram(object):
+  """A histogram with fixed bucket upper bounds, as in Prometheus."""
+
+  def __init__(self, buckets):
+    self.buckets = tuple(buckets)
+    # counts[i] is the number of values <= buckets[i], and above the
+    # previous bound. counts[-1] counts the values above all bounds.
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.sum = 0.0
+    self.count = 0
+
+  def add(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def cumulative_counts(self):
+    """Returns the (upper bound, count of values <= bound) pairs."""
+    result = []
+    total = 0
+    for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+      total += count
+      result.append((bound, total))
+    return result
+
+  def quantile(self, q):
+    """Returns the upper bound of the bucket holding the q quantile."""
+    if not self.count:
+      return 0.0
+    rank = q * self.count
+    for bound, total in self.cumulative_counts():
+      if total >= rank:
+        return bound
+    return float('inf')
+
+
+class _Series(object):
+  """The histograms of one (method, keyspace, tablet type)."""
+
+  TIMES = ('build_time', 'wire_time', 'decode_time', 'total_time')
+  SIZES = ('rows', 'bytes_sent', 'bytes_received')
+
+  def __init__(self, time_buckets, size_buckets):
+    self.histograms = {}
+    for name in self.TIMES:
+      self.histograms[name] = Histogram(time_buckets)
+    for name in self.SIZES:
+      self.histograms[name] = Histogram(size_buckets)
+    # retries is the number of attempts that were retries.
+    self.retries = 0
+    self.errors = 0
+
+  def add(self, event):
+    for name, histogram in self.histograms.iteritems():
+      histogram.add(getattr(event, name))
+    # There is one event per attempt, and event.retries is the attempt
+    # index: count the attempts, not the indices.
+    if event.retries:
+      self.retries += 1
+    if event.error is not None:
+      self.errors += 1
+
+
+def _format_float(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(float(value))
+
+
+def _escape_label(value):
+  return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+      '\n', r'\n')
+
+
+class HistogramObserver(RpcObserver):
+  """Aggregates the RPCs into histograms, see the module doc."""
+
+  def __init__(self, time_buckets=DEFAULT_TIME_BUCKETS,
+               size_buckets=DEFAULT_SIZE_BUCKETS, prefix='vtdb_rpc'):
+    """Creates a HistogramObserver.
+
+    Args:
+      time_buckets: upper bounds of the time histograms, in seconds.
+      size_buckets: upper bounds of the rows and bytes histograms.
+      prefix: the prefix of the exported metric names.
+    """
+    self.time_buckets = time_buckets
+    self.size_buckets = size_buckets
+    self.prefix = prefix
+    self._series = {}
+    self._lock = threading.Lock()
+
+  def observe(self, event):
+    key = (event.method, event.keyspace or '', event.tablet_type or '')
+    with self._lock:
+      series = self._series.get(key)
+      if series is None:
+        series = _Series(self.time_buckets, self.size_buckets)
+        self._series[key] = series
+      series.add(event)
+
+  def histogram(self, method, keyspace, tablet_type, name):
+    """Returns a copy of one histogram, or None if there is no such RPC.
+
+    Args:
+      method: the vtgate method name.
+      keyspace: the keyspace, or None.
+      tablet_type: the tablet type, or None.
+      name: one of the RpcEvent time, rows or bytes attributes, or
+        'total_time'.
+
+    Returns:
+      A Histogram.
+    """
+    with self._lock:
+      series = self._series.get((method, keyspace or '', tablet_type or ''))
+      if series is None:
+        return None
+      source = series.histograms[name]
+      histogram = Histogram(source.buckets)
+      histogram.counts = list(source.counts)
+      histogram.sum = source.sum
+      histogram.count = source.count
+      return histogram
+
+  def reset(self):
+    with self._lock:
+      self._series.clear()
+
+  def prometheus_text(self):
+    """Returns the histograms in the Prometheus text exposition format."""
+    lines = []
+    with self._lock:
+      items = sorted(self._series.iteritems())
+      names = [(name, 'seconds') for name in _Series.TIMES] + [
+          (name, None) for name in _Series.SIZES]
+      for name, unit in names:
+        metric = '%s_%s%s' % (self.prefix, name, '_seconds' if unit else '')
+        lines.append('# HELP %s vtgate RPC %s.' % (
+            metric, name.replace('_', ' ')))
+        lines.append('# TYPE %s histogram' % metric)
+        for (method, keyspace, tablet_type), series in items:
+          labels = 'method="%s",keyspace="%s",tablet_type="%s"' % (
+              _escape_label(method), _escape_label(keyspace),
+              _escape_label(tablet_type))
+          histogram = series.histograms[name]
+          for bound, total in histogram.cumulative_counts():
+            lines.append('%s_bucket{%s,le="%s"} %d' % (
+                metric, labels, _format_float(bound), total))
+          lines.append('%s_sum{%s} %s' % (
+              metric, labels, _format_float(histogram.sum)))
+          lines.append('%s_count{%s} %d' % (metric, labels, histogram.count))
+      for name in ('retries', 'errors'):
+        metric = '%s_%s_total' % (self.prefix, name)
+        lines.append('# HELP %s vtgate RPC %s.' % (metric, name))
+        lines.append('# TYPE %s counter' % metric)
+        for (method, keyspace, tablet_type), series in items:
+          lines.append(
+              '%s{method="%s",keyspace="%s",tablet_type="%s"} %d' % (
+                  metric, _escape_label(method), _escape_label(keyspace),
+                  _escape_label(tablet_type), getattr(series, name)))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,170 @@
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A client-side cache of SrvKeyspace objects.
+
+VTGateClient.get_srv_keyspace is a full RPC. Clients that route rows
+themselves need the SrvKeyspace for every row, so this cache keeps the
+keyspace.Keyspace objects, and refreshes them in the background.
+
+An entry is served from the cache while it is younger than ttl. Once
+start() is called, a background thread refreshes the entries older than
+refresh_interval, so callers never wait for the RPC. If the refresh
+fails, the previous entry is kept until it expires, after which get()
+fetches it again synchronously, and raises the error of the RPC.
+
+API usage -
+
+cache = srv_keyspace_cache.SrvKeyspaceCache(conn, ttl=60, refresh_interval=10)
+cache.start()
+shard = cache.keyspace_id_to_shard_name('user', 0x1234, 'master')
+cache.close()
+"""
+
+import logging
+import threading
+import time
+
+# DEFAULT_TTL is how long an entry is used, in seconds.
+DEFAULT_TTL = 60.0
+# DEFAULT_REFRESH_INTERVAL is the age, in seconds, at which the
+# background thread refreshes an entry.
+DEFAULT_REFRESH_INTERVAL = 15.0
+
+
+class _Entry(object):
+
+  def __init__(self, ks, fetch_time):
+    self.keyspace = ks
+    self.fetch_time = fetch_time
+
+
+class SrvKeyspaceCache(object):
+  """Caches the keyspace.Keyspace objects of a VTGateClient."""
+
+  def __init__(self, conn, ttl=DEFAULT_TTL,
+               refresh_interval=DEFAULT_REFRESH_INTERVAL):
+    """Creates a SrvKeyspaceCache.
+
+    Args:
+      conn: a dialed VTGateClient. Its get_srv_keyspace is called from
+        the background thread too.
+      ttl: how long an entry is used, in seconds.
+      refresh_interval: age at which the background thread refreshes an
+        entry, in seconds. Should be smaller than ttl.
+    """
+    self.conn = conn
+    self.ttl = ttl
+    self.refresh_interval = refresh_interval
+    self.hits = 0
+    self.misses = 0
+    self.refreshes = 0
+    self.refresh_errors = 0
+    self._entries = {}
+    self._lock = threading.Lock()
+    self._closed = threading.Event()
+    self._thread = None
+
+  def start(self):
+    """Starts the background refresh thread."""
+    with self._lock:
+      if self._thread:
+        return
+      self._closed.clear()
+      self._thread = threading.Thread(target=self._refresh_loop)
+      self._thread.daemon = True
+      self._thread.start()
+
+  def close(self):
+    """Stops the background refresh thread."""
+    self._closed.set()
+    with self._lock:
+      thread = self._thread
+      self._thread = None
+    if thread:
+      thread.join()
+
+  def get(self, name):
+    """Returns the keyspace.Keyspace for a keyspace name.
+
+    Args:
+      name: the keyspace name.
+
+    Returns:
+      A keyspace.Keyspace object.
+
+    Raises:
+      dbexceptions.DatabaseError: if the keyspace had to be fetched,
+        and get_srv_keyspace failed.
+    """
+    now = time.time()
+    with self._lock:
+      entry = self._entries.get(name)
+      if entry and now - entry.fetch_time < self.ttl:
+        self.hits += 1
+        return entry.keyspace
+      self.misses += 1
+    return self._fetch(name)
+
+  def _fetch(self, name):
+    ks = self.conn.get_srv_keyspace(name)
+    with self._lock:
+      self._entries[name] = _Entry(ks, time.time())
+    return ks
+
+  def invalidate(self, name=None):
+    """Drops a keyspace from the cache, or all of them if name is None."""
+    with self._lock:
+      if name is None:
+        self._entries.clear()
+      else:
+        self._entries.pop(name, None)
+
+  def keyspace_id_to_shard_name(self, name, keyspace_id, db_type):
+    """Returns the shard of a keyspace_id, see keyspace.Keyspace."""
+    return self.get(name).keyspace_id_to_shard_name_for_db_type(
+        keyspace_id, db_type)
+
+  def keyspace_ids_to_shard_names(self, name, keyspace_ids, db_type):
+    """Returns the shards of many keyspace_ids, see keyspace.Keyspace."""
+    return self.get(name).keyspace_ids_to_shard_names_for_db_type(
+        keyspace_ids, db_type)
+
+  def _refresh_loop(self):
+    while not self._closed.wait(min(1.0, self.refresh_interval / 2.0)):
+      now = time.time()
+      with self._lock:
+        names = [name for name, entry in self._entries.iteritems()
+                 if now - entry.fetch_time >= self.refresh_interval]
+      for name in names:
+        if self._closed.is_set():
+          return
+        try:
+          self._fetch(name)
+          self.refreshes += 1
+        except Exception as e:  # pylint: disable=broad-except
+          self.refresh_errors += 1
+          logging.warning('cannot refresh SrvKeyspace %s: %s', name, e)
+
+  def stats(self):
+    """Returns a dict with the size and the hit / miss / refresh counters."""
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {
+          'size': len(self._entries),
+          'hits': self.hits,
+          'misses': self.misses,
+          'refreshes': self.refreshes,
+          'refresh_errors': self.refresh_errors,
+          'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+      }
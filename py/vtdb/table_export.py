@@ -0,0 +1,309 @@
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Exports the result of a query to files, using SplitQuery.
+
+vtgate cuts the query into balanced splits (see VTGateClient.split_query),
+the splits are streamed in parallel, and the rows of each split are
+written as they arrive to their own file in the output directory, in CSV
+or newline-delimited JSON. In JSON files, the values of the binary
+columns (BINARY, VARBINARY, BLOB, BIT and GEOMETRY) are base64 strings,
+the other strings are expected to be UTF-8.
+
+When a checkpoint file is given, it records the splits and the ones
+that are complete. Running the same export again with the same
+checkpoint file only streams the splits that were not complete, and
+rewrites their files from scratch.
+
+API usage -
+
+exporter = table_export.TableExporter(
+    conn, 'user', 'rdonly', '/data/export', output_format='json',
+    checkpoint_path='/data/export/checkpoint.json')
+exporter.run('SELECT id, name FROM user', split_count=64)
+"""
+
+import base64
+import csv
+import json
+import logging
+import os
+import time
+
+from vtproto import query_pb2
+
+from vtdb import dbexceptions
+from vtdb import keyrange
+from vtdb import parallel_scanner
+from vtdb import proto3_encoding
+from vtdb import vtgate_client
+
+CSV = 'csv'
+JSON = 'json'
+
+# CHECKPOINT_VERSION is stored in the checkpoint files, and checked
+# when loading them.
+CHECKPOINT_VERSION = 2
+
+# _BINARY_TYPES are the field types written as base64 in JSON files.
+_BINARY_TYPES = frozenset([query_pb2.BINARY, query_pb2.VARBINARY,
+                           query_pb2.BLOB, query_pb2.BIT, query_pb2.GEOMETRY])
+
+
+class ExportProgress(object):
+  """The progress of a TableExporter run."""
+
+  def __init__(self, total_splits, completed_splits):
+    self.total_splits = total_splits
+    self.completed_splits = completed_splits
+    self.rows = 0
+    self.start_time = time.time()
+
+  @property
+  def elapsed(self):
+    return time.time() - self.start_time
+
+  def __repr__(self):
+    return 'ExportProgress(%d/%d splits, %d rows, %.1fs)' % (
+        self.completed_splits, self.total_splits, self.rows, self.elapsed)
+
+
+class _SplitWriter(object):
+  """Writes the rows of one split to its file."""
+
+  def __init__(self, path, output_format, fields, null_value):
+    self.file = open(path, 'wb')
+    self.output_format = output_format
+    self.names = [name for name, _ in fields]
+    self.binary_columns = [i for i, (_, field_type) in enumerate(fields)
+                           if field_type in _BINARY_TYPES]
+    self.null_value = null_value
+    if output_format == CSV:
+      self.csv_writer = csv.writer(self.file)
+      self.csv_writer.writerow(self.names)
+
+  def write(self, rows):
+    if self.output_format == CSV:
+      self.csv_writer.writerows(
+          [self.null_value if v is None else v for v in row] for row in rows)
+    else:
+      for row in rows:
+        if self.binary_columns:
+          row = list(row)
+          for i in self.binary_columns:
+            if row[i] is not None:
+              row[i] = base64.b64encode(row[i])
+        self.file.write(json.dumps(dict(zip(self.names, row)), default=str))
+        self.file.write('\n')
+
+  def close(self):
+    self.file.close()
+    return os.path.getsize(self.file.name)
+
+
+class TableExporter(object):
+  """Exports a query to one file per split, see the module doc."""
+
+  def __init__(self, conn, keyspace_name, tablet_type, output_dir,
+               output_format=CSV, checkpoint_path=None, null_value='\\N',
+               on_progress=None, effective_caller_id=None, **kwargs):
+    """Creates a TableExporter.
+
+    Args:
+      conn: a dialed VTGateClient. Its _stream_execute is called from
+        several threads at once.
+      keyspace_name: the keyspace of the table.
+      tablet_type: the (string) tablet type to stream from.
+      output_dir: directory for the split files. Must exist.
+      output_format: CSV or JSON.
+      checkpoint_path: optional checkpoint file, to resume an export.
+      null_value: how NULL values are written in CSV files.
+      on_progress: optional function called with an ExportProgress after
+        each completed split.
+      effective_caller_id: CallerID object.
+      **kwargs: passed to parallel_scanner.StreamMerger (num_threads,
+        chunk_size, max_pending_chunks, num_retries, retry_exceptions).
+
+    Raises:
+      ValueError: for an unknown output_format.
+    """
+    if output_format not in (CSV, JSON):
+      raise ValueError('Unknown output format', output_format)
+    self.conn = conn
+    self.keyspace_name = keyspace_name
+    self.tablet_type = tablet_type
+    self.output_dir = output_dir
+    self.output_format = output_format
+    self.checkpoint_path = checkpoint_path
+    self.null_value = null_value
+    self.on_progress = on_progress
+    self.effective_caller_id = effective_caller_id
+    self.merger = parallel_scanner.StreamMerger(**kwargs)
+    self.progress = None
+    # Map of split index to (TaskStats, bytes written).
+    self.stats = {}
+
+  def split_path(self, index):
+    """Returns the path of the file for the split at index."""
+    return os.path.join(self.output_dir, 'split-%05d.%s' % (
+        index, self.output_format))
+
+  def cancel(self):
+    self.merger.cancel()
+
+  def run(self, sql, bind_variables=None, **kwargs):
+    """Runs the export.
+
+    Args:
+      sql: the query to export, with bind variables in the :name format.
+      bind_variables: map of bind variables for the query.
+      **kwargs: passed to conn.split_query (split_columns, split_count,
+        num_rows_per_query_part, algorithm).
+
+    Returns:
+      The list of the paths of all the split files.
+
+    Raises:
+      dbexceptions.ProgrammingError: if the checkpoint file is for
+        another query.
+    """
+    splits, completed = self._load_checkpoint(sql, bind_variables)
+    if splits is None:
+      splits = self.conn.split_query(
+          sql, self.keyspace_name, bind_variables=bind_variables,
+          effective_caller_id=self.effective_caller_id, **kwargs)
+      completed = set()
+      self._save_checkpoint(sql, bind_variables, splits, completed)
+    if completed:
+      logging.info('resuming export: %d of %d splits already done',
+                   len(completed), len(splits))
+
+    self.progress = ExportProgress(len(splits), len(completed))
+    self.stats = {}
+    writers = {}
+
+    def on_task_done(task_stats):
+      index = task_stats.task_id
+      writer = writers.pop(index, None)
+      if writer is None:
+        # Empty split, the file still needs to exist.
+        writer = _SplitWriter(self.split_path(index), self.output_format,
+                              self.merger.fields or [], self.null_value)
+      self.stats[index] = (task_stats, writer.close())
+      completed.add(index)
+      self._save_checkpoint(sql, bind_variables, splits, completed)
+      self.progress.completed_splits += 1
+      logging.info('split %d done: %d rows in %.1fs (%.0f rows/s), %s',
+                   index, task_stats.rows, task_stats.elapsed,
+                   task_stats.rows_per_second, self.progress)
+      if self.on_progress:
+        self.on_progress(self.progress)
+
+    tasks = [(i, self._open_stream_func(split))
+             for i, split in enumerate(splits) if i not in completed]
+    try:
+      for index, rows in self.merger.run(tasks, on_task_done=on_task_done):
+        writer = writers.get(index)
+        if writer is None:
+          writer = _SplitWriter(self.split_path(index), self.output_format,
+                                self.merger.fields, self.null_value)
+          writers[index] = writer
+        writer.write(rows)
+        self.progress.rows += len(rows)
+    finally:
+      # Files of incomplete splits are rewritten on the next run.
+      for writer in writers.itervalues():
+        writer.close()
+    return [self.split_path(i) for i in xrange(len(splits))]
+
+  def _open_stream_func(self, split):
+    def open_stream():
+      return self.conn._stream_execute(  # pylint: disable=protected-access
+          split.sql, split.bind_variables,
+          tablet_type=self.tablet_type,
+          keyspace_name=split.keyspace,
+          shards=split.shards,
+          keyranges=split.keyranges,
+          effective_caller_id=self.effective_caller_id)
+    return open_stream
+
+  def _load_checkpoint(self, sql, bind_variables):
+    """Returns the splits and completed indexes, or (None, None)."""
+    if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+      return None, None
+    with open(self.checkpoint_path) as f:
+      checkpoint = json.load(f)
+    if checkpoint.get('version') != CHECKPOINT_VERSION:
+      raise dbexceptions.ProgrammingError(
+          'unsupported checkpoint version', self.checkpoint_path)
+    if (checkpoint['sql'] != sql or
+        checkpoint['bind_variables'] !=
+        _encode_bind_variables(bind_variables)):
+      raise dbexceptions.ProgrammingError(
+          'checkpoint is for another query', self.checkpoint_path,
+          checkpoint['sql'])
+    splits = []
+    for s in checkpoint['splits']:
+      keyranges = None
+      if s['keyranges'] is not None:
+        keyranges = [keyrange.KeyRange(kr) for kr in s['keyranges']]
+      splits.append(vtgate_client.QuerySplit(
+          s['sql'], _decode_bind_variables(s['bind_variables']),
+          s['keyspace'],
+          shards=s['shards'], keyranges=keyranges, size=s['size']))
+    return splits, set(checkpoint['completed'])
+
+  def _save_checkpoint(self, sql, bind_variables, splits, completed):
+    """Atomically writes the checkpoint file, if any."""
+    if not self.checkpoint_path:
+      return
+    checkpoint = {
+        'version': CHECKPOINT_VERSION,
+        'sql': sql,
+        'bind_variables': _encode_bind_variables(bind_variables),
+        'splits': [{
+            'sql': s.sql,
+            'bind_variables': _encode_bind_variables(s.bind_variables),
+            'keyspace': s.keyspace,
+            'shards': s.shards,
+            'keyranges': (None if s.keyranges is None
+                          else [str(kr) for kr in s.keyranges]),
+            'size': s.size,
+        } for s in splits],
+        'completed': sorted(completed),
+    }
+    tmp_path = self.checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(checkpoint, f, indent=2)
+    os.rename(tmp_path, self.checkpoint_path)
+
+
+# Bind variables can hold binary strings, they are stored in the
+# checkpoint files as base64 serialized query.BindVariable protos.
+def _encode_bind_variables(bind_variables):
+  encoded = {}
+  for name, value in (bind_variables or {}).iteritems():
+    bind_variable = query_pb2.BindVariable()
+    proto3_encoding.convert_value(value, bind_variable, allow_lists=True)
+    encoded[name] = base64.b64encode(bind_variable.SerializeToString())
+  return encoded
+
+
+def _decode_bind_variables(encoded):
+  bind_variables = {}
+  for name, data in encoded.iteritems():
+    bind_variable = query_pb2.BindVariable()
+    bind_variable.ParseFromString(base64.b64decode(data))
+    bind_variables[str(name)] = proto3_encoding.convert_bind_variable(
+        bind_variable)
+  return bind_variables
@@ -0,0 +1,310 @@
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs transactions on pinned connections, reusing their session.
+
+A VTGateClient keeps a single transaction, in its session. The
+TransactionManager runs each transaction on its own connection: with a
+vtgate_pool.VTGatePool, a connection is checked out of the pool at
+begin, and checked in at commit or rollback, so transactions can run
+concurrently from several threads. With a single connection, the
+transactions run one at a time.
+
+The session of a transaction grows with the number of shards it
+touches, and goes back and forth with every statement. While a
+connection is pinned, its reuse_session flag is set: the session of a
+response is kept serialized, and appended as is to the next request,
+instead of being copied into it and serialized again.
+
+The cursors of a transaction are recycled once it ends, and each
+transaction records its number of RPCs and bytes sent and received.
+
+API usage -
+
+manager = transaction_manager.TransactionManager(pool)
+with manager.transaction() as tx:
+  for user in users:
+    tx.execute('insert into user(id, name) values (:id, :name)',
+               {'id': user.id, 'name': user.name}, keyspace='user')
+print tx.stats
+"""
+
+import contextlib
+import threading
+import time
+
+from vtdb import dbexceptions
+from vtdb import vtgate_cursor
+
+# DEFAULT_MAX_IDLE_CURSORS is the number of cursors kept for reuse.
+DEFAULT_MAX_IDLE_CURSORS = 64
+
+
+class TransactionStats(object):
+  """The RPCs of one transaction.
+
+  rpcs, bytes_sent and bytes_received are only counted by connections
+  that support reuse_session, like grpc_vtgate_client.
+
+  Attributes:
+    statements: number of execute calls made through the Transaction.
+    rpcs: number of RPCs, including begin and commit or rollback.
+    bytes_sent: size of the requests.
+    bytes_received: size of the responses.
+    duration: time from begin to commit or rollback, in seconds.
+  """
+
+  def __init__(self):
+    self.statements = 0
+    self.rpcs = 0
+    self.bytes_sent = 0
+    self.bytes_received = 0
+    self.duration = 0.0
+
+  def __repr__(self):
+    return ('TransactionStats(statements=%d, rpcs=%d, bytes_sent=%d, '
+            'bytes_received=%d, duration=%.3f)' % (
+                self.statements, self.rpcs, self.bytes_sent,
+                self.bytes_received, self.duration))
+
+
+def _counters(conn):
+  return (getattr(conn, 'rpc_count', 0), getattr(conn, 'bytes_sent', 0),
+          getattr(conn, 'bytes_received', 0))
+
+
+class Transaction(object):
+  """A transaction on a pinned connection, see TransactionManager.begin."""
+
+  def __init__(self, manager, conn, release):
+    self.manager = manager
+    self.conn = conn
+    self.stats = TransactionStats()
+    self._release = release
+    self._cursors = []
+    self._start_time = time.time()
+    self._start_counters = _counters(conn)
+    # Set once the transaction is committed or rolled back.
+    self.done = False
+
+  def cursor(self, tablet_type='master', keyspace=None, shards=None,
+             keyspace_ids=None, keyranges=None, writable=True):
+    """Returns a vtgate_cursor.VTGateCursor in this transaction.
+
+    The cursor is only valid until the transaction ends.
+
+    Args:
+      tablet_type: Str tablet_type.
+      keyspace: Str keyspace or None if batch API will be used.
+      shards: List of strings.
+      keyspace_ids: Struct('!Q').packed keyspace IDs.
+      keyranges: Str keyranges.
+      writable: True if writable.
+
+    Returns:
+      A VTGateCursor.
+    """
+    self._check_open()
+    cursor = self.manager.get_cursor(
+        self.conn, tablet_type, keyspace=keyspace, shards=shards,
+        keyspace_ids=keyspace_ids, keyranges=keyranges, writable=writable)
+    self._cursors.append(cursor)
+    return cursor
+
+  def execute(self, sql, bind_variables, tablet_type='master', keyspace=None,
+              shards=None, keyspace_ids=None, keyranges=None, **kwargs):
+    """Executes a statement in this transaction.
+
+    Args:
+      sql: the statement.
+      bind_variables: the bind variables of the statement.
+      tablet_type: Str tablet_type.
+      keyspace: Str keyspace.
+      shards: List of strings.
+      keyspace_ids: Struct('!Q').packed keyspace IDs.
+      keyranges: Str keyranges.
+      **kwargs: passed to the cursor execute.
+
+    Returns:
+      The cursor, with the results of the statement.
+    """
+    cursor = self.cursor(tablet_type, keyspace=keyspace, shards=shards,
+                         keyspace_ids=keyspace_ids, keyranges=keyranges)
+    self.stats.statements += 1
+    cursor.execute(sql, bind_variables, **kwargs)
+    return cursor
+
+  def commit(self, twopc=False):
+    """Commits the transaction, and releases its connection."""
+    self._end('commit', twopc)
+
+  def rollback(self):
+    """Rolls back the transaction, and releases its connection."""
+    self._end('rollback')
+
+  def _check_open(self):
+    if self.done:
+      raise dbexceptions.ProgrammingError('Transaction already ended')
+
+  def _end(self, method_name, *pargs):
+    self._check_open()
+    self.done = True
+    error = None
+    try:
+      getattr(self.conn, method_name)(*pargs)
+    except Exception as e:
+      error = e
+      raise
+    finally:
+      counters = _counters(self.conn)
+      self.stats.rpcs, self.stats.bytes_sent, self.stats.bytes_received = [
+          end - start for start, end in zip(self._start_counters, counters)]
+      self.stats.duration = time.time() - self._start_time
+      cursors = self._cursors
+      self._cursors = []
+      self._release(self, method_name, error, cursors)
+
+
+class TransactionManager(object):
+  """Pins a connection per transaction, see the module doc."""
+
+  def __init__(self, conn, max_idle_cursors=DEFAULT_MAX_IDLE_CURSORS):
+    """Creates a TransactionManager.
+
+    Args:
+      conn: a dialed vtgate_pool.VTGatePool, or a dialed VTGateClient.
+        Only one transaction at a time runs on a VTGateClient.
+      max_idle_cursors: the number of cursors kept for reuse.
+    """
+    self.conn = conn
+    self.max_idle_cursors = max_idle_cursors
+    self.transactions = 0
+    self.commits = 0
+    self.rollbacks = 0
+    self.errors = 0
+    self.rpcs = 0
+    self.bytes_sent = 0
+    self.bytes_received = 0
+    self.cursors_created = 0
+    self.cursors_reused = 0
+    self._idle_cursors = []
+    self._lock = threading.Lock()
+    # Serializes the transactions on a single connection.
+    self._conn_lock = threading.Lock()
+
+  def begin(self, effective_caller_id=None, single_db=False):
+    """Starts a transaction on its own connection.
+
+    Args:
+      effective_caller_id: CallerID object.
+      single_db: True if single db transaction is needed.
+
+    Returns:
+      A Transaction. It must be committed or rolled back to release
+      its connection.
+    """
+    if hasattr(self.conn, 'checkout'):
+      endpoint, conn = self.conn.checkout()
+      checkin = lambda error: self.conn.checkin(endpoint, conn, error)
+    else:
+      self._conn_lock.acquire()
+      conn = self.conn
+      checkin = lambda error: self._conn_lock.release()
+
+    def release(tx, method_name, error, cursors):
+      conn.reuse_session = False
+      checkin(error)
+      self._record(tx, method_name, error, cursors)
+
+    try:
+      conn.reuse_session = True
+      tx = Transaction(self, conn, release)
+      conn.begin(effective_caller_id=effective_caller_id, single_db=single_db)
+    except Exception as e:
+      conn.reuse_session = False
+      checkin(e)
+      with self._lock:
+        self.errors += 1
+      raise
+    with self._lock:
+      self.transactions += 1
+    return tx
+
+  @contextlib.contextmanager
+  def transaction(self, effective_caller_id=None, single_db=False,
+                  twopc=False):
+    """Runs a block in a transaction, committed if the block succeeds.
+
+    Args:
+      effective_caller_id: CallerID object.
+      single_db: True if single db transaction is needed.
+      twopc: True if 2-phase commit is needed.
+
+    Yields:
+      The Transaction. It is rolled back if the block raises.
+    """
+    tx = self.begin(effective_caller_id=effective_caller_id,
+                    single_db=single_db)
+    try:
+      yield tx
+    except Exception:
+      if not tx.done:
+        tx.rollback()
+      raise
+    if not tx.done:
+      tx.commit(twopc)
+
+  def get_cursor(self, conn, tablet_type, **kwargs):
+    """Returns a recycled or new VTGateCursor, see VTGateCursor.reset."""
+    with self._lock:
+      cursor = self._idle_cursors.pop() if self._idle_cursors else None
+      if cursor is None:
+        self.cursors_created += 1
+      else:
+        self.cursors_reused += 1
+    if cursor is None:
+      return vtgate_cursor.VTGateCursor(conn, tablet_type, **kwargs)
+    cursor.reset(conn, tablet_type, **kwargs)
+    return cursor
+
+  def _record(self, tx, method_name, error, cursors):
+    for cursor in cursors:
+      cursor.close()
+    with self._lock:
+      free = self.max_idle_cursors - len(self._idle_cursors)
+      self._idle_cursors.extend(cursors[:max(0, free)])
+      if error is not None:
+        self.errors += 1
+      elif method_name == 'commit':
+        self.commits += 1
+      else:
+        self.rollbacks += 1
+      self.rpcs += tx.stats.rpcs
+      self.bytes_sent += tx.stats.bytes_sent
+      self.bytes_received += tx.stats.bytes_received
+
+  def stats(self):
+    """Returns a dict with the transaction, RPC and cursor counters."""
+    with self._lock:
+      return {
+          'transactions': self.transactions,
+          'commits': self.commits,
+          'rollbacks': self.rollbacks,
+          'errors': self.errors,
+          'rpcs': self.rpcs,
+          'bytes_sent': self.bytes_sent,
+          'bytes_received': self.bytes_received,
+          'cursors_created': self.cursors_created,
+          'cursors_reused': self.cursors_reused,
+          'idle_cursors': len(self._idle_cursors),
+      }
@@ -0,0 +1,326 @@
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Consumes the update streams of all the shards of a keyspace.
+
+UpdateStreamConsumer opens one VTGateClient.update_stream per shard,
+each in its own thread, and merges their events into a single
+generator. The events of a shard are returned in order, the events of
+different shards are interleaved as they arrive.
+
+Each shard resumes on its own: when its stream fails or ends, it is
+opened again from the EventToken of the last event received, after a
+backoff delay. The EventToken of the last event the caller consumed is
+also saved, per shard, in a CheckpointStore (a JSON file or a SQLite
+database), so a new consumer with the same store resumes where the
+previous one stopped. An event is consumed once the caller asks for the
+next one, so events are delivered at least once.
+
+API usage -
+
+store = update_stream_consumer.SQLiteCheckpointStore('/var/lib/inv.db')
+consumer = update_stream_consumer.UpdateStreamConsumer(
+    conn, 'user', 'replica', store)
+consumer.start()
+for shard, event in consumer.events():
+  invalidate(event)
+"""
+
+import json
+import logging
+import os
+import Queue
+import sqlite3
+import threading
+import time
+
+from vtproto import query_pb2
+
+from vtdb import vtgate_utils
+
+# DEFAULT_MAX_PENDING_EVENTS is the number of events buffered, across
+# all shards, before the streams stall.
+DEFAULT_MAX_PENDING_EVENTS = 1000
+# DEFAULT_CHECKPOINT_INTERVAL is how often the checkpoints are saved,
+# in seconds.
+DEFAULT_CHECKPOINT_INTERVAL = 1.0
+# MAX_RECONNECT_DELAY_MS is the longest wait between two attempts to
+# open the stream of a shard.
+MAX_RECONNECT_DELAY_MS = 5000
+
+# How often blocked threads check if the consumer was closed.
+_POLL_INTERVAL = 0.1
+# How long close() waits for the stream threads, in seconds.
+_CLOSE_TIMEOUT = 1.0
+
+
+class CheckpointStore(object):
+  """Stores the last consumed EventToken of each shard."""
+
+  def load(self, keyspace_name, shard):
+    """Returns the saved query_pb2.EventToken of a shard, or None."""
+    raise NotImplementedError('Child class needs to implement this')
+
+  def save(self, keyspace_name, checkpoints):
+    """Saves checkpoints, a dict of shard to query_pb2.EventToken."""
+    raise NotImplementedError('Child class needs to implement this')
+
+  def close(self):
+    pass
+
+
+def _token_to_dict(token):
+  return {'timestamp': token.timestamp, 'position': token.position}
+
+
+def _token_from_dict(d):
+  return query_pb2.EventToken(timestamp=d['timestamp'],
+                              position=d['position'])
+
+
+class FileCheckpointStore(CheckpointStore):
+  """Stores the checkpoints in a JSON file, rewritten atomically."""
+
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+    self._checkpoints = {}
+    if os.path.exists(path):
+      with open(path) as f:
+        self._checkpoints = json.load(f)
+
+  def load(self, keyspace_name, shard):
+    with self._lock:
+      d = self._checkpoints.get('%s/%s' % (keyspace_name, shard))
+    if d is None:
+      return None
+    return _token_from_dict(d)
+
+  def save(self, keyspace_name, checkpoints):
+    with self._lock:
+      for shard, token in checkpoints.iteritems():
+        self._checkpoints['%s/%s' % (keyspace_name, shard)] = (
+            _token_to_dict(token))
+      tmp_path = self.path + '.tmp'
+      with open(tmp_path, 'w') as f:
+        json.dump(self._checkpoints, f, indent=2, sort_keys=True)
+      os.rename(tmp_path, self.path)
+
+
+class SQLiteCheckpointStore(CheckpointStore):
+  """Stores the checkpoints in a table of a SQLite database."""
+
+  def __init__(self, path, table='update_stream_checkpoints'):
+    self.table = table
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, check_same_thread=False)
+    self._db.execute(
+        'create table if not exists %s (keyspace text, shard text, '
+        'timestamp integer, position text, '
+        'primary key (keyspace, shard))' % table)
+    self._db.commit()
+
+  def load(self, keyspace_name, shard):
+    with self._lock:
+      row = self._db.execute(
+          'select timestamp, position from %s where keyspace = ? and '
+          'shard = ?' % self.table, (keyspace_name, shard)).fetchone()
+    if row is None:
+      return None
+    return query_pb2.EventToken(timestamp=row[0], position=row[1])
+
+  def save(self, keyspace_name, checkpoints):
+    with self._lock:
+      self._db.executemany(
+          'insert or replace into %s (keyspace, shard, timestamp, position) '
+          'values (?, ?, ?, ?)' % self.table,
+          [(keyspace_name, shard, token.timestamp, token.position)
+           for shard, token in checkpoints.iteritems()])
+      self._db.commit()
+
+  def close(self):
+    with self._lock:
+      self._db.close()
+
+
+class ShardStats(object):
+  """Statistics for the stream of one shard."""
+
+  def __init__(self, shard):
+    self.shard = shard
+    self.events = 0
+    self.reconnects = 0
+    self.last_error = None
+    self.last_timestamp = None
+
+  def __repr__(self):
+    return 'ShardStats(%r, events=%d, reconnects=%d, last_timestamp=%r)' % (
+        self.shard, self.events, self.reconnects, self.last_timestamp)
+
+
+class UpdateStreamConsumer(object):
+  """Streams the updates of many shards, see the module doc."""
+
+  def __init__(self, conn, keyspace_name, tablet_type, store,
+               shards=None, timestamp=None,
+               max_pending_events=DEFAULT_MAX_PENDING_EVENTS,
+               checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL,
+               effective_caller_id=None):
+    """Creates an UpdateStreamConsumer.
+
+    Args:
+      conn: a dialed VTGateClient. Its update_stream is called from
+        several threads at once.
+      keyspace_name: the keyspace to stream.
+      tablet_type: the (string) tablet type to stream from.
+      store: the CheckpointStore.
+      shards: the list of shards to stream. Defaults to all the shards
+        of the keyspace for tablet_type.
+      timestamp: where to start the shards without a checkpoint, in
+        seconds since Epoch. Defaults to now.
+      max_pending_events: number of events buffered before the streams
+        stall.
+      checkpoint_interval: how often the checkpoints are saved, in
+        seconds.
+      effective_caller_id: CallerID object.
+    """
+    self.conn = conn
+    self.keyspace_name = keyspace_name
+    self.tablet_type = tablet_type
+    self.store = store
+    self.shards = shards
+    self.timestamp = timestamp
+    self.checkpoint_interval = checkpoint_interval
+    self.effective_caller_id = effective_caller_id
+    self.stats = {}
+    self._queue = Queue.Queue(max_pending_events)
+    self._closed = threading.Event()
+    self._threads = []
+    # Checkpoints of the consumed events, not saved yet.
+    self._dirty = {}
+    self._last_save = time.time()
+
+  def start(self):
+    """Starts streaming all the shards."""
+    if self.shards is None:
+      self.shards = self.conn.get_srv_keyspace(
+          self.keyspace_name).get_shard_names(self.tablet_type)
+    timestamp = self.timestamp or long(time.time())
+    for shard in self.shards:
+      self.stats[shard] = ShardStats(shard)
+      token = self.store.load(self.keyspace_name, shard)
+      t = threading.Thread(target=self._stream_shard,
+                           args=(shard, token, timestamp))
+      t.daemon = True
+      t.start()
+      self._threads.append(t)
+
+  def close(self):
+    """Stops the streams, and saves the checkpoints.
+
+    The threads waiting for an event on a quiet stream stop at the next
+    event, or when the RPC times out, they are only waited for up to
+    _CLOSE_TIMEOUT.
+    """
+    self._closed.set()
+    deadline = time.time() + _CLOSE_TIMEOUT
+    for t in self._threads:
+      t.join(max(0, deadline - time.time()))
+    self.save_checkpoints()
+
+  def save_checkpoints(self):
+    """Saves the checkpoints of the events consumed so far."""
+    self._last_save = time.time()
+    if not self._dirty:
+      return
+    dirty = self._dirty
+    self._dirty = {}
+    self.store.save(self.keyspace_name, dirty)
+
+  def events(self, timeout=None):
+    """Yields the events of all the shards, as they arrive.
+
+    The checkpoint of an event is recorded when the next one is asked
+    for, and saved every checkpoint_interval.
+
+    Args:
+      timeout: if set, stop when no event arrived for that many seconds.
+
+    Yields:
+      (shard, event) pairs, event being a query_pb2.StreamEvent.
+    """
+    consumed = None
+    last_event_time = time.time()
+    while not self._closed.is_set():
+      if consumed and consumed[1].event_token.position:
+        self._dirty[consumed[0]] = consumed[1].event_token
+      consumed = None
+      if time.time() - self._last_save >= self.checkpoint_interval:
+        self.save_checkpoints()
+      try:
+        consumed = self._queue.get(timeout=_POLL_INTERVAL)
+      except Queue.Empty:
+        if timeout is not None and time.time() - last_event_time > timeout:
+          return
+        continue
+      last_event_time = time.time()
+      yield consumed
+
+  def _put(self, item):
+    while not self._closed.is_set():
+      try:
+        self._queue.put(item, timeout=_POLL_INTERVAL)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def _stream_shard(self, shard, token, timestamp):
+    """Streams one shard, reopening the stream until closed."""
+    stats = self.stats[shard]
+    delay = vtgate_utils.INITIAL_DELAY_MS
+    while not self._closed.is_set():
+      if token is not None:
+        event = query_pb2.EventToken(timestamp=token.timestamp,
+                                     shard=shard, position=token.position)
+        kwargs = {'event': event}
+      else:
+        kwargs = {'timestamp': timestamp}
+      stream = None
+      try:
+        stream = self.conn.update_stream(
+            self.keyspace_name, self.tablet_type, shard=shard,
+            effective_caller_id=self.effective_caller_id, **kwargs)
+        for event, resume_timestamp in stream:
+          if not self._put((shard, event)):
+            return
+          stats.events += 1
+          stats.last_timestamp = resume_timestamp
+          if event.event_token.position:
+            token = event.event_token
+          elif resume_timestamp:
+            timestamp = resume_timestamp
+          delay = vtgate_utils.INITIAL_DELAY_MS
+        logging.info('update stream of shard %s ended, reopening', shard)
+      except Exception as e:  # pylint: disable=broad-except
+        stats.last_error = e
+        logging.warning('update stream of shard %s failed: %s, '
+                        'reopening in %d ms', shard, e, delay)
+      finally:
+        if stream is not None:
+          stream.close()
+      stats.reconnects += 1
+      if self._closed.wait(delay / 1000.0):
+        return
+      delay = min(delay * vtgate_utils.BACKOFF_MULTIPLIER,
+                  MAX_RECONNECT_DELAY_MS)
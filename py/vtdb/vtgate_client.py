@@ -75,6 +75,28 @@ class CallerID(object):
     return repr((self.principal, self.component, self.subcomponent))
 
 
+class QuerySplit(object):
+  """One part of a query, as returned by VTGateClient.split_query.
+
+  Exactly one of shards and keyranges is set. The sql uses the :name
+  format for bind variables, and can be run as is with _stream_execute.
+  """
+
+  def __init__(self, sql, bind_variables, keyspace, shards=None,
+               keyranges=None, size=0):
+    self.sql = sql
+    self.bind_variables = bind_variables
+    self.keyspace = keyspace
+    self.shards = shards
+    self.keyranges = keyranges
+    self.size = size
+
+  def __repr__(self):
+    return 'QuerySplit(%r, %r, %r, shards=%r, keyranges=%r, size=%d)' % (
+        self.sql, self.bind_variables, self.keyspace, self.shards,
+        self.keyranges, self.size)
+
+
 class VTGateClient(object):
   """VTGateClient is the interface for the vtgate client implementations.
 
@@ -98,7 +120,8 @@ class VTGateClient(object):
     super(VTGateClient, self).__init__(*pargs, **kwargs)
     self.addr = addr
     self.timeout = timeout
-    # self.session is used by vtgate_utils.exponential_backoff_retry.
+    # self.session is used by vtgate_utils.exponential_backoff_retry
+    # and retry_policy.retry.
     # implementations should use it to store the session object.
     self.session = None
 
@@ -337,10 +360,15 @@ class VTGateClient(object):
         Incompatible with shards, keyspace_ids.
         Requires keyspace.
       effective_caller_id: CallerID object.
-      **kwargs: implementation specific parameters.
+      **kwargs: implementation specific parameters. Implementations
+        that support it take chunked=True, to get an iterator of
+        lists of rows, one list per response, instead of rows, and
+        views=True, to get memoryview cells instead of strings, see
+        proto3_encoding.make_row.
 
     Returns:
-      A (row generator, fields) pair.
+      A (row generator, fields) pair. The cancel() method of the
+      generator, if it has one, cancels the stream from any thread.
 
     Raises:
       dbexceptions.TimeoutError: for connection timeout.
@@ -369,6 +397,41 @@ class VTGateClient(object):
     """
     raise NotImplementedError('Child class needs to implement this')
 
+  def split_query(self, sql, keyspace, bind_variables=None,
+                  split_columns=None, split_count=0,
+                  num_rows_per_query_part=0, algorithm=None,
+                  effective_caller_id=None, **kwargs):
+    """Asks vtgate to split a query into parts that can run in parallel.
+
+    Args:
+      sql: the query to split, of the form SELECT <cols> FROM <table>
+        WHERE <filter>, with bind variables in the :name format.
+      keyspace: the keyspace of the table.
+      bind_variables: map of bind variables for the query.
+      split_columns: list of columns to split on. Defaults to the
+        primary key columns of the table.
+      split_count: approximate number of parts to return.
+        Incompatible with num_rows_per_query_part.
+      num_rows_per_query_part: approximate number of rows per part.
+        Incompatible with split_count.
+      algorithm: a query_pb2.SplitQueryRequest algorithm
+        (EQUAL_SPLITS or FULL_SCAN).
+      effective_caller_id: CallerID object.
+      **kwargs: implementation specific parameters.
+
+    Returns:
+      A list of QuerySplit objects.
+
+    Raises:
+      dbexceptions.TimeoutError: for connection timeout.
+      dbexceptions.TransientError: the server is overloaded, and this query
+        is asked to back off.
+      dbexceptions.DatabaseError: generic database error.
+      dbexceptions.ProgrammingError: the query cannot be split.
+      dbexceptions.FatalError: this query should not be retried.
+    """
+    raise NotImplementedError('Child class needs to implement this')
+
   def update_stream(self,
                     keyspace_name, tablet_type,
                     timestamp=None, event=None,
@@ -403,6 +466,37 @@ class VTGateClient(object):
     """
     raise NotImplementedError('Child class needs to implement this')
 
+  def vstream(self,
+              tablet_type, vgtid,
+              filter_rules=None, batch=False,
+              effective_caller_id=None,
+              **kwargs):
+    """Asks for a VStream of row changes.
+
+    Args:
+      tablet_type: the (string) tablet type to stream from.
+      vgtid: where to start the stream from, a binlogdata_pb2.VGtid or a
+        list of (keyspace, shard, gtid) tuples. gtid can be 'current'.
+      filter_rules: optional list of (match, filter) pairs, to select
+        the tables and columns to stream.
+      batch: if set, return the changes of a transaction at once, per
+        table and per column.
+      effective_caller_id: CallerID object.
+      **kwargs: implementation specific parameters.
+
+    Returns:
+      A generator of proto3_encoding.RowChange objects, or of
+      proto3_encoding.Transaction objects if batch is set.
+
+    Raises:
+      dbexceptions.TimeoutError: for connection timeout.
+      dbexceptions.TransientError: the server is overloaded, and this query
+        is asked to back off.
+      dbexceptions.DatabaseError: generic database error.
+      dbexceptions.FatalError: this query should not be retried.
+    """
+    raise NotImplementedError('Child class needs to implement this')
+
   def message_stream(self,
                      keyspace, name,
                      shard=None, key_range=None,
@@ -458,6 +552,35 @@ class VTGateClient(object):
     """
     raise NotImplementedError('Child class needs to implement this')
 
+  def message_ack_keyspace_ids(self,
+                               name, id_keyspace_ids,
+                               keyspace=None, effective_caller_id=None,
+                               **kwargs):
+    """Acks a list of messages, routed by their keyspace ids.
+
+    Unlike message_ack, this sends the acks only to the shards of the
+    messages.
+
+    Args:
+      name: the name of the message table.
+      id_keyspace_ids: list of (message id, packed keyspace id) pairs.
+      keyspace: the keyspace of the message table.
+        Not required if table can be auto-resolved.
+      effective_caller_id: CallerID object.
+      **kwargs: implementation specific parameters.
+
+    Returns:
+      The number of rows acked.
+
+    Raises:
+      dbexceptions.TimeoutError: for connection timeout.
+      dbexceptions.TransientError: the server is overloaded, and this query
+        is asked to back off.
+      dbexceptions.DatabaseError: generic database error.
+      dbexceptions.FatalError: this query should not be retried.
+    """
+    raise NotImplementedError('Child class needs to implement this')
+
   def get_warnings(self):
     """Get warnings from the previous query
 
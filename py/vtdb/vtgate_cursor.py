@@ -14,15 +14,26 @@
 
 """VTGateCursor, and StreamVTGateCursor."""
 
+import heapq
 import itertools
 import operator
+import Queue
 import re
+import threading
+import time
 
 from vtdb import base_cursor
 from vtdb import dbexceptions
 
 write_sql_pattern = re.compile(r'\s*(insert|update|delete)', re.IGNORECASE)
 
+# DEFAULT_PREFETCH_CHUNKS is the number of decoded response chunks a
+# PrefetchStreamVTGateCursor reads ahead of the consumer.
+DEFAULT_PREFETCH_CHUNKS = 4
+
+# How often a blocked prefetch thread checks if the cursor was closed.
+_PREFETCH_POLL_INTERVAL = 0.1
+
 
 def ascii_lower(string):
   """Lower-case, but only in the ASCII range."""
@@ -80,6 +91,18 @@ class VTGateCursor(base_cursor.BaseListCursor, VTGateCursorMixin):
     self.as_transaction = as_transaction
     self._clear_batch_state()
 
+  def reset(self, connection, tablet_type, **kwargs):
+    """Re-initializes the cursor, as if it was just created.
+
+    This lets callers that create many short-lived cursors reuse them.
+
+    Args:
+      connection: A PEP0249 connection object.
+      tablet_type: Str tablet_type.
+      **kwargs: the other arguments of the constructor.
+    """
+    self.__init__(connection, tablet_type, **kwargs)
+
   # pass kwargs here in case higher level APIs need to push more data through
   # for instance, a key value for shard mapping
   def execute(self, sql, bind_variables, **kwargs):
@@ -145,24 +168,7 @@ class VTGateCursor(base_cursor.BaseListCursor, VTGateCursorMixin):
       Smallest rows, with up to limit items. First len(order_by_columns)
         columns are stripped.
     """
-    sort_columns = []
-    desc_columns = []
-    for order_clause in order_by_columns:
-      if isinstance(order_clause, (tuple, list)):
-        sort_columns.append(order_clause[0])
-        if ascii_lower(order_clause[1]) == 'desc':
-          desc_columns.append(order_clause[0])
-      else:
-        sort_columns.append(order_clause)
-    # sort the rows and then trim off the prepended sort columns
-
-    if sort_columns:
-      sorted_rows = list(sort_row_list_by_columns(
-          self.fetchall(), sort_columns, desc_columns))[:limit]
-    else:
-      sorted_rows = itertools.islice(self.fetchall(), limit)
-    neutered_rows = [row[len(order_by_columns):] for row in sorted_rows]
-    return neutered_rows
+    return _fetch_aggregate(self, order_by_columns, limit)
 
   def _clear_batch_state(self):
     """Clear state that allows traversal to next query's results."""
@@ -231,6 +237,60 @@ class VTGateCursor(base_cursor.BaseListCursor, VTGateCursorMixin):
       return None
 
 
+class ColumnarVTGateCursor(VTGateCursor):
+  """A cursor for execute statements to VTGate, decoding results per column.
+
+  The whole result is decoded at once into one array per column (see
+  proto3_encoding.make_columns), which is a lot cheaper than building
+  a tuple per row for large results. The columns are available as
+  self.columns after execute. The regular fetch methods still work,
+  rows are then assembled from the columns on demand (numeric values
+  are then NumPy scalars).
+  """
+
+  def __init__(self, *pargs, **kwargs):
+    super(ColumnarVTGateCursor, self).__init__(*pargs, **kwargs)
+    self.columns = None
+
+  def execute(self, sql, bind_variables, **kwargs):
+    """Perform a query, return the number of rows affected."""
+    rowcount = super(ColumnarVTGateCursor, self).execute(
+        sql, bind_variables, columnar=True, **kwargs)
+    if self.results is not None:
+      self.columns = self.results
+      self.results = ColumnarRows(self.columns)
+    return rowcount
+
+  def fetchcolumns(self):
+    """Returns the list of columns of the last executed query."""
+    self._check_fetch()
+    return self.columns
+
+  def _clear_list_state(self):
+    super(ColumnarVTGateCursor, self)._clear_list_state()
+    self.columns = None
+
+
+class ColumnarRows(object):
+  """A read-only list of row tuples backed by a list of columns."""
+
+  def __init__(self, columns):
+    self.columns = columns
+
+  def __len__(self):
+    if not self.columns:
+      return 0
+    return len(self.columns[0])
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return zip(*[c[index] for c in self.columns])
+    return tuple(c[index] for c in self.columns)
+
+  def __iter__(self):
+    return iter(zip(*self.columns))
+
+
 class StreamVTGateCursor(base_cursor.BaseStreamCursor, VTGateCursorMixin):
 
   """A cursor for streaming statements to VTGate.
@@ -275,6 +335,318 @@ class StreamVTGateCursor(base_cursor.BaseStreamCursor, VTGateCursorMixin):
         **kwargs)
     return 0
 
+  def fetch_aggregate(self, order_by_columns, limit):
+    """Stream from many shards, keep the first rows, remove sort columns.
+
+    Same as VTGateCursor.fetch_aggregate, but only limit rows are
+    kept in memory while the stream is read.
+
+    Args:
+      order_by_columns: The ORDER BY clause. Each element is either a
+        column, [column, 'ASC'], or [column, 'DESC'].
+      limit: Int limit.
+
+    Returns:
+      Smallest rows, with up to limit items. First len(order_by_columns)
+        columns are stripped.
+    """
+    return _fetch_aggregate(self, order_by_columns, limit)
+
+
+class PrefetchStreamVTGateCursor(StreamVTGateCursor):
+  """A StreamVTGateCursor that reads and decodes ahead of the consumer.
+
+  A background thread reads the responses of the stream, and decodes
+  them into chunks of rows, while the consumer works on the previous
+  chunks. Up to prefetch_chunks chunks are buffered, after which the
+  thread stops reading until the consumer catches up.
+
+  fetchmany() without a size returns a whole decoded chunk, which is
+  the cheapest way to consume the stream.
+
+  The cursor measures how long each side waited for the other, see
+  prefetch_stats(): a consumer that stalls a lot is network (or
+  decode) bound, a prefetch thread that stalls a lot means the
+  consumer is the bottleneck.
+  """
+
+  def __init__(self, *pargs, **kwargs):
+    self.prefetch_chunks = kwargs.pop(
+        'prefetch_chunks', DEFAULT_PREFETCH_CHUNKS)
+    self._stream = None
+    super(PrefetchStreamVTGateCursor, self).__init__(*pargs, **kwargs)
+
+  def _clear_stream_state(self):
+    if self._stream:
+      # Unblocks the prefetch thread, which closes the stream on its
+      # way out.
+      self._stream.stop.set()
+      cancel = getattr(self._stream.chunks, 'cancel', None)
+      if cancel:
+        cancel()
+    super(PrefetchStreamVTGateCursor, self)._clear_stream_state()
+    self._stream = None
+    self._chunk = []
+    self._position = 0
+    self._done = True
+    self.chunks = 0
+    self.stall_time = 0.0
+
+  @property
+  def prefetch_stall_time(self):
+    """Seconds the prefetch thread of the current stream waited."""
+    if self._stream is None:
+      return 0.0
+    return self._stream.stall_time
+
+  def execute(self, sql, bind_variables, **kwargs):
+    """Starts a streaming query, and the prefetch thread."""
+    super(PrefetchStreamVTGateCursor, self).execute(
+        sql, bind_variables, chunked=True, **kwargs)
+    # Only the prefetch thread uses the generator from now on.
+    self._stream = _PrefetchStream(self.generator, self.prefetch_chunks)
+    self.generator = None
+    self._done = False
+    t = threading.Thread(target=self._prefetch, args=(self._stream,))
+    t.daemon = True
+    t.start()
+    return 0
+
+  def _prefetch(self, stream):
+    """Reads the chunks of the stream into its queue, until stopped."""
+    try:
+      for chunk in stream.chunks:
+        if not stream.put((chunk, None)):
+          return
+      stream.put((None, None))
+    except Exception as e:  # pylint: disable=broad-except
+      stream.put((None, e))
+    finally:
+      stream.chunks.close()
+
+  def _next_chunk(self):
+    """Waits for the next chunk. Returns False at the end of the stream."""
+    if self.description is None:
+      raise dbexceptions.ProgrammingError('Fetch called before execute.')
+    if self._done:
+      return False
+    start = time.time()
+    chunk, error = self._stream.queue.get()
+    self.stall_time += time.time() - start
+    if chunk is None:
+      self._done = True
+      if error is not None:
+        raise error
+      return False
+    self._chunk = chunk
+    self._position = 0
+    self.chunks += 1
+    return True
+
+  def fetchone(self):
+    while self._position >= len(self._chunk):
+      if not self._next_chunk():
+        return None
+    row = self._chunk[self._position]
+    self._position += 1
+    self.index += 1
+    return row
+
+  def fetchmany(self, size=None):
+    """Returns up to size rows, or the next decoded chunk if size is None.
+
+    Args:
+      size: the maximum number of rows to return.
+
+    Returns:
+      A list of rows, empty at the end of the stream.
+    """
+    result = []
+    while size is None or len(result) < size:
+      if self._position >= len(self._chunk):
+        if result and size is None:
+          break
+        if not self._next_chunk():
+          break
+      if size is None:
+        end = len(self._chunk)
+      else:
+        end = min(len(self._chunk), self._position + size - len(result))
+      if self._position == 0 and end == len(self._chunk) and not result:
+        result = self._chunk
+      else:
+        result.extend(self._chunk[self._position:end])
+      self._position = end
+    self.index += len(result)
+    return result
+
+  def fetchall(self):
+    result = []
+    while True:
+      rows = self.fetchmany()
+      if not rows:
+        return result
+      result.extend(rows)
+
+  def prefetch_stats(self):
+    """Returns the chunk count and the stall times of the current stream.
+
+    Returns:
+      A dict with:
+        chunks: the number of chunks fetched so far.
+        stall_time: seconds the consumer waited for a chunk.
+        prefetch_stall_time: seconds the prefetch thread waited for
+          room in the buffer.
+    """
+    return {
+        'chunks': self.chunks,
+        'stall_time': self.stall_time,
+        'prefetch_stall_time': self.prefetch_stall_time,
+    }
+
+
+class _PrefetchStream(object):
+  """One stream of a PrefetchStreamVTGateCursor, and its prefetch state.
+
+  A new stream gets a new object, so the thread of a previous stream
+  cannot add to its queue or its stall time.
+  """
+
+  def __init__(self, chunks, max_chunks):
+    self.chunks = chunks
+    self.queue = Queue.Queue(max_chunks)
+    self.stop = threading.Event()
+    # stall_time is the time the prefetch thread waited for room in the
+    # queue.
+    self.stall_time = 0.0
+
+  def put(self, item):
+    """Puts an item in the queue. Returns False if the stream stopped."""
+    start = time.time()
+    try:
+      while not self.stop.is_set():
+        try:
+          self.queue.put(item, timeout=_PREFETCH_POLL_INTERVAL)
+          return True
+        except Queue.Full:
+          pass
+      return False
+    finally:
+      self.stall_time += time.time() - start
+
+
+def _fetch_aggregate(cursor, order_by_columns, limit):
+  """Implements fetch_aggregate for both cursor types."""
+  rows = iter(cursor.fetchone, None)
+  if order_by_columns:
+    sorted_rows = top_n_rows(rows, order_by_columns, limit)
+  else:
+    sorted_rows = itertools.islice(rows, limit)
+  # trim off the prepended sort columns
+  return [row[len(order_by_columns):] for row in sorted_rows]
+
+
+class SortKey(object):
+  """Composite sort key over the leading columns of a row.
+
+  Each column is compared ascending or descending, according to its
+  flag in desc, so rows can be ordered by mixed ASC / DESC columns
+  with a single comparison.
+  """
+
+  __slots__ = ('values', 'desc')
+
+  def __init__(self, values, desc):
+    self.values = values
+    self.desc = desc
+
+  def __lt__(self, other):
+    for value, other_value, desc in zip(self.values, other.values,
+                                        self.desc):
+      if value == other_value:
+        continue
+      if desc:
+        return other_value < value
+      return value < other_value
+    return False
+
+  def __eq__(self, other):
+    return self.values == other.values
+
+  def __ne__(self, other):
+    return self.values != other.values
+
+
+def sort_key_func(order_by_columns):
+  """Returns a function building the SortKey of a row.
+
+  Args:
+    order_by_columns: The ORDER BY clause. Each element is either a
+      column, [column, 'ASC'], or [column, 'DESC']. The sort columns
+      are the first len(order_by_columns) columns of each row.
+
+  Returns:
+    A function that takes a row and returns its SortKey.
+  """
+  desc = tuple(
+      isinstance(order_clause, (tuple, list)) and
+      ascii_lower(order_clause[1]) == 'desc'
+      for order_clause in order_by_columns)
+  n = len(desc)
+  return lambda row: SortKey(row[:n], desc)
+
+
+def top_n_rows(rows, order_by_columns, limit):
+  """Returns the first limit rows of rows, in ORDER BY order.
+
+  rows can be any iterable, only limit rows are kept in memory.
+  Equal rows keep their relative order.
+
+  Args:
+    rows: iterable of rows, starting with the sort columns.
+    order_by_columns: see sort_key_func.
+    limit: Int limit.
+
+  Returns:
+    The sorted list of up to limit rows.
+  """
+  return heapq.nsmallest(limit, rows, key=sort_key_func(order_by_columns))
+
+
+def merge_sorted_rows(row_streams, order_by_columns, limit=None):
+  """K-way merge of row streams that are each sorted by order_by_columns.
+
+  For instance, the row_streams can be StreamVTGateCursor objects that
+  each ran the same ORDER BY query on a different shard. Only one row
+  per stream is kept in memory.
+
+  Args:
+    row_streams: list of iterables of sorted rows.
+    order_by_columns: see sort_key_func.
+    limit: optional maximum number of rows to return.
+
+  Yields:
+    The rows of all the streams, in ORDER BY order.
+  """
+  key = sort_key_func(order_by_columns)
+  heap = []
+  for index, stream in enumerate(row_streams):
+    it = iter(stream)
+    for row in it:
+      heap.append((key(row), index, row, it))
+      break
+  heapq.heapify(heap)
+  count = 0
+  while heap and (limit is None or count < limit):
+    _, index, row, it = heap[0]
+    yield row
+    count += 1
+    for next_row in it:
+      heapq.heapreplace(heap, (key(next_row), index, next_row, it))
+      break
+    else:
+      heapq.heappop(heap)
+
 
 def sort_row_list_by_columns(row_list, sort_columns=(), desc_columns=()):
   """Sort by leading sort columns by stable-sorting in reverse-index order."""
@@ -0,0 +1,496 @@
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A pool of vtgate connections, load balanced across several vtgates.
+
+A VTGatePool keeps a few dialed connections (and so, for gRPC, warm
+channels) to every configured vtgate. Each call is sent to the healthy
+vtgate with the fewest calls in flight. A vtgate that keeps returning
+transient errors is ejected for a while, and then gets a single probe
+call: if it succeeds, the vtgate is healthy again, if it fails, it is
+ejected for twice as long.
+
+Transactions are pinned: begin() checks out one connection, and all the
+calls up to commit() or rollback() go to it.
+
+Usage:
+  pool = vtgate_pool.connect('grpc', ['vtgate1:15991', 'vtgate2:15991'], 30.0)
+  cursor = pool.cursor(tablet_type='replica', keyspace='user')
+"""
+
+import logging
+import Queue
+import random
+import threading
+import time
+
+from vtdb import dbexceptions
+from vtdb import vtgate_client
+
+# DEFAULT_SIZE is the number of connections kept per vtgate.
+DEFAULT_SIZE = 4
+
+# Ejection parameters. A vtgate is ejected after EJECT_AFTER consecutive
+# failures, for EJECT_INTERVAL seconds, doubled after each failed probe,
+# up to MAX_EJECT_INTERVAL.
+EJECT_AFTER = 3
+EJECT_INTERVAL = 1.0
+MAX_EJECT_INTERVAL = 30.0
+
+# The errors that count as a vtgate failure.
+EJECT_EXCEPTIONS = (dbexceptions.TransientError, dbexceptions.TimeoutError)
+
+# Endpoint states.
+HEALTHY = 'healthy'
+EJECTED = 'ejected'
+PROBING = 'probing'
+
+
+def connect(protocol, vtgate_addrs, timeout, *pargs, **kwargs):
+  """Returns a dialed VTGatePool, see vtgate_client.connect for the args.
+
+  Args:
+    protocol: the registered protocol to use.
+    vtgate_addrs: list of vtgate server addresses to connect to.
+    timeout: connection timeout, float in seconds.
+    *pargs: passed to the VTGatePool constructor.
+    **kwargs: passed to the VTGatePool constructor.
+
+  Returns:
+    A dialed VTGatePool.
+  """
+  pool = VTGatePool(protocol, vtgate_addrs, timeout, *pargs, **kwargs)
+  pool.dial()
+  return pool
+
+
+class Endpoint(object):
+  """A vtgate address, its idle connections and its health."""
+
+  def __init__(self, addr):
+    self.addr = addr
+    self.connections = []
+    self.idle = Queue.Queue()
+    self.in_flight = 0
+    self.state = HEALTHY
+    self.consecutive_failures = 0
+    self.eject_interval = EJECT_INTERVAL
+    self.ejected_until = 0
+    self.calls = 0
+    self.failures = 0
+
+  def stats(self):
+    return {
+        'addr': self.addr,
+        'state': self.state,
+        'in_flight': self.in_flight,
+        'calls': self.calls,
+        'failures': self.failures,
+    }
+
+
+class _ReleasingStream(object):
+  """Iterates a stream of a pooled connection, and releases it when done.
+
+  The connection is released at the end of the stream, on its first
+  error, or when the stream is closed or cancelled. cancel() is
+  forwarded to the stream, if it has one, so that the RPC is cancelled.
+  """
+
+  def __init__(self, stream, release):
+    self.stream = stream
+    self._it = iter(stream)
+    self._release = release
+    self._released = False
+    self._lock = threading.Lock()
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    try:
+      return self._it.next()
+    except StopIteration:
+      self._done()
+      raise
+    except Exception as e:
+      self._done(e)
+      raise
+
+  def close(self):
+    close = getattr(self.stream, 'close', None)
+    try:
+      if close:
+        close()
+    finally:
+      self._done()
+
+  def cancel(self):
+    """Cancels the stream, and releases the connection right away."""
+    cancel = getattr(self.stream, 'cancel', None)
+    try:
+      if cancel:
+        cancel()
+    finally:
+      self._done()
+
+  def _done(self, error=None):
+    with self._lock:
+      if self._released:
+        return
+      self._released = True
+    self._release(error)
+
+  def __del__(self):
+    # As a generator would, releases the connection of an abandoned
+    # stream.
+    self._done()
+
+
+class VTGatePool(vtgate_client.VTGateClient):
+  """A VTGateClient that balances calls over connections to many vtgates.
+
+  The pool is thread-safe for calls outside a transaction. As with a
+  single connection, the transaction state is per object.
+  """
+
+  def __init__(self, protocol, vtgate_addrs, timeout, size=DEFAULT_SIZE,
+               eject_after=EJECT_AFTER, eject_interval=EJECT_INTERVAL,
+               max_eject_interval=MAX_EJECT_INTERVAL,
+               eject_exceptions=EJECT_EXCEPTIONS, **kwargs):
+    """Creates a new VTGatePool.
+
+    Args:
+      protocol: the registered protocol to use.
+      vtgate_addrs: single address or list of vtgate addresses.
+      timeout: connection timeout, float in seconds.
+      size: number of connections to keep per vtgate.
+      eject_after: consecutive failures before a vtgate is ejected.
+      eject_interval: initial ejection time, in seconds.
+      max_eject_interval: maximum ejection time, in seconds.
+      eject_exceptions: tuple of exceptions that count as a failure.
+      **kwargs: passed to the connection class constructor.
+
+    Raises:
+      ValueError: if the protocol is unknown or there is no address.
+    """
+    if protocol not in vtgate_client.vtgate_client_conn_classes:
+      raise ValueError('Unknown vtgate_client protocol', protocol)
+    if isinstance(vtgate_addrs, basestring):
+      vtgate_addrs = [vtgate_addrs]
+    if not vtgate_addrs:
+      raise ValueError('No vtgate address to connect to')
+    # The (endpoint, connection) pair pinned by the current transaction.
+    # Set first, the base class constructor assigns self.session.
+    self._pinned = None
+    super(VTGatePool, self).__init__(vtgate_addrs, timeout)
+    self.conn_class = vtgate_client.vtgate_client_conn_classes[protocol]
+    self.conn_kwargs = kwargs
+    self.size = size
+    self.eject_after = eject_after
+    self.eject_interval = eject_interval
+    self.max_eject_interval = max_eject_interval
+    self.eject_exceptions = eject_exceptions
+    self.endpoints = [Endpoint(addr) for addr in vtgate_addrs]
+    self._lock = threading.Lock()
+    self._closed = True
+
+  @property
+  def session(self):
+    if self._pinned:
+      return self._pinned[1].session
+    return None
+
+  @session.setter
+  def session(self, value):
+    if self._pinned:
+      self._pinned[1].session = value
+
+  def dial(self):
+    """Dials size connections to every vtgate."""
+    for endpoint in self.endpoints:
+      if not endpoint.connections:
+        for _ in xrange(self.size):
+          conn = self.conn_class(endpoint.addr, self.timeout,
+                                 **self.conn_kwargs)
+          endpoint.connections.append(conn)
+          endpoint.idle.put(conn)
+      for conn in endpoint.connections:
+        conn.dial()
+    self._closed = False
+
+  def close(self):
+    if self._pinned:
+      try:
+        self.rollback()
+      except dbexceptions.DatabaseError:
+        pass
+    for endpoint in self.endpoints:
+      for conn in endpoint.connections:
+        conn.close()
+    self._closed = True
+
+  def is_closed(self):
+    return self._closed
+
+  def stats(self):
+    """Returns a list of per-vtgate stats dicts."""
+    with self._lock:
+      return [endpoint.stats() for endpoint in self.endpoints]
+
+  def _pick_endpoint(self, exclude):
+    """Returns the least loaded available endpoint, not in exclude.
+
+    Ejected endpoints whose ejection time is over are moved to the
+    probing state, and then get a single call until it completes.
+
+    Args:
+      exclude: endpoints that already failed this call.
+
+    Returns:
+      An Endpoint, with its in_flight count incremented.
+
+    Raises:
+      dbexceptions.OperationalError: if no vtgate is available.
+    """
+    now = time.time()
+    with self._lock:
+      candidates = []
+      for endpoint in self.endpoints:
+        if endpoint in exclude:
+          continue
+        if endpoint.state == EJECTED and now >= endpoint.ejected_until:
+          if endpoint.in_flight == 0:
+            endpoint.state = PROBING
+            candidates = [endpoint]
+            break
+        if endpoint.state == HEALTHY:
+          candidates.append(endpoint)
+      if not candidates:
+        raise dbexceptions.OperationalError(
+            'no healthy vtgate available', [e.addr for e in self.endpoints])
+      least = min(e.in_flight for e in candidates)
+      endpoint = random.choice(
+          [e for e in candidates if e.in_flight == least])
+      endpoint.in_flight += 1
+      endpoint.calls += 1
+      return endpoint
+
+  def _release(self, endpoint, error=None):
+    """Records the outcome of a call on an endpoint.
+
+    Args:
+      endpoint: the Endpoint the call went to.
+      error: the exception the call raised, if any.
+    """
+    with self._lock:
+      endpoint.in_flight -= 1
+      if error is None or not isinstance(error, self.eject_exceptions):
+        endpoint.consecutive_failures = 0
+        if endpoint.state == PROBING:
+          logging.info('vtgate %s is healthy again', endpoint.addr)
+          endpoint.state = HEALTHY
+          endpoint.eject_interval = self.eject_interval
+        return
+      endpoint.failures += 1
+      endpoint.consecutive_failures += 1
+      if endpoint.state == PROBING:
+        endpoint.eject_interval = min(endpoint.eject_interval * 2,
+                                      self.max_eject_interval)
+      elif (endpoint.state == HEALTHY and
+            endpoint.consecutive_failures >= self.eject_after):
+        endpoint.eject_interval = self.eject_interval
+      else:
+        return
+      logging.warning('ejecting vtgate %s for %.1fs after %d failures: %s',
+                      endpoint.addr, endpoint.eject_interval,
+                      endpoint.consecutive_failures, error)
+      endpoint.state = EJECTED
+      endpoint.ejected_until = time.time() + endpoint.eject_interval
+
+  def _checkout(self, exclude):
+    endpoint = self._pick_endpoint(exclude)
+    try:
+      conn = endpoint.idle.get(timeout=self.timeout)
+    except Queue.Empty:
+      self._release(endpoint)
+      raise dbexceptions.TimeoutError(
+          'no idle connection to vtgate', endpoint.addr)
+    return endpoint, conn
+
+  def _checkin(self, endpoint, conn, error=None):
+    # Outside a transaction, the session carries nothing we want to
+    # leak into the next call that uses this connection.
+    if conn.session and not conn.session.in_transaction:
+      conn.session = None
+    endpoint.idle.put(conn)
+    self._release(endpoint, error)
+
+  def checkout(self):
+    """Checks out a connection of the least loaded vtgate.
+
+    The caller owns the connection until it gives it back with checkin.
+    This is used to run several transactions at once on the same pool,
+    see transaction_manager.
+
+    Returns:
+      An (endpoint, connection) pair.
+    """
+    return self._checkout([])
+
+  def checkin(self, endpoint, conn, error=None):
+    """Gives back a connection returned by checkout.
+
+    Args:
+      endpoint: the endpoint returned by checkout.
+      conn: the connection returned by checkout.
+      error: the exception the last call raised, if any.
+    """
+    self._checkin(endpoint, conn, error)
+
+  def _call(self, method_name, *pargs, **kwargs):
+    """Calls a method on the pinned or the least loaded connection.
+
+    Outside a transaction, a call that fails with one of eject_exceptions
+    is tried again on the other vtgates.
+
+    Args:
+      method_name: name of the connection method to call.
+      *pargs: passed to the method.
+      **kwargs: passed to the method.
+
+    Returns:
+      The method result.
+    """
+    if self._pinned:
+      return getattr(self._pinned[1], method_name)(*pargs, **kwargs)
+    tried = []
+    while True:
+      endpoint, conn = self._checkout(tried)
+      try:
+        result = getattr(conn, method_name)(*pargs, **kwargs)
+      except self.eject_exceptions as e:
+        self._checkin(endpoint, conn, e)
+        tried.append(endpoint)
+        if len(tried) >= len(self.endpoints):
+          raise
+        continue
+      except Exception as e:
+        self._checkin(endpoint, conn, e)
+        raise
+      self._checkin(endpoint, conn)
+      return result
+
+  def _call_generator(self, method_name, *pargs, **kwargs):
+    """Same as _call for methods returning a (generator, fields) pair.
+
+    The connection is only released once the stream is done, closed or
+    cancelled.
+
+    Args:
+      method_name: name of the connection method to call.
+      *pargs: passed to the method.
+      **kwargs: passed to the method.
+
+    Returns:
+      The method result, with a wrapped generator.
+    """
+    if self._pinned:
+      return getattr(self._pinned[1], method_name)(*pargs, **kwargs)
+    tried = []
+    while True:
+      endpoint, conn = self._checkout(tried)
+      try:
+        result = getattr(conn, method_name)(*pargs, **kwargs)
+        break
+      except self.eject_exceptions as e:
+        self._checkin(endpoint, conn, e)
+        tried.append(endpoint)
+        if len(tried) >= len(self.endpoints):
+          raise
+      except Exception as e:
+        self._checkin(endpoint, conn, e)
+        raise
+
+    def release(error):
+      self._checkin(endpoint, conn, error)
+
+    if isinstance(result, tuple):
+      return (_ReleasingStream(result[0], release),) + result[1:]
+    return _ReleasingStream(result, release)
+
+  def begin(self, effective_caller_id=None, single_db=False):
+    if self._pinned:
+      raise dbexceptions.ProgrammingError('Already in a transaction')
+    endpoint, conn = self._checkout([])
+    try:
+      conn.begin(effective_caller_id=effective_caller_id, single_db=single_db)
+    except Exception as e:
+      self._checkin(endpoint, conn, e)
+      raise
+    self._pinned = (endpoint, conn)
+
+  def _unpin(self, method_name, *pargs):
+    if not self._pinned:
+      raise dbexceptions.ProgrammingError('Not in a transaction')
+    endpoint, conn = self._pinned
+    self._pinned = None
+    error = None
+    try:
+      return getattr(conn, method_name)(*pargs)
+    except Exception as e:
+      error = e
+      raise
+    finally:
+      self._checkin(endpoint, conn, error)
+
+  def commit(self, twopc=False):
+    return self._unpin('commit', twopc)
+
+  def rollback(self):
+    return self._unpin('rollback')
+
+  def _execute(self, *pargs, **kwargs):
+    return self._call('_execute', *pargs, **kwargs)
+
+  def _execute_batch(self, *pargs, **kwargs):
+    return self._call('_execute_batch', *pargs, **kwargs)
+
+  def _stream_execute(self, *pargs, **kwargs):
+    return self._call_generator('_stream_execute', *pargs, **kwargs)
+
+  def get_srv_keyspace(self, keyspace):
+    return self._call('get_srv_keyspace', keyspace)
+
+  def split_query(self, *pargs, **kwargs):
+    return self._call('split_query', *pargs, **kwargs)
+
+  def update_stream(self, *pargs, **kwargs):
+    return self._call_generator('update_stream', *pargs, **kwargs)
+
+  def vstream(self, *pargs, **kwargs):
+    return self._call_generator('vstream', *pargs, **kwargs)
+
+  def message_stream(self, *pargs, **kwargs):
+    return self._call_generator('message_stream', *pargs, **kwargs)
+
+  def message_ack(self, *pargs, **kwargs):
+    return self._call('message_ack', *pargs, **kwargs)
+
+  def message_ack_keyspace_ids(self, *pargs, **kwargs):
+    return self._call('message_ack_keyspace_ids', *pargs, **kwargs)
+
+  def get_warnings(self):
+    if self._pinned:
+      return self._pinned[1].get_warnings()
+    return []
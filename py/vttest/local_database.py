@@ -12,17 +12,96 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Create a local Vitess database for testing."""
+"""Create a local Vitess database for testing.
+
+In fast start mode, the schema is loaded into all the shards in parallel,
+and vtcombo is started while the random data is loaded into MySQL.
+
+With a data cache directory, the MySQL data directory is saved there once
+it is initialized, under a hash of the topology, schema, random data
+options and MySQL settings. The next runs with the same hash restore it,
+instead of creating the databases, loading the schema and the data.
+"""
 
 import glob
+import hashlib
 import logging
 import os
-import random
-import re
+import Queue
+import shutil
+import tempfile
+import threading
+
+from google.protobuf import text_format
 
 from vttest import environment
+from vttest import random_data
 from vttest import vt_processes
 
+# DEFAULT_NUM_THREADS is the number of shards loaded at once in fast
+# start mode.
+DEFAULT_NUM_THREADS = 8
+
+
+def run_in_parallel(func, args_list, num_threads=DEFAULT_NUM_THREADS):
+  """Calls func with each args tuple, from up to num_threads threads.
+
+  Args:
+    func: the function to call.
+    args_list: list of tuples of arguments.
+    num_threads: the maximum number of concurrent calls.
+
+  Raises:
+    Exception: the first exception raised by a call, once all are done.
+  """
+  queue = Queue.Queue()
+  for args in args_list:
+    queue.put(args)
+  errors = []
+
+  def work():
+    while True:
+      try:
+        args = queue.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        func(*args)
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception('%s%r failed', func.__name__, args)
+        errors.append(e)
+
+  threads = [threading.Thread(target=work)
+             for _ in xrange(min(num_threads, len(args_list)))]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  if errors:
+    raise errors[0]
+
+
+class _BackgroundCall(object):
+  """Runs a function in a thread, join() raises its exception if any."""
+
+  def __init__(self, func):
+    self.error = None
+    self.thread = threading.Thread(target=self._run, args=(func,))
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _run(self, func):
+    try:
+      func()
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception('%s failed', func.__name__)
+      self.error = e
+
+  def join(self):
+    self.thread.join()
+    if self.error:
+      raise self.error  # pylint: disable=raising-bad-type
+
 
 class LocalDatabase(object):
   """Set up a local Vitess database."""
@@ -37,7 +116,9 @@ class LocalDatabase(object):
                extra_my_cnf=None,
                web_dir2=None,
                snapshot_file=None,
-               charset='utf8'):
+               charset='utf8',
+               fast_start=False,
+               data_cache_dir=None):
     """Initializes an object of this class.
 
     Args:
@@ -59,6 +140,11 @@ class LocalDatabase(object):
           flag in run_local_database.py
       snapshot_file: A MySQL DB snapshot file.
       charset: MySQL charset.
+      fast_start: if set, loads the schema of the shards in parallel, and
+          starts vtcombo while the random data is loaded.
+      data_cache_dir: if set, the initialized MySQL data directory is
+          saved there, and restored by the next runs, see the module doc.
+          Not used with snapshot_file.
     """
 
     self.topology = topology
@@ -71,6 +157,8 @@ class LocalDatabase(object):
     self.web_dir2 = web_dir2
     self.snapshot_file = snapshot_file
     self.charset = charset
+    self.fast_start = fast_start
+    self.data_cache_dir = data_cache_dir
 
   def setup(self):
     """Create a MySQL instance and all Vitess processes."""
@@ -79,20 +167,80 @@ class LocalDatabase(object):
     self.mysql_db = environment.mysql_db_class(
         self.directory, mysql_port, self.extra_my_cnf, self.snapshot_file)
 
-    self.mysql_db.setup()
-    if not self.snapshot_file:
-      self.create_databases()
-      self.load_schema()
+    cache_path = None
+    if self.data_cache_dir and not self.snapshot_file:
+      cache_path = os.path.join(self.data_cache_dir, self.data_cache_key())
+    loader = None
+    if cache_path and os.path.isdir(cache_path):
+      logging.info('Restoring the MySQL data directory from %s', cache_path)
+      self.mysql_db.setup_from_snapshot(cache_path)
+    else:
+      self.mysql_db.setup()
+      if not self.snapshot_file:
+        self.create_databases()
+        self.load_schema()
+      if self.init_data_options is not None:
+        if self.fast_start and not cache_path and not self.mysql_only:
+          # vtcombo only needs the schema to start.
+          loader = _BackgroundCall(self.populate_with_random_data)
+        else:
+          self.populate_with_random_data()
+      if cache_path:
+        self.save_data_cache(cache_path)
+    try:
+      if not self.mysql_only:
+        vt_processes.start_vt_processes(
+            self.directory, self.topology, self.mysql_db, self.schema_dir,
+            charset=self.charset, web_dir=self.web_dir,
+            web_dir2=self.web_dir2)
+    finally:
+      if loader:
+        loader.join()
+
+  def data_cache_key(self):
+    """Returns the hash of what the initialized MySQL data depends on."""
+    h = hashlib.sha1()
+    h.update(text_format.MessageToString(self.topology))
+    h.update(repr((type(self.mysql_db).__name__,
+                   os.environ.get('MYSQL_FLAVOR'), self.extra_my_cnf,
+                   self.charset)))
     if self.init_data_options is not None:
-      self.rng = random.Random(self.init_data_options.rng_seed)
-      self.populate_with_random_data()
-    if self.mysql_only:
-      return
+      h.update(repr(sorted(vars(self.init_data_options).items())))
+    for schema_dir in (self.schema_dir, self.default_schema_dir):
+      if not schema_dir or not os.path.isdir(schema_dir):
+        h.update('-')
+        continue
+      for root, dirs, files in os.walk(schema_dir):
+        dirs.sort()
+        for name in sorted(files):
+          path = os.path.join(root, name)
+          h.update(os.path.relpath(path, schema_dir))
+          with open(path, 'rb') as f:
+            h.update(hashlib.sha1(f.read()).digest())
+    return h.hexdigest()
 
-    vt_processes.start_vt_processes(self.directory, self.topology,
-                                    self.mysql_db, self.schema_dir,
-                                    charset=self.charset, web_dir=self.web_dir,
-                                    web_dir2=self.web_dir2)
+  def save_data_cache(self, cache_path):
+    """Saves the MySQL data directory to cache_path, if not there yet.
+
+    Concurrent runs can save the same entry, the first one wins.
+
+    Args:
+      cache_path: the entry of the data cache.
+    """
+    if not os.path.isdir(self.data_cache_dir):
+      os.makedirs(self.data_cache_dir)
+    tmp_dir = tempfile.mkdtemp(dir=self.data_cache_dir, prefix='.tmp')
+    try:
+      tmp_path = os.path.join(tmp_dir, 'snapshot')
+      logging.info('Saving the MySQL data directory to %s', cache_path)
+      self.mysql_db.save_snapshot(tmp_path)
+      try:
+        os.rename(tmp_path, cache_path)
+      except OSError:
+        if not os.path.isdir(cache_path):
+          raise
+    finally:
+      shutil.rmtree(tmp_dir, ignore_errors=True)
 
   def teardown(self):
     """Kill all Vitess processes and wait for them to end.
@@ -185,6 +333,8 @@ class LocalDatabase(object):
     if not os.path.isdir(self.schema_dir):
       raise Exception('schema_dir "%s" is not a directory.' % self.schema_dir)
 
+    # List of (db_name, list of (filepath, commands)) to run.
+    shard_files = []
     for kpb in self.topology.keyspaces:
       if kpb.served_from:
         # redirected keyspaces have no underlying database
@@ -207,21 +357,42 @@ class LocalDatabase(object):
               (self.schema_dir, keyspace, self.default_schema_dir,
                keyspace_dir))
 
-      for filepath in glob.glob(os.path.join(schema_dir, '*.sql')):
-        logging.info('Loading schema for keyspace %s from file %s',
-                     keyspace, filepath)
-        cmds = self.get_sql_commands_from_file(filepath, schema_dir)
+      files = [(filepath, self.get_sql_commands_from_file(filepath,
+                                                          schema_dir))
+               for filepath in glob.glob(os.path.join(schema_dir, '*.sql'))]
+
+      # Run the cmds on each shard and cell in the keyspace.
+      for spb in kpb.shards:
+        db_name = spb.db_name_override
+        if not db_name:
+          db_name = 'vt_%s_%s' % (kpb.name, spb.name)
+        shard_files.append((db_name, files))
+
+    if self.fast_start:
+      run_in_parallel(self.load_shard_schema, shard_files)
+    else:
+      for db_name, files in shard_files:
+        self.load_shard_schema(db_name, files)
+
+  def load_shard_schema(self, db_name, files):
+    """Runs the commands of schema files on a shard database.
 
-        # Run the cmds on each shard and cell in the keyspace.
-        for spb in kpb.shards:
-          db_name = spb.db_name_override
-          if not db_name:
-            db_name = 'vt_%s_%s' % (kpb.name, spb.name)
-          self.mysql_execute(cmds, db_name=db_name)
+    Args:
+      db_name: The shard database name (string).
+      files: list of (filepath, list of SQL commands), run in order.
+    """
+    for filepath, cmds in files:
+      logging.info('Loading schema for database %s from file %s',
+                   db_name, filepath)
+      self.mysql_execute(cmds, db_name=db_name)
 
   def populate_with_random_data(self):
-    """Populates all shards with randomly generated data."""
+    """Populates all shards with randomly generated data.
 
+    The tables of all the shards are populated in parallel.
+    """
+
+    jobs = []
     for kpb in self.topology.keyspaces:
       if kpb.served_from:
         # redirected keyspaces have no underlying database
@@ -231,7 +402,11 @@ class LocalDatabase(object):
         db_name = spb.db_name_override
         if not db_name:
           db_name = 'vt_%s_%s' % (kpb.name, spb.name)
-        self.populate_shard_with_random_data(db_name)
+        tables = self.mysql_execute(['SHOW TABLES'], db_name)
+        jobs.extend((db_name, table[0]) for table in tables)
+    if jobs:
+      self.mysql_execute(['SET GLOBAL local_infile = 1'])
+    run_in_parallel(self.populate_table_with_random_data, jobs)
 
   def populate_shard_with_random_data(self, db_name):
     """Populates the given database with randomly generated data.
@@ -246,14 +421,16 @@ class LocalDatabase(object):
     for table in tables:
       self.populate_table_with_random_data(db_name, table[0])
 
-  # The number of rows inserted in a single INSERT statement.
-  batch_insert_size = 1000
+  # The number of rows generated at once, and written to the data file.
+  load_batch_size = 100000
 
   def populate_table_with_random_data(self, db_name, table_name):
     """Populates the given table with randomly generated data.
 
-    Queries the database for the table schema and then populates
-    the columns with randomly generated data.
+    Queries the database for the table schema, generates random columns
+    of data in a temporary file, and loads it with LOAD DATA LOCAL INFILE.
+    The data only depends on the rng_seed option and the database and
+    table names.
 
     Args:
       db_name: The shard database name (string).
@@ -261,118 +438,42 @@ class LocalDatabase(object):
     """
 
     field_infos = self.mysql_execute(['DESCRIBE %s' % table_name], db_name)
-    num_rows = self.rng.randint(self.init_data_options.min_table_shard_size,
-                                self.init_data_options.max_table_shard_size)
-    rows = []
-    for _ in xrange(num_rows):
-      row = []
-      for field_info in field_infos:
-        field_type = field_info[1]
-        field_allow_nulls = (field_info[2] == 'YES')
-        row.append(
-            self.generate_random_field(
-                table_name, field_type, field_allow_nulls))
-      rows.append(row)
-
-    # Insert 'rows' into the database in batches of size
-    # self.batch_insert_size
-    field_names = [field_info[0] for field_info in field_infos]
-    for index in xrange(0, len(rows), self.batch_insert_size):
-      self.batch_insert(db_name,
-                        table_name,
-                        field_names,
-                        rows[index:index + self.batch_insert_size])
-
-  def batch_insert(self, db_name, table_name, field_names, rows):
-    """Inserts the rows in 'rows' into 'table_name' of database 'db_name'.
+    generator = random_data.ColumnGenerator(random_data.table_seed(
+        self.init_data_options.rng_seed, db_name, table_name))
+    num_rows = generator.rng.randint(
+        self.init_data_options.min_table_shard_size,
+        self.init_data_options.max_table_shard_size)
+    with tempfile.NamedTemporaryFile(
+        prefix='%s.%s.' % (db_name, table_name), suffix='.tsv') as f:
+      for index in xrange(0, num_rows, self.load_batch_size):
+        size = min(self.load_batch_size, num_rows - index)
+        columns = [
+            generator.column(table_name, field_info[1],
+                             field_info[2] == 'YES',
+                             self.init_data_options.null_probability, size)
+            for field_info in field_infos]
+        random_data.write_rows(f, columns)
+      f.flush()
+      self.load_data_file(db_name, table_name,
+                          [field_info[0] for field_info in field_infos],
+                          f.name)
+
+  def load_data_file(self, db_name, table_name, field_names, path):
+    """Loads a file into 'table_name' of database 'db_name'.
 
     Args:
       db_name: The name of the database containing the table.
       table_name: The name of the table to populate.
-      field_names: The list of the field names in the table.
-      rows: A list of tuples with each tuple containing
-          the string representations of the fields.
-          The order of the representation must match the order of the field
-          names listed in 'field_names'.
-    """
-
-    field_names_string = ','.join(field_names)
-    values_string = ','.join(['(' + ','.join(row) +')' for row in rows])
-    # We use "INSERT IGNORE" to ignore duplicate key errors.
-    insert_query = ('INSERT IGNORE INTO %s (%s) VALUES %s' %
-                    (table_name, field_names_string, values_string))
-    logging.info('Executing in database %s: %s', db_name, insert_query)
-    self.mysql_execute([insert_query], db_name)
-
-  def generate_random_field(self, table_name, field_type, field_allows_nulls):
-    """Generates a random field string representation.
-
-    By 'string representation' we mean a string that is suitable to be a part
-    of an 'INSERT INTO' SQL statement.
-
-    Args:
-      table_name: The name of the table that will contain the generated field
-          value. Only used for a descriptive exception message in case of
-          an error.
-      field_type: The field_type as given by a "DESCRIBE <table>" SQL statement.
-      field_allows_nulls: Should be 'true' if this field allows NULLS.
-
-    Returns:
-      The random field.
-
-    Raises:
-      Exception: If 'field_type' is not supported.
-    """
-
-    value = None
-    if field_type.startswith('tinyint'):
-      value = self.random_integer(field_type, 1)
-    elif field_type.startswith('smallint'):
-      value = self.random_integer(field_type, 2)
-    elif field_type.startswith('mediumint'):
-      value = self.random_integer(field_type, 3)
-    elif field_type.startswith('int'):
-      value = self.random_integer(field_type, 4)
-    elif field_type.startswith('bigint'):
-      value = self.random_integer(field_type, 8)
-    elif field_type.startswith('decimal'):
-      value = self.random_decimal(field_type)
-    else:
-      raise Exception('Populating random data in field type: %s is not yet '
-                      'supported. (table: %s)' % (field_type, table_name))
-    if (field_allows_nulls and
-        self.true_with_probability(self.init_data_options.null_probability)):
-      return 'NULL'
-    return value
-
-  def true_with_probability(self, true_probability):
-    """Returns a pseudo-random boolean.
-
-    Args:
-      true_probability: The probability to use for returning 'true'.
-    Returns:
-      The value 'true' is with probability 'true_probability'.
+      field_names: The list of the field names in the file.
+      path: The file, with one line per row, and tab separated fields.
     """
 
-    return self.rng.uniform(0, 1) < true_probability
-
-  def random_integer(self, field_type, num_bytes):
-    num_bits = 8*num_bytes
-    if field_type.endswith('unsigned'):
-      return '%d' % (self.rng.randint(0, 2**num_bits-1))
-    return '%d' % (self.rng.randint(-2**(num_bits-1), 2**(num_bits-1)-1))
-
-  decimal_regexp = re.compile(r'decimal\((\d+),(\d+)\)')
-
-  def random_decimal(self, field_type):
-    match = self.decimal_regexp.match(field_type)
-    if match is None:
-      raise Exception("Can't parse 'decimal' field type: %s" % field_type)
-    num_digits_right = int(match.group(2))
-    num_digits_left = int(match.group(1))-num_digits_right
-    boundary = 10**num_digits_left-1
-    rand = self.rng.uniform(-boundary, boundary)
-    return '%.*f' % (num_digits_right, rand)
+    # We use "IGNORE" to ignore duplicate key errors.
+    load_query = ("LOAD DATA LOCAL INFILE '%s' IGNORE INTO TABLE %s (%s)" %
+                  (path.replace('\\', '\\\\').replace("'", "\\'"),
+                   table_name, ','.join(field_names)))
+    logging.info('Executing in database %s: %s', db_name, load_query)
+    self.mysql_execute([load_query], db_name)
 
   def get_sql_commands_from_file(self, filename, source_root=None):
     """Given a file, extract an array of commands from the file.
@@ -33,6 +33,14 @@ class MySqlDB(object):
     """Stops the MySQL database."""
     raise NotImplementedError('MySqlDB is the base class.')
 
+  def save_snapshot(self, path):
+    """Copies the data directory of the running database to path."""
+    raise NotImplementedError('MySqlDB is the base class.')
+
+  def setup_from_snapshot(self, path):
+    """Starts the MySQL database from a copy of a save_snapshot path."""
+    raise NotImplementedError('MySqlDB is the base class.')
+
   def username(self):
     raise NotImplementedError('MySqlDB is the base class.')
 
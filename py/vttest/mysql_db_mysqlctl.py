@@ -15,7 +15,9 @@
 """This module defines a mysqlctl based MySQL database.
 """
 
+import json
 import os
+import shutil
 import subprocess
 
 import MySQLdb
@@ -24,6 +26,10 @@ from vttest import environment
 from vttest import mysql_db
 from vttest.mysql_flavor import mysql_flavor
 
+# SNAPSHOT_INFO is the file of a snapshot recording the directory it was
+# taken from.
+SNAPSHOT_INFO = 'vttest_snapshot.json'
+
 
 class MySqlDBMysqlctl(mysql_db.MySqlDB):
   """Contains data and methods to manage a MySQL instance using mysqlctl."""
@@ -64,10 +70,62 @@ class MySqlDBMysqlctl(mysql_db.MySqlDB):
     if result != 0:
       raise Exception('mysqlctl failed', result)
 
+  def start(self):
+    """Starts mysqld on an initialized data directory."""
+    cmd = [
+        environment.mysqlctl_binary,
+        '-alsologtostderr',
+        '-tablet_uid', '1',
+        '-mysql_port', str(self._port),
+        'start',
+    ]
+    env = os.environ
+    env['VTDATAROOT'] = self._directory
+    result = subprocess.call(cmd, env=env)
+    if result != 0:
+      raise Exception('mysqlctl failed', result)
+
+  def tablet_directory(self):
+    return os.path.join(self._directory, 'vt_0000000001')
+
+  def save_snapshot(self, path):
+    """Copies the data directory to path, with mysqld stopped meanwhile."""
+    self.teardown()
+    try:
+      shutil.copytree(self.tablet_directory(), path, symlinks=True,
+                      ignore=shutil.ignore_patterns('mysql.sock*', '*.pid'))
+      with open(os.path.join(path, SNAPSHOT_INFO), 'w') as f:
+        json.dump({'directory': self._directory}, f)
+    finally:
+      self.start()
+
+  def setup_from_snapshot(self, path):
+    """Starts mysqld on a copy of a save_snapshot path.
+
+    The paths of the original directory, in my.cnf and in the binlog and
+    relay log indexes, are replaced by the ones of this directory.
+
+    Args:
+      path: the snapshot directory.
+    """
+    tablet_directory = self.tablet_directory()
+    shutil.copytree(path, tablet_directory, symlinks=True)
+    info_path = os.path.join(tablet_directory, SNAPSHOT_INFO)
+    with open(info_path) as f:
+      old_directory = json.load(f)['directory']
+    os.remove(info_path)
+    for root, _, files in os.walk(tablet_directory):
+      for name in files:
+        if name == 'my.cnf' or name.endswith(('.index', '.info')):
+          _replace_in_file(os.path.join(root, name), old_directory,
+                           self._directory)
+    self.start()
+
   def connect(self, db_name):
     return MySQLdb.connect(user='vt_dba',
                            unix_socket=self.unix_socket(),
-                           db=db_name)
+                           db=db_name,
+                           local_infile=1)
 
   def username(self):
     return 'vt_dba'
@@ -90,3 +148,11 @@ class MySqlDBMysqlctl(mysql_db.MySqlDB):
         'password': self.password(),
         'socket': self.unix_socket(),
     }
+
+
+def _replace_in_file(path, old, new):
+  with open(path) as f:
+    content = f.read()
+  if old in content:
+    with open(path, 'w') as f:
+      f.write(content.replace(old, new))
@@ -0,0 +1,132 @@
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Generates random table data a column at a time, for LOAD DATA.
+
+The values of a column are drawn in a single call, by NumPy if it is
+installed, and formatted as the text of a LOAD DATA INFILE file: tab
+separated columns, one row per line, NULL as \\N.
+
+The data of a table only depends on the seed it is given, so tables can
+be generated in any order, or in parallel.
+"""
+
+import hashlib
+import random
+import re
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# NULL is how LOAD DATA INFILE reads a NULL value.
+NULL = '\\N'
+
+# Number of bytes of the integer types, by the prefix of their type.
+_INTEGER_BYTES = (
+    ('tinyint', 1),
+    ('smallint', 2),
+    ('mediumint', 3),
+    ('int', 4),
+    ('bigint', 8),
+)
+
+_decimal_regexp = re.compile(r'decimal\((\d+),(\d+)\)')
+
+
+def table_seed(rng_seed, db_name, table_name):
+  """Returns the seed of a table, derived from the global seed."""
+  digest = hashlib.md5('%s/%s/%s' % (rng_seed, db_name, table_name)).digest()
+  return int(digest[:4].encode('hex'), 16)
+
+
+class ColumnGenerator(object):
+  """Draws whole columns of random values from a seed."""
+
+  def __init__(self, seed):
+    if numpy:
+      self.numpy_rng = numpy.random.RandomState(seed)
+    self.rng = random.Random(seed)
+
+  def randint(self, low, high, size):
+    """Returns size ints between low and high, both included."""
+    if numpy:
+      dtype = 'i8' if low < 0 else 'u8'
+      return self.numpy_rng.randint(
+          low, high + 1, size=size, dtype=dtype).tolist()
+    return [self.rng.randint(low, high) for _ in xrange(size)]
+
+  def uniform(self, low, high, size):
+    if numpy:
+      return self.numpy_rng.uniform(low, high, size).tolist()
+    return [self.rng.uniform(low, high) for _ in xrange(size)]
+
+  def null_indexes(self, probability, size):
+    """Returns the indexes of the values to set to NULL."""
+    if numpy:
+      return numpy.flatnonzero(
+          self.numpy_rng.random_sample(size) < probability).tolist()
+    return [i for i in xrange(size) if self.rng.uniform(0, 1) < probability]
+
+  def column(self, table_name, field_type, allows_nulls, null_probability,
+             size):
+    """Returns a random column, as a list of LOAD DATA strings.
+
+    Args:
+      table_name: the name of the table, for error messages only.
+      field_type: the field type as given by "DESCRIBE <table>".
+      allows_nulls: True if the field can be NULL.
+      null_probability: the probability of NULL values, if allowed.
+      size: the number of values.
+
+    Returns:
+      The list of the values.
+
+    Raises:
+      Exception: If 'field_type' is not supported.
+    """
+    for prefix, num_bytes in _INTEGER_BYTES:
+      if field_type.startswith(prefix):
+        num_bits = 8 * num_bytes
+        if field_type.endswith('unsigned'):
+          low, high = 0, 2**num_bits - 1
+        else:
+          low, high = -2**(num_bits - 1), 2**(num_bits - 1) - 1
+        values = map(str, self.randint(low, high, size))
+        break
+    else:
+      if field_type.startswith('decimal'):
+        match = _decimal_regexp.match(field_type)
+        if match is None:
+          raise Exception("Can't parse 'decimal' field type: %s" % field_type)
+        num_digits_right = int(match.group(2))
+        num_digits_left = int(match.group(1)) - num_digits_right
+        boundary = 10**num_digits_left - 1
+        fmt = '%%.%df' % num_digits_right
+        values = map(fmt.__mod__, self.uniform(-boundary, boundary, size))
+      else:
+        raise Exception('Populating random data in field type: %s is not yet '
+                        'supported. (table: %s)' % (field_type, table_name))
+    if allows_nulls:
+      for i in self.null_indexes(null_probability, size):
+        values[i] = NULL
+    return values
+
+
+def write_rows(f, columns):
+  """Writes columns of strings to a file, in the LOAD DATA format."""
+  if not columns:
+    return
+  f.writelines('\t'.join(row) + '\n' for row in zip(*columns))
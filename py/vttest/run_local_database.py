@@ -112,7 +112,9 @@ def main(cmdline_options):
       default_schema_dir=cmdline_options.default_schema_dir,
       extra_my_cnf=extra_my_cnf,
       charset=cmdline_options.charset,
-      snapshot_file=cmdline_options.snapshot_file) as local_db:
+      snapshot_file=cmdline_options.snapshot_file,
+      fast_start=cmdline_options.fast_start,
+      data_cache_dir=cmdline_options.data_cache_dir) as local_db:
     print json.dumps(local_db.config())
     sys.stdout.flush()
     try:
@@ -205,6 +207,15 @@ if __name__ == '__main__':
   parser.add_option('--charset', default='utf8', help='MySQL charset')
   parser.add_option(
       '--snapshot_file', default=None, help='A MySQL DB snapshot file')
+  parser.add_option(
+      '--fast_start', action='store_true',
+      help='Load the schema of all shards in parallel, and start vtcombo'
+      ' while the random data is loaded.')
+  parser.add_option(
+      '--data_cache_dir', default=None,
+      help='Directory caching the initialized MySQL data directory, keyed'
+      ' by a hash of the topology, schema and random data options. Runs'
+      ' with the same hash restore it instead of initializing MySQL.')
   (options, args) = parser.parse_args()
   if options.verbose:
     logging.getLogger().setLevel(logging.DEBUG)
@@ -31,6 +31,10 @@ class VtProcess(object):
   """Base class for a vt process, vtcombo only now."""
 
   START_RETRIES = 5
+  # The process is polled every POLL_INITIAL_INTERVAL seconds at first,
+  # then at intervals growing up to POLL_MAX_INTERVAL.
+  POLL_INITIAL_INTERVAL = 0.02
+  POLL_MAX_INTERVAL = 0.3
 
   def __init__(self, name, directory, binary, port_name):
     self.name = name
@@ -66,6 +70,7 @@ class VtProcess(object):
       self.process = subprocess.Popen(cmd,
                                       stdout=self.stdout)
       timeout = time.time() + 60.0
+      poll_interval = self.POLL_INITIAL_INTERVAL
       while time.time() < timeout:
         if environment.process_is_healthy(
             self.name, self.addr()) and self.get_vars():
@@ -74,7 +79,8 @@ class VtProcess(object):
         elif self.process.poll() is not None:
           logging.error('%s process exited prematurely.', self.name)
           break
-        time.sleep(0.3)
+        time.sleep(poll_interval)
+        poll_interval = min(poll_interval * 1.5, self.POLL_MAX_INTERVAL)
 
       logging.error('cannot start %s process on time: %s ',
                     self.name, socket.getfqdn())
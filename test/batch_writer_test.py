@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for batch_writer, against a fake connection."""
+
+import time
+import unittest
+
+from vtdb import batch_writer
+from vtdb import dbexceptions
+from vtdb import keyspace
+
+
+class FakeConnection(object):
+  """Records the batches, fails the ones with a bad_id bind variable."""
+
+  def __init__(self):
+    self.batches = []
+    self.bad_id = None
+    self.error = None
+
+  def get_srv_keyspace(self, name):
+    return keyspace.Keyspace(name, {'Partitions': {'master': {
+        'ShardReferences': [
+            {'Name': '-80', 'KeyRange': {'Start': '', 'End': '\x80'}},
+            {'Name': '80-', 'KeyRange': {'Start': '\x80', 'End': ''}},
+        ]}}})
+
+  def _execute_batch(self, sql_list, bind_variables_list, keyspace_list,
+                     keyspace_ids_list, shards_list, tablet_type,
+                     as_transaction, effective_caller_id=None):
+    self.batches.append((sql_list, bind_variables_list, keyspace_ids_list))
+    if self.error:
+      raise self.error
+    for bind_variables in bind_variables_list:
+      if self.bad_id in bind_variables.values():
+        raise dbexceptions.IntegrityError('duplicate entry')
+    return [([], 1, 0, []) for _ in sql_list]
+
+
+def kid(i):
+  # Even rows go to -80, odd rows to 80-.
+  return (i % 2) << 63 | i
+
+
+class TestBatchWriter(unittest.TestCase):
+
+  def setUp(self):
+    self.conn = FakeConnection()
+    self.writer = batch_writer.BatchWriter(
+        self.conn, 'ks', max_rows=4, max_delay=60, max_rows_per_statement=3)
+
+  def test_grouping(self):
+    for i in xrange(7):
+      self.writer.insert('t', {'id': i, 'name': 'n%d' % i}, kid(i))
+    # The -80 shard got its 4 rows, and was flushed.
+    self.assertEqual(len(self.conn.batches), 1)
+    sql_list, bind_variables_list, keyspace_ids_list = self.conn.batches[0]
+    self.assertEqual(sql_list, [
+        'insert into t(id, name) values (:v0_0, :v0_1), (:v1_0, :v1_1), '
+        '(:v2_0, :v2_1)',
+        'insert into t(id, name) values (:v0_0, :v0_1)'])
+    self.assertEqual(bind_variables_list[1], {'v0_0': 6, 'v0_1': 'n6'})
+    self.assertEqual([len(kids) for kids in keyspace_ids_list], [3, 1])
+    self.assertEqual(keyspace_ids_list[1],
+                     [keyspace.pack_keyspace_id(kid(6))])
+    self.assertEqual(self.writer.pending(), 3)
+
+    w = self.writer.execute('update t set n = :n where id = :id',
+                            {'id': 1, 'n': 2}, kid(1))
+    self.writer.close()
+    self.assertEqual(self.writer.pending(), 0)
+    self.assertEqual(self.conn.batches[1][0][-1],
+                     'update t set n = :n where id = :id')
+    self.assertTrue(w.done)
+    self.assertEqual(self.writer.rows_sent, 8)
+
+  def test_error_attribution(self):
+    self.conn.bad_id = 2
+    writes = [self.writer.insert('t', {'id': i}, kid(i))
+              for i in (0, 2, 4)]
+    with self.assertRaises(batch_writer.BatchWriteError) as cm:
+      self.writer.flush()
+    self.assertEqual(cm.exception.failed_writes, [writes[1]])
+    self.assertIsInstance(writes[1].error, dbexceptions.IntegrityError)
+    self.assertEqual([w.error for w in (writes[0], writes[2])], [None, None])
+    # One failed batch, then the writes one by one.
+    self.assertEqual(len(self.conn.batches), 4)
+
+  def test_timeout_is_not_replayed(self):
+    self.conn.error = dbexceptions.TimeoutError('deadline exceeded')
+    writes = [self.writer.insert('t', {'id': i}, kid(i))
+              for i in (0, 2, 4)]
+    with self.assertRaises(batch_writer.BatchWriteError) as cm:
+      self.writer.flush()
+    self.assertEqual(cm.exception.failed_writes, writes)
+    for w in writes:
+      self.assertIs(w.error, self.conn.error)
+    self.assertEqual(len(self.conn.batches), 1)
+
+  def test_order_around_statements(self):
+    self.writer.max_rows = 10
+    self.writer.insert('t', {'id': 0}, kid(0))
+    self.writer.execute('update t set n = n + 1', {}, kid(0))
+    self.writer.insert('t', {'id': 2}, kid(0))
+    self.writer.insert('t', {'id': 4}, kid(0))
+    self.writer.flush()
+    sql_list, _, _ = self.conn.batches[0]
+    self.assertEqual(sql_list, [
+        'insert into t(id) values (:v0_0)',
+        'update t set n = n + 1',
+        'insert into t(id) values (:v0_0), (:v1_0)'])
+
+  def test_max_delay(self):
+    self.writer.max_delay = 0.01
+    self.writer.start()
+    w = self.writer.insert('t', {'id': 1}, kid(1))
+    deadline = time.time() + 5
+    while not w.done and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertTrue(w.done)
+    self.writer.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for circuit_breaker, and its use by grpc_vtgate_client."""
+
+import time
+import unittest
+
+from vtproto import vtgate_pb2
+from vtproto import vtrpc_pb2
+
+from vtdb import circuit_breaker
+from vtdb import dbexceptions
+from vtdb import grpc_vtgate_client
+from vtdb import retry_policy
+
+KEY = ('ks', 'master')
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+  def setUp(self):
+    self.breaker = circuit_breaker.CircuitBreaker(
+        failure_rate_threshold=0.5, min_requests=4, open_interval=0.05)
+
+  def call(self, error=None, keys=(KEY,)):
+    with self.breaker.guard(list(keys)):
+      if error:
+        raise error
+
+  def fail(self):
+    self.assertRaises(dbexceptions.TransientError, self.call,
+                      dbexceptions.TransientError('down'))
+
+  def test_opens_on_failure_rate(self):
+    self.call()
+    self.call()
+    self.fail()
+    self.assertEqual(self.breaker.state(*KEY), circuit_breaker.CLOSED)
+    self.fail()
+    self.assertEqual(self.breaker.state(*KEY), circuit_breaker.OPEN)
+    self.assertRaises(dbexceptions.CircuitOpenError, self.call)
+    # Other keys are not affected.
+    self.call(keys=[('ks', 'replica')])
+    self.assertEqual(self.breaker.stats()[KEY]['rejected'], 1)
+
+  def test_other_errors_are_successes(self):
+    for _ in xrange(10):
+      self.assertRaises(dbexceptions.IntegrityError, self.call,
+                        dbexceptions.IntegrityError('dup'))
+    self.assertEqual(self.breaker.state(*KEY), circuit_breaker.CLOSED)
+
+  def test_half_open(self):
+    for _ in xrange(4):
+      self.fail()
+    time.sleep(0.06)
+    self.assertEqual(self.breaker.state(*KEY), circuit_breaker.HALF_OPEN)
+
+    # A single probe at a time.
+    guard = self.breaker.guard([KEY])
+    guard.__enter__()
+    self.assertRaises(dbexceptions.CircuitOpenError, self.call)
+
+    # A failed probe opens the circuit for longer.
+    guard.__exit__(dbexceptions.TransientError,
+                   dbexceptions.TransientError('down'), None)
+    self.assertEqual(self.breaker.state(*KEY), circuit_breaker.OPEN)
+    time.sleep(0.06)
+    self.assertRaises(dbexceptions.CircuitOpenError, self.call)
+    time.sleep(0.06)
+
+    # A successful probe closes it.
+    self.call()
+    self.assertEqual(self.breaker.state(*KEY), circuit_breaker.CLOSED)
+    self.call()
+
+  def test_all_keys_are_checked(self):
+    for _ in xrange(4):
+      self.fail()
+    self.assertRaises(dbexceptions.CircuitOpenError, self.call,
+                      keys=[('other', 'master'), KEY])
+    self.assertEqual(self.breaker.stats()[('other', 'master')]['successes'],
+                     0)
+
+
+class FakeStub(object):
+
+  def __init__(self):
+    self.calls = 0
+
+  def Execute(self, request, unused_timeout):
+    self.calls += 1
+    response = vtgate_pb2.ExecuteResponse()
+    response.error.code = vtrpc_pb2.UNAVAILABLE
+    response.error.message = 'no serving tablet'
+    return response
+
+
+class TestGRPCVTGateConnection(unittest.TestCase):
+
+  def test_execute_fails_fast(self):
+    breaker = circuit_breaker.CircuitBreaker(min_requests=2)
+    conn = grpc_vtgate_client.GRPCVTGateConnection(
+        'localhost:1', 10, circuit_breaker=breaker)
+    conn.retry_policy = retry_policy.RetryPolicy(num_retries=0)
+    conn.stub = FakeStub()
+    for _ in xrange(2):
+      self.assertRaises(dbexceptions.TransientError, conn._execute,
+                        'select 1', {}, 'replica', keyspace_name='ks')
+    self.assertRaises(dbexceptions.CircuitOpenError, conn._execute,
+                      'select 1', {}, 'REPLICA', keyspace_name='ks')
+    self.assertEqual(conn.stub.calls, 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -20,11 +20,26 @@ all sandlets, or selectively choose which ones to start.
 
 Sandlets are made up of components, which are the actual subprocesses or jobs
 to run.
+
+A ComponentGroup runs an action on its components as a dependency graph: each
+component starts as soon as the components it depends on are finished, on up
+to num_threads threads, and its readiness is polled at growing intervals.
 """
 
 import logging
+import Queue
+import threading
 import time
 
+# DEFAULT_NUM_THREADS is the number of components acted on at once.
+DEFAULT_NUM_THREADS = 8
+# Readiness polling parameters, in seconds: a component is first checked
+# POLL_INITIAL_INTERVAL after its action, then at intervals growing by
+# POLL_MULTIPLIER, up to POLL_MAX_INTERVAL.
+POLL_INITIAL_INTERVAL = 0.1
+POLL_MULTIPLIER = 1.5
+POLL_MAX_INTERVAL = 10.0
+
 
 class DependencyError(Exception):
   """Raised when the configuration has an incorrect set of dependencies."""
@@ -81,6 +96,88 @@ class StopAction(BaseAction):
     return [x.name for x in available if not x.is_down()]
 
 
+class ComponentTiming(object):
+  """When the action on a component became possible, started and finished.
+
+  Attributes:
+    name: the component name.
+    ready: when its dependencies were finished, in seconds since Epoch.
+    start: when the action started.
+    acted: when the action returned.
+    end: when the component was finished.
+    blocked_by: the dependency that finished last, None if there was none.
+  """
+
+  def __init__(self, name, ready):
+    self.name = name
+    self.ready = ready
+    self.start = None
+    self.acted = None
+    self.end = None
+    self.blocked_by = None
+
+  @property
+  def duration(self):
+    return self.end - self.start
+
+
+class ExecutionReport(object):
+  """The timings of a ComponentGroup.execute call."""
+
+  def __init__(self, action):
+    self.action = action
+    self.start = time.time()
+    self.end = None
+    # Map of component name to ComponentTiming.
+    self.timings = {}
+
+  def critical_path(self):
+    """Returns the chain of components that determined the total time.
+
+    Returns:
+      The list of ComponentTiming, from the first to start to the last to
+      finish, each blocked by the previous one.
+    """
+    finished = [t for t in self.timings.itervalues() if t.end is not None]
+    if not finished:
+      return []
+    path = [max(finished, key=lambda t: t.end)]
+    while path[-1].blocked_by:
+      path.append(self.timings[path[-1].blocked_by])
+    path.reverse()
+    return path
+
+  def format(self):
+    """Returns the report as a human readable string."""
+    lines = ['%s: %.1fs total, critical path:' % (
+        self.action.__name__, (self.end or time.time()) - self.start)]
+    for t in self.critical_path():
+      lines.append('  %-30s waited %5.1fs, action %5.1fs, ready after %5.1fs'
+                   % (t.name, t.start - t.ready, t.acted - t.start,
+                      t.end - t.acted))
+    return '\n'.join(lines)
+
+
+def _act(action, component, timing, done_queue):
+  """Runs an action on a component, and waits for it to be finished."""
+  error = None
+  try:
+    timing.start = time.time()
+    action.do_action(component)
+    timing.acted = time.time()
+    interval = POLL_INITIAL_INTERVAL
+    if action.get_unfinished([component]):
+      logging.info('Waiting to be finished: %s.', component.name)
+    while action.get_unfinished([component]):
+      time.sleep(interval)
+      interval = min(interval * POLL_MULTIPLIER, POLL_MAX_INTERVAL)
+    timing.end = time.time()
+  except Exception as e:  # pylint: disable=broad-except
+    logging.exception('%s failed on %s.', action.__name__, component.name)
+    error = e
+  done_queue.put((component.name, error))
+
+
 class ComponentGroup(object):
   """A grouping of components with dependencies that can be executed."""
 
@@ -90,25 +187,72 @@ class ComponentGroup(object):
   def add_component(self, component):
     self.components.append(component)
 
-  def execute(self, action, subcomponents=None):
-    remaining = subcomponents or [x.name for x in self.components]
-    while remaining:
-      available = [x for x in self.components if x.name in remaining
-                   and action.able_to_act(x, self.components, remaining)]
-      if not available:
+  def execute(self, action, subcomponents=None,
+              num_threads=DEFAULT_NUM_THREADS):
+    """Runs an action on components, following their dependencies.
+
+    Args:
+      action: StartAction or StopAction.
+      subcomponents: names of the components to act on, defaults to all.
+      num_threads: the number of components acted on at once.
+
+    Returns:
+      An ExecutionReport.
+
+    Raises:
+      DependencyError: if the dependencies have a cycle.
+      Exception: the first error raised by an action, once the actions
+        already started are finished.
+    """
+    report = ExecutionReport(action)
+    names = subcomponents or [x.name for x in self.components]
+    pending = [x for x in self.components if x.name in names]
+    # Names of the components not finished yet, running or pending.
+    unfinished = set(x.name for x in pending)
+    done_queue = Queue.Queue()
+    running = 0
+    error = None
+    last_done = None
+    while pending or running:
+      if error is None:
+        available = [x for x in pending
+                     if action.able_to_act(x, self.components, unfinished)]
+        for component in available:
+          if component.name not in report.timings:
+            timing = ComponentTiming(component.name, time.time())
+            timing.blocked_by = last_done
+            report.timings[component.name] = timing
+        for component in available[:num_threads - running]:
+          pending.remove(component)
+          running += 1
+          t = threading.Thread(
+              target=_act, args=(action, component,
+                                 report.timings[component.name], done_queue))
+          t.daemon = True
+          t.start()
+      if not running:
+        if error is not None:
+          break
         # This is a cycle, we have remaining tasks but none can run
         raise DependencyError(
-            'Cycle detected: remaining components: %s.' % remaining)
-      for component in available:
-        action.do_action(component)
-        remaining.remove(component.name)
+            'Cycle detected: remaining components: %s.' %
+            [x.name for x in pending])
       while True:
-        unfinished_components = action.get_unfinished(available)
-        if not unfinished_components:
+        try:
+          name, e = done_queue.get(timeout=1)
           break
-        logging.info(
-            'Waiting to be finished: %s.', ', '.join(unfinished_components))
-        time.sleep(10)
+        except Queue.Empty:
+          pass
+      running -= 1
+      unfinished.discard(name)
+      last_done = name
+      if e is not None and error is None:
+        error = e
+    report.end = time.time()
+    if error is not None:
+      raise error
+    logging.info('%s', report.format())
+    return report
 
 
 class Sandlet(object):
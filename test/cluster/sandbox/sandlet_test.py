@@ -16,6 +16,7 @@
 
 import StringIO
 import sys
+import time
 import unittest
 
 import sandlet
@@ -51,7 +52,8 @@ class SandletTest(unittest.TestCase):
     try:
       out = StringIO.StringIO()
       sys.stdout = out
-      group.execute(action, subcomponents)
+      # A single thread keeps the output order deterministic.
+      group.execute(action, subcomponents, num_threads=1)
       output = out.getvalue().strip()
       self.assertEquals(output, expected_output)
     finally:
@@ -83,5 +85,80 @@ class SandletTest(unittest.TestCase):
       self._test_dependency_graph([a, b, c], '', sandlet.StartAction)
 
 
+class SlowComponent(object):
+  """A component that takes start_time to start, and up_time to be up."""
+
+  def __init__(self, name, dependencies, start_time=0, up_time=0,
+               error=None):
+    self.name = name
+    self.dependencies = dependencies
+    self.start_time = start_time
+    self.up_time = up_time
+    self.error = error
+    self.started = None
+
+  def start(self):
+    self.started = time.time()
+    time.sleep(self.start_time)
+    if self.error:
+      raise self.error
+
+  def stop(self):
+    pass
+
+  def is_up(self):
+    return time.time() >= self.started + self.start_time + self.up_time
+
+  def is_down(self):
+    return True
+
+
+class ComponentGroupTest(unittest.TestCase):
+
+  def _group(self, components):
+    group = sandlet.ComponentGroup()
+    for c in components:
+      group.add_component(c)
+    return group
+
+  def test_independent_components_run_in_parallel(self):
+    components = [SlowComponent(name, [], start_time=0.2)
+                  for name in 'abcd']
+    start = time.time()
+    report = self._group(components).execute(sandlet.StartAction)
+    self.assertLess(time.time() - start, 0.6)
+    self.assertEqual(len(report.timings), 4)
+
+  def test_start_when_dependencies_finish(self):
+    # fast depends on quick, slow is independent and takes longer: fast
+    # starts without waiting for slow.
+    quick = SlowComponent('quick', [], up_time=0.05)
+    slow = SlowComponent('slow', [], up_time=0.5)
+    fast = SlowComponent('fast', ['quick'])
+    report = self._group([quick, slow, fast]).execute(sandlet.StartAction)
+    self.assertLess(fast.started, slow.started + 0.4)
+    self.assertEqual([t.name for t in report.critical_path()], ['slow'])
+
+  def test_critical_path(self):
+    a = SlowComponent('a', [], up_time=0.1)
+    b = SlowComponent('b', ['a'], start_time=0.1)
+    c = SlowComponent('c', [])
+    report = self._group([a, b, c]).execute(sandlet.StartAction)
+    path = report.critical_path()
+    self.assertEqual([t.name for t in path], ['a', 'b'])
+    self.assertGreaterEqual(path[1].start, path[0].end)
+    self.assertIn('critical path', report.format())
+
+  def test_error(self):
+    a = SlowComponent('a', [], error=ValueError('no quota'))
+    b = SlowComponent('b', ['a'])
+    c = SlowComponent('c', [], start_time=0.1)
+    with self.assertRaises(ValueError):
+      self._group([a, b, c]).execute(sandlet.StartAction)
+    # Components already started are waited for, the others not started.
+    self.assertIsNotNone(c.started)
+    self.assertIsNone(b.started)
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the bind variable conversion in dbapi."""
+
+import unittest
+
+from vtdb import dbapi
+from vtdb import dbexceptions
+
+
+class TestPrepareQueryBindVars(unittest.TestCase):
+
+  QUERIES = [
+      ('select * from t where a = %(a)s', {'a': 1, 'unused': 2}),
+      ('select * from t where a = %(a)s and b in %(b)s and c = %(a)s',
+       {'a': 'x', 'b': (1, 2)}),
+      ("select * from t where name like 'a%%' and id = %(id)s", {'id': 3}),
+      ('select * from t where b in %(b)s', {'b': set([1])}),
+      ('select %(a)r', {'a': 1}),
+      ('select 1', None),
+  ]
+
+  def setUp(self):
+    dbapi.prepared_query_cache.clear()
+
+  def test_same_as_uncached(self):
+    for query, bind_vars in self.QUERIES:
+      expected = dbapi._prepare_query_bind_vars_uncached(query, bind_vars)
+      # The second call is served from the cache.
+      for _ in xrange(2):
+        self.assertEqual(
+            dbapi.prepare_query_bind_vars(query, bind_vars), expected)
+
+  def test_list_shape(self):
+    query = 'select * from t where b in %(b)s'
+    self.assertEqual(dbapi.prepare_query_bind_vars(query, {'b': [1, 2]}),
+                     ('select * from t where b in ::b', {'b': [1, 2]}))
+    self.assertEqual(dbapi.prepare_query_bind_vars(query, {'b': 1}),
+                     ('select * from t where b in :b', {'b': 1}))
+
+  def test_missing_bind_var(self):
+    query = 'select * from t where a = %(a)s'
+    self.assertRaises(dbexceptions.InterfaceError,
+                      dbapi.prepare_query_bind_vars, query, {'b': 1})
+    self.assertRaises(dbexceptions.InterfaceError,
+                      dbapi.prepare_query_bind_vars, query, None)
+
+  def test_cache_stats(self):
+    cache = dbapi.PreparedQueryCache(capacity=2)
+    # 'q2' is the least recently used query when 'q3' is added.
+    for query in ('q1 %(a)s', 'q2', 'q1 %(a)s', 'q3', 'q1 %(a)s', 'q2'):
+      cache.get(query)
+    stats = cache.stats()
+    self.assertEqual(stats['hits'], 2)
+    self.assertEqual(stats['misses'], 4)
+    self.assertEqual(stats['evictions'], 2)
+    self.assertEqual(stats['size'], 2)
+    self.assertAlmostEqual(stats['hit_rate'], 2.0 / 6)
+
+  def test_unprepared_query_is_cached(self):
+    cache = dbapi.PreparedQueryCache()
+    for _ in xrange(2):
+      self.assertIsNone(cache.get('select %(a)r'))
+    self.assertEqual(cache.stats()['hits'], 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for grpc_vtgate_async_client, against a fake stub."""
+
+import threading
+import unittest
+
+from concurrent import futures
+
+from vtproto import query_pb2
+from vtproto import vtgate_pb2
+from vtproto import vtrpc_pb2
+
+from vtdb import dbexceptions
+from vtdb import grpc_vtgate_async_client
+
+
+def fill_result(qr, rows):
+  qr.fields.add(name='id', type=query_pb2.INT64)
+  for row in rows:
+    r = qr.rows.add()
+    r.lengths.append(len(row))
+    r.values += row
+
+
+class FakeMethod(object):
+  """A fake stub method, returning the queued responses in order."""
+
+  def __init__(self, responses):
+    self.responses = list(responses)
+    self.requests = []
+
+  def __call__(self, request, timeout):
+    self.requests.append(request)
+    return iter(self.responses.pop(0))
+
+  def future(self, request, timeout):
+    self.requests.append(request)
+    result = futures.Future()
+    response = self.responses.pop(0)
+    if isinstance(response, Exception):
+      result.set_exception(response)
+    else:
+      result.set_result(response)
+    return result
+
+
+class FakeStub(object):
+  pass
+
+
+class TestAsyncClient(unittest.TestCase):
+
+  def setUp(self):
+    self.conn = grpc_vtgate_async_client.AsyncGRPCVTGateConnection(
+        'localhost:1', 1.0, initial_delay_ms=1)
+    self.conn.stub = FakeStub()
+
+  def execute_response(self, rows):
+    response = vtgate_pb2.ExecuteResponse()
+    fill_result(response.result, rows)
+    return response
+
+  def test_execute(self):
+    self.conn.stub.Execute = FakeMethod([self.execute_response(['1', '2'])])
+    future = self.conn.execute_async('select id from t', {}, 'replica')
+    results, rowcount, _, fields = future.result(5)
+    self.assertEqual(results, [(1,), (2,)])
+    self.assertEqual(rowcount, 0)
+    self.assertEqual(fields, [('id', query_pb2.INT64)])
+
+  def test_execute_retries_transient_errors(self):
+    unavailable = vtgate_pb2.ExecuteResponse()
+    unavailable.error.code = vtrpc_pb2.UNAVAILABLE
+    unavailable.error.message = 'tablet is restarting'
+    method = FakeMethod([unavailable, self.execute_response(['3'])])
+    self.conn.stub.Execute = method
+    results, _, _, _ = self.conn.execute_async(
+        'select id from t', {}, 'replica').result(5)
+    self.assertEqual(results, [(3,)])
+    self.assertEqual(len(method.requests), 2)
+
+  def test_execute_error(self):
+    response = vtgate_pb2.ExecuteResponse()
+    response.error.code = vtrpc_pb2.INVALID_ARGUMENT
+    response.error.message = 'syntax error'
+    self.conn.stub.Execute = FakeMethod([response])
+    future = self.conn.execute_async('select', {}, 'replica')
+    self.assertRaises(dbexceptions.ProgrammingError, future.result, 5)
+
+  def test_no_retry_in_transaction(self):
+    self.conn.session = vtgate_pb2.Session(in_transaction=True)
+    unavailable = vtgate_pb2.ExecuteResponse()
+    unavailable.error.code = vtrpc_pb2.UNAVAILABLE
+    method = FakeMethod([unavailable, self.execute_response(['3'])])
+    self.conn.stub.Execute = method
+    future = self.conn.execute_async('select id from t', {}, 'master')
+    self.assertRaises(dbexceptions.DatabaseError, future.result, 5)
+    self.assertEqual(len(method.requests), 1)
+
+  def test_transaction(self):
+    begin = vtgate_pb2.BeginResponse()
+    begin.session.in_transaction = True
+    self.conn.stub.Begin = FakeMethod([begin])
+    self.conn.stub.Commit = FakeMethod([vtgate_pb2.CommitResponse()])
+    self.assertIsNone(self.conn.begin_async().result(5))
+    self.assertTrue(self.conn.session.in_transaction)
+    self.assertIsNone(self.conn.commit_async().result(5))
+    self.assertIsNone(self.conn.session)
+
+  def test_blocking_transaction(self):
+    # The blocking methods are not replaced: begin() returns once the
+    # session is set.
+    begin = vtgate_pb2.BeginResponse()
+    begin.session.in_transaction = True
+    self.conn.stub.Begin = lambda request, timeout: begin
+    self.conn.stub.Rollback = (
+        lambda request, timeout: vtgate_pb2.RollbackResponse())
+    self.assertIsNone(self.conn.begin())
+    self.assertTrue(self.conn.session.in_transaction)
+    self.conn.rollback()
+    self.assertIsNone(self.conn.session)
+
+  def test_stream_execute(self):
+    responses = []
+    for rows in (['1'], ['2', '3']):
+      response = vtgate_pb2.StreamExecuteResponse()
+      fill_result(response.result, rows)
+      responses.append(response)
+    self.conn.stub.StreamExecute = FakeMethod([responses])
+    reader = self.conn.stream_execute_async(
+        'select id from t', {}, 'replica').result(5)
+    self.assertEqual(reader.fields, [('id', query_pb2.INT64)])
+    chunks = []
+    while True:
+      chunk = reader.next_chunk().result(5)
+      if chunk is None:
+        break
+      chunks.append(chunk)
+    self.assertEqual(chunks, [[(1,)], [(2,), (3,)]])
+
+  def test_stream_open_not_starved(self):
+    # The stream readers are all busy: new streams still open.
+    stream_executor = futures.ThreadPoolExecutor(1)
+    blocked = threading.Event()
+    stream_executor.submit(blocked.wait, 5)
+    self.conn.stream_executor = stream_executor
+    response = vtgate_pb2.StreamExecuteResponse()
+    fill_result(response.result, ['1'])
+    self.conn.stub.StreamExecute = FakeMethod([[response]])
+    try:
+      reader = self.conn.stream_execute_async(
+          'select id from t', {}, 'replica').result(5)
+      self.assertEqual(reader.next_chunk().result(5), [(1,)])
+    finally:
+      blocked.set()
+      stream_executor.shutdown()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for message_consumer."""
+
+import threading
+import time
+import unittest
+
+from vtdb import dbexceptions
+from vtdb import message_consumer
+
+
+class FakeConnection(object):
+  """Streams count messages per shard, then blocks until closed."""
+
+  def __init__(self, shards, count):
+    self.messages = dict((shard, [(i, '%s-%d' % (shard, i))
+                                  for i in xrange(count)])
+                         for shard in shards)
+    self.fields = [('id', 0), ('message', 0)]
+    self.acks = []
+    self.in_flight = 0
+    self.max_in_flight = 0
+    self.ack_error = None
+    self.ack_event = threading.Event()
+    self.done = threading.Event()
+    self.lock = threading.Lock()
+
+  def message_stream(self, keyspace, name, shard=None,
+                     effective_caller_id=None):
+    def rows():
+      for message in self.messages[shard]:
+        yield message
+      self.messages[shard] = []
+      self.done.wait()
+    return rows(), self.fields
+
+  def _ack(self, ids):
+    with self.lock:
+      self.in_flight += 1
+      self.max_in_flight = max(self.max_in_flight, self.in_flight)
+    try:
+      self.ack_event.wait()
+      if self.ack_error:
+        raise self.ack_error
+      with self.lock:
+        self.acks.append(ids)
+      return len(ids)
+    finally:
+      with self.lock:
+        self.in_flight -= 1
+
+  def message_ack(self, name, ids, keyspace=None, effective_caller_id=None):
+    return self._ack(ids)
+
+  def message_ack_keyspace_ids(self, name, id_keyspace_ids, keyspace=None,
+                               effective_caller_id=None):
+    return self._ack(id_keyspace_ids)
+
+
+def wait_for(predicate):
+  deadline = time.time() + 5
+  while not predicate() and time.time() < deadline:
+    time.sleep(0.01)
+
+
+class TestMessageConsumer(unittest.TestCase):
+
+  def make_consumer(self, conn, handler, **kwargs):
+    consumer = message_consumer.MessageConsumer(
+        conn, 'ks', 'msgs', handler, shards=['-80', '80-'], num_workers=4,
+        **kwargs)
+    consumer.start()
+    self.addCleanup(conn.done.set)
+    return consumer
+
+  def test_acks_are_batched(self):
+    conn = FakeConnection(['-80', '80-'], 100)
+    handled = []
+    consumer = self.make_consumer(conn, handled.append, max_ack_batch=30,
+                                  max_ack_delay=1)
+    # Acks do not block the handling of messages.
+    wait_for(lambda: len(handled) == 200)
+    self.assertEqual(len(handled), 200)
+    # 4 batches are in flight, the other acks wait.
+    wait_for(lambda: consumer.stats()['pending_acks'] == 80)
+    self.assertEqual(conn.in_flight, 4)
+    conn.ack_event.set()
+    consumer.close()
+    acked = sorted(i for ids in conn.acks for i in ids)
+    self.assertEqual(acked, sorted(2 * range(100)))
+    self.assertTrue(all(len(ids) <= 30 for ids in conn.acks))
+    self.assertEqual(len(conn.acks), 7)
+    stats = consumer.stats()
+    self.assertEqual(stats['handled'], 200)
+    self.assertEqual(stats['acked'], 200)
+
+  def test_pending_acks_are_bounded(self):
+    conn = FakeConnection(['-80', '80-'], 100)
+    handled = []
+    consumer = self.make_consumer(conn, handled.append, max_ack_batch=10,
+                                  max_pending_acks=20, num_ack_threads=2)
+    wait_for(lambda: consumer.stats()['pending_acks'] == 20)
+    time.sleep(0.1)
+    # 2 batches in flight, 20 pending acks, and one message waiting in
+    # each worker.
+    self.assertEqual(conn.max_in_flight, 2)
+    self.assertEqual(consumer.stats()['pending_acks'], 20)
+    self.assertLessEqual(len(handled), 44)
+    conn.ack_event.set()
+    wait_for(lambda: consumer.stats()['acked'] == 200)
+    consumer.close()
+    self.assertEqual(consumer.stats()['acked'], 200)
+
+  def test_missing_id_column(self):
+    conn = FakeConnection(['-80', '80-'], 10)
+    handled = []
+    consumer = self.make_consumer(conn, handled.append,
+                                  id_column='message_id')
+    wait_for(lambda: consumer.error is not None)
+    consumer.close()
+    self.assertIsInstance(consumer.error, dbexceptions.ProgrammingError)
+    self.assertEqual(handled, [])
+    self.assertEqual(consumer.stats()['reconnects'], 0)
+
+  def test_max_ack_delay(self):
+    conn = FakeConnection(['-80', '80-'], 1)
+    conn.ack_event.set()
+    consumer = self.make_consumer(conn, lambda row: None, max_ack_delay=0.01)
+    wait_for(lambda: sum(len(ids) for ids in conn.acks) == 2)
+    self.assertEqual(sorted(i for ids in conn.acks for i in ids), [0, 0])
+    consumer.close()
+
+  def test_handler_errors_and_keyspace_ids(self):
+    conn = FakeConnection(['-80', '80-'], 10)
+    conn.ack_event.set()
+
+    def handler(row):
+      if row[0] % 2:
+        raise ValueError('odd')
+
+    consumer = self.make_consumer(conn, handler,
+                                  keyspace_id_func=lambda row: row[1])
+    wait_for(lambda: consumer.stats()['handler_errors'] == 10)
+    consumer.close()
+    acked = sorted(pair for ids in conn.acks for pair in ids)
+    self.assertEqual(acked, sorted((i, '%s-%d' % (shard, i))
+                                   for shard in ('-80', '80-')
+                                   for i in xrange(0, 10, 2)))
+
+  def test_ack_errors(self):
+    conn = FakeConnection(['-80', '80-'], 5)
+    conn.ack_error = dbexceptions.TransientError('busy')
+    conn.ack_event.set()
+    consumer = self.make_consumer(conn, lambda row: None, max_ack_delay=0.01)
+    wait_for(lambda: consumer.stats()['ack_errors'] > 0)
+    consumer.close()
+    stats = consumer.stats()
+    self.assertEqual(stats['acked'], 0)
+    self.assertEqual(stats['handled'], 10)
+
+
+if __name__ == '__main__':
+  unittest.main()
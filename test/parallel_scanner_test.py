@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for parallel_scanner, using a fake connection."""
+
+import threading
+import time
+import unittest
+
+from vtdb import dbexceptions
+from vtdb import parallel_scanner
+
+
+class FakeConnection(object):
+  """Returns 10 rows per keyrange, and fails the first call if asked to."""
+
+  def __init__(self, fail_first=0):
+    self.fail_first = fail_first
+    self.queries = []
+    self.lock = threading.Lock()
+
+  def _stream_execute(self, sql, bind_variables, tablet_type,
+                      keyspace_name=None, keyranges=None, **kwargs):
+    with self.lock:
+      self.queries.append((sql, bind_variables))
+      if self.fail_first:
+        self.fail_first -= 1
+        raise dbexceptions.TransientError('try again')
+    kr = keyranges[0]
+    rows = [(kr.Start.encode('hex'), i) for i in xrange(10)]
+    return (r for r in rows), [('kr', 0), ('i', 0)]
+
+
+class BlockedRows(object):
+  """Yields rows, then blocks until cancelled, like a quiet stream."""
+
+  def __init__(self, rows):
+    self.rows = iter(rows)
+    self.cancelled = threading.Event()
+    self.closed = threading.Event()
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    for row in self.rows:
+      return row
+    self.cancelled.wait(5)
+    raise dbexceptions.OperationalError('cancelled')
+
+  def cancel(self):
+    self.cancelled.set()
+
+  def close(self):
+    self.closed.set()
+
+
+class BlockingConnection(object):
+  """Returns 2 rows per keyrange, and then blocks."""
+
+  def __init__(self):
+    self.streams = []
+    self.lock = threading.Lock()
+
+  def _stream_execute(self, sql, bind_variables, tablet_type, **kwargs):
+    stream = BlockedRows([(1,), (2,)])
+    with self.lock:
+      self.streams.append(stream)
+    return stream, [('i', 0)]
+
+
+def wait_for_threads_exit():
+  """Waits for the stream threads of a cancelled scan to exit."""
+  deadline = time.time() + 1
+  while threading.active_count() > 1 and time.time() < deadline:
+    time.sleep(0.01)
+  return threading.active_count() == 1
+
+
+class TestParallelScanner(unittest.TestCase):
+
+  def test_scan(self):
+    conn = FakeConnection()
+    scanner = parallel_scanner.ParallelScanner(
+        conn, 'ks', 'rdonly', 4, shard_count=2, num_threads=2, chunk_size=3,
+        max_pending_chunks=2)
+    rows = list(scanner.scan('select kr, i from t', {'x': 1}, 'i > %(x)s'))
+    self.assertEqual(len(rows), 40)
+    self.assertEqual(len(set(rows)), 40)
+    self.assertEqual(scanner.fields, [('kr', 0), ('i', 0)])
+    self.assertEqual(sorted(s.rows for s in scanner.stats.values()),
+                     [10] * 4)
+    # Each keyrange gets its own where clause, in the :name format.
+    sql, bind_vars = sorted(conn.queries)[0]
+    self.assertIn('WHERE i > :x AND keyspace_id', sql)
+    self.assertEqual(bind_vars['x'], 1)
+
+  def test_retry(self):
+    conn = FakeConnection(fail_first=2)
+    scanner = parallel_scanner.ParallelScanner(
+        conn, 'ks', 'rdonly', 2, num_threads=1)
+    self.assertEqual(len(list(scanner.scan('select kr, i from t'))), 20)
+    self.assertEqual(sum(s.retries for s in scanner.stats.values()), 2)
+
+  def test_too_many_errors(self):
+    conn = FakeConnection(fail_first=10)
+    scanner = parallel_scanner.ParallelScanner(
+        conn, 'ks', 'rdonly', 2, num_threads=1, num_retries=1)
+    self.assertRaises(dbexceptions.TransientError, list,
+                      scanner.scan('select kr, i from t'))
+
+  def test_cancel(self):
+    conn = FakeConnection()
+    scanner = parallel_scanner.ParallelScanner(
+        conn, 'ks', 'rdonly', 8, num_threads=2, chunk_size=1,
+        max_pending_chunks=1)
+    rows = []
+    for row in scanner.scan('select kr, i from t'):
+      rows.append(row)
+      if len(rows) == 5:
+        scanner.cancel()
+    self.assertLess(len(rows), 80)
+    self.assertTrue(wait_for_threads_exit())
+
+  def test_cancel_blocked_streams(self):
+    conn = BlockingConnection()
+    scanner = parallel_scanner.ParallelScanner(
+        conn, 'ks', 'rdonly', 4, num_threads=4, chunk_size=1)
+    rows = []
+    for row in scanner.scan('select i from t'):
+      rows.append(row)
+      if len(rows) == 8:
+        scanner.cancel()
+    self.assertEqual(len(rows), 8)
+    # The blocked reads were cancelled, and the streams closed.
+    self.assertEqual(len(conn.streams), 4)
+    for stream in conn.streams:
+      self.assertTrue(stream.cancelled.is_set())
+      self.assertTrue(stream.closed.wait(1))
+    self.assertTrue(wait_for_threads_exit())
+
+
+if __name__ == '__main__':
+  unittest.main()
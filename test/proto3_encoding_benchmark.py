@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks for the proto3 encoding and decoding in proto3_encoding.
+
+This is not a test, run it manually:
+  test/proto3_encoding_benchmark.py --rows 50000
+"""
+
+import optparse
+import random
+import timeit
+
+from vtproto import query_pb2
+
+from vtdb import proto3_encoding
+
+
+FIELDS = [
+    ('id', query_pb2.INT64),
+    ('user_id', query_pb2.UINT64),
+    ('score', query_pb2.FLOAT64),
+    ('name', query_pb2.VARCHAR),
+    ('created', query_pb2.DATETIME),
+]
+
+
+# NUMERIC_FIELDS is the number of leading numeric FIELDS.
+NUMERIC_FIELDS = 3
+
+
+def make_query_result(num_rows, num_fields=len(FIELDS)):
+  """Builds a query_pb2.QueryResult with num_rows random rows."""
+  qr = query_pb2.QueryResult()
+  for name, field_type in FIELDS[:num_fields]:
+    qr.fields.add(name=name, type=field_type)
+  for i in xrange(num_rows):
+    values = [
+        str(i),
+        str(random.randint(0, (1 << 64) - 1)),
+        repr(random.random() * 1000),
+        'name_%d' % random.randint(0, 1000000),
+        '2019-01-%02d 12:34:56' % random.randint(1, 28),
+    ][:num_fields]
+    row = qr.rows.add()
+    row.lengths.extend(len(v) for v in values)
+    row.values = ''.join(values)
+  return qr
+
+
+def bench(name, func, repeat):
+  best = min(timeit.repeat(func, number=1, repeat=repeat))
+  print '%-20s %8.2f ms' % (name, best * 1000)
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--rows', type='int', default=50000,
+                    help='number of rows in the result')
+  parser.add_option('--ids', type='int', default=5000,
+                    help='number of values in the TUPLE bind variable')
+  parser.add_option('--numeric', action='store_true',
+                    help='only decode the numeric columns')
+  parser.add_option('--repeat', type='int', default=5,
+                    help='number of runs, the best one is reported')
+  options, _ = parser.parse_args()
+
+  num_fields = NUMERIC_FIELDS if options.numeric else len(FIELDS)
+  qr = make_query_result(options.rows, num_fields)
+  conn = proto3_encoding.Proto3Connection()
+  _, convs = conn.build_conversions(qr.fields)
+  print 'decoding %d rows of %d columns (numpy: %s)' % (
+      options.rows, num_fields, proto3_encoding.numpy is not None)
+  bench('make_row', lambda: [
+      tuple(proto3_encoding.make_row(row, convs)) for row in qr.rows],
+        options.repeat)
+  bench('rows', lambda: conn._get_rowset_from_query_result(qr),
+        options.repeat)
+  bench('columnar', lambda: conn._get_columns_from_query_result(qr),
+        options.repeat)
+
+  ids = range(options.ids)
+  print 'encoding a TUPLE bind variable of %d ids' % options.ids
+
+  def encode_one_by_one():
+    bv = query_pb2.BindVariable(type=query_pb2.TUPLE)
+    for v in ids:
+      proto3_encoding.convert_value(v, bv.values.add())
+
+  bench('one by one', encode_one_by_one, options.repeat)
+  bench('tuple', lambda: proto3_encoding.convert_value(
+      ids, query_pb2.BindVariable(), allow_lists=True), options.repeat)
+
+
+if __name__ == '__main__':
+  main()
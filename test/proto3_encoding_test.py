@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the proto3 result decoding in proto3_encoding."""
+
+import datetime
+import unittest
+
+from vtproto import binlogdata_pb2
+from vtproto import query_pb2
+from vtproto import vtgate_pb2
+
+from vtdb import dbexceptions
+from vtdb import proto3_encoding
+from vtdb import vtgate_cursor
+
+
+def make_query_result(fields, rows):
+  """Builds a query_pb2.QueryResult from (name, type) fields and rows."""
+  qr = query_pb2.QueryResult()
+  for name, field_type in fields:
+    qr.fields.add(name=name, type=field_type)
+  for row in rows:
+    r = qr.rows.add()
+    for v in row:
+      if v is None:
+        r.lengths.append(-1)
+      else:
+        r.lengths.append(len(v))
+        r.values += v
+  return qr
+
+
+FIELDS = [
+    ('id', query_pb2.INT64),
+    ('big', query_pb2.UINT64),
+    ('score', query_pb2.FLOAT64),
+    ('name', query_pb2.VARCHAR),
+    ('count', query_pb2.INT32),
+]
+
+ROWS = [
+    ('1', '18446744073709551615', '1.5', 'alice', '10'),
+    ('-2', '0', '-3.25', None, None),
+    ('3', '7', '0', '', '12'),
+]
+
+
+class TestColumnarDecoding(unittest.TestCase):
+
+  def setUp(self):
+    self.conn = proto3_encoding.Proto3Connection()
+    self.qr = make_query_result(FIELDS, ROWS)
+
+  def test_columns_match_rows(self):
+    rows, _, _, fields = self.conn._get_rowset_from_query_result(self.qr)
+    columns, _, _, columnar_fields = (
+        self.conn._get_columns_from_query_result(self.qr))
+    self.assertEqual(fields, columnar_fields)
+    self.assertEqual(len(columns), len(FIELDS))
+    self.assertEqual(rows, vtgate_cursor.ColumnarRows(columns)[:])
+
+  def test_numeric_columns(self):
+    if proto3_encoding.numpy is None:
+      self.skipTest('numpy is not installed')
+    columns, _, _, _ = self.conn._get_columns_from_query_result(self.qr)
+    self.assertEqual(columns[0].dtype.name, 'int64')
+    self.assertEqual(columns[1].dtype.name, 'uint64')
+    self.assertEqual(columns[2].dtype.name, 'float64')
+    # Strings and columns with NULLs are object arrays.
+    self.assertEqual(columns[3].dtype.name, 'object')
+    self.assertEqual(columns[4].dtype.name, 'object')
+    self.assertEqual(list(columns[1]), [18446744073709551615, 0, 7])
+    self.assertEqual(list(columns[4]), [10, None, 12])
+
+  def test_datetime_columns(self):
+    fields = [('d', query_pb2.DATETIME)]
+    for values, expected in (
+        (['2019-01-02 03:04:05', '2019-12-31T23:59:59'],
+         [datetime.datetime(2019, 1, 2, 3, 4, 5),
+          datetime.datetime(2019, 12, 31, 23, 59, 59)]),
+        # Invalid dates and fractional seconds are left to DateTimeOrNone.
+        (['0000-00-00 00:00:00', '2019-01-02 03:04:05'],
+         [None, datetime.datetime(2019, 1, 2, 3, 4, 5)]),
+        (['2019-01-02 03:04:05.5', None],
+         [None, None])):
+      qr = make_query_result(fields, [(v,) for v in values])
+      columns, _, _, _ = self.conn._get_columns_from_query_result(qr)
+      self.assertEqual(list(columns[0]), expected)
+
+  def test_without_numpy(self):
+    rows, _, _, _ = self.conn._get_rowset_from_query_result(self.qr)
+    numpy = proto3_encoding.numpy
+    proto3_encoding.numpy = None
+    try:
+      columns, _, _, _ = self.conn._get_columns_from_query_result(self.qr)
+    finally:
+      proto3_encoding.numpy = numpy
+    self.assertEqual(rows, vtgate_cursor.ColumnarRows(columns)[:])
+
+  def test_empty_result(self):
+    qr = make_query_result(FIELDS, [])
+    columns, _, _, _ = self.conn._get_columns_from_query_result(qr)
+    self.assertEqual([len(c) for c in columns], [0] * len(FIELDS))
+    self.assertEqual(len(vtgate_cursor.ColumnarRows(columns)), 0)
+
+
+class TestRowDecoderCache(unittest.TestCase):
+
+  def test_decoder_matches_make_row(self):
+    qr = make_query_result(FIELDS, ROWS)
+    cache = proto3_encoding.RowDecoderCache()
+    fields, decoder = cache.get(qr.fields)
+    self.assertEqual(fields, FIELDS)
+    convs = [proto3_encoding.conversions.get(t) for _, t in FIELDS]
+    for row in qr.rows:
+      self.assertEqual(decoder(row),
+                       tuple(proto3_encoding.make_row(row, convs)))
+
+  def test_views(self):
+    fields = FIELDS + [('price', query_pb2.DECIMAL)]
+    rows = [row + ('1.10',) for row in ROWS]
+    qr = make_query_result(fields, rows)
+    convs = [proto3_encoding.conversions.get(t) for _, t in fields]
+    _, decoder = proto3_encoding.RowDecoderCache().get(qr.fields)
+    _, view_decoder = proto3_encoding.RowDecoderCache().get(
+        qr.fields, views=True)
+    for row in qr.rows:
+      expected = decoder(row)
+      for values in (view_decoder(row),
+                     proto3_encoding.make_row(row, convs, views=True)):
+        self.assertEqual(tuple(values), expected)
+        name = values[3]
+        if name is not None:
+          self.assertIsInstance(name, memoryview)
+          self.assertEqual(name.tobytes(), expected[3])
+        self.assertNotIsInstance(values[0], memoryview)
+
+  def test_no_fields(self):
+    qr = make_query_result([], [()])
+    _, decoder = proto3_encoding.RowDecoderCache().get(qr.fields)
+    self.assertEqual(decoder(qr.rows[0]), ())
+
+  def test_lru(self):
+    cache = proto3_encoding.RowDecoderCache(capacity=2)
+    qr1 = make_query_result(FIELDS[:1], [])
+    qr2 = make_query_result(FIELDS[:2], [])
+    qr3 = make_query_result(FIELDS[:3], [])
+    _, d1 = cache.get(qr1.fields)
+    cache.get(qr2.fields)
+    # Same shape from a different result is a hit.
+    _, d1_again = cache.get(make_query_result(FIELDS[:1], []).fields)
+    self.assertIs(d1, d1_again)
+    # qr2 is the least recently used, it gets evicted.
+    cache.get(qr3.fields)
+    cache.get(qr2.fields)
+    stats = cache.stats()
+    self.assertEqual(stats['size'], 2)
+    self.assertEqual(stats['hits'], 1)
+    self.assertEqual(stats['misses'], 4)
+    self.assertEqual(stats['evictions'], 2)
+    self.assertEqual(stats['hit_rate'], 0.2)
+
+
+class Literal(object):
+
+  def __sql_literal__(self):
+    return 'literal'
+
+
+class Point(object):
+
+  def __init__(self, x, y):
+    self.x = x
+    self.y = y
+
+
+class TestConvertValue(unittest.TestCase):
+
+  def convert(self, value, allow_lists=True):
+    bv = query_pb2.BindVariable()
+    proto3_encoding.convert_value(value, bv, allow_lists=allow_lists)
+    return bv
+
+  def test_scalars(self):
+    for value, value_type, encoded in [
+        (True, query_pb2.INT64, '1'),
+        (-3, query_pb2.INT64, '-3'),
+        (5L, query_pb2.INT64, '5'),
+        (1 << 63, query_pb2.UINT64, str(1 << 63)),
+        (1.5, query_pb2.FLOAT64, '1.5'),
+        ('abc', query_pb2.VARBINARY, 'abc'),
+        (None, query_pb2.NULL_TYPE, ''),
+        (datetime.date(2019, 1, 2), query_pb2.VARBINARY, '2019-01-02'),
+        (Literal(), query_pb2.VARBINARY, 'literal'),
+        (u'abc', query_pb2.VARBINARY, 'abc'),
+        ([1], query_pb2.VARBINARY, '[1]'),
+    ]:
+      bv = self.convert(value, allow_lists=False)
+      self.assertEqual((bv.type, bv.value), (value_type, encoded), value)
+
+  def test_tuples(self):
+    for values in [
+        range(1000),
+        [1L, (1 << 64) - 1],
+        ['a', 'b' * 300, ''],
+        (0.5, 2.0),
+        [None, None],
+        [1, 'a', None, 2.5],
+        [datetime.date(2019, 1, 2)] * 2,
+        [],
+    ]:
+      bv = self.convert(values)
+      expected = query_pb2.BindVariable(type=query_pb2.TUPLE)
+      for v in values:
+        proto3_encoding.convert_value(v, expected.values.add())
+      self.assertEqual(bv, expected, values)
+
+  def test_register_encoder(self):
+    def encode_point(p):
+      return query_pb2.VARCHAR, '%d,%d' % (p.x, p.y)
+    proto3_encoding.register_encoder(Point, encode_point)
+    try:
+      bv = self.convert(Point(1, 2))
+      self.assertEqual((bv.type, bv.value), (query_pb2.VARCHAR, '1,2'))
+      bv = self.convert([Point(1, 2), Point(3, 4)])
+      self.assertEqual([v.value for v in bv.values], ['1,2', '3,4'])
+    finally:
+      del proto3_encoding.value_encoders[Point]
+      del proto3_encoding._resolved_encoders[Point]
+
+  def test_entity_ids(self):
+    conn = proto3_encoding.Proto3Connection()
+    request = vtgate_pb2.ExecuteEntityIdsRequest()
+    conn._convert_entity_ids({1: '\x01', None: '\x02'},
+                             request.entity_keyspace_ids)
+    eids = sorted((e.keyspace_id, e.type, e.value)
+                  for e in request.entity_keyspace_ids)
+    self.assertEqual(eids, [('\x01', query_pb2.INT64, '1'),
+                            ('\x02', query_pb2.NULL_TYPE, '')])
+
+
+def make_vstream_responses(transactions):
+  """Builds VStreamResponses, one per transaction of (before, after) rows."""
+  qr = make_query_result(FIELDS, [])
+  responses = []
+  for i, changes in enumerate(transactions):
+    response = vtgate_pb2.VStreamResponse()
+    if i == 0:
+      field_event = response.events.add(type=binlogdata_pb2.FIELD)
+      field_event.field_event.table_name = 't'
+      field_event.field_event.fields.extend(qr.fields)
+    response.events.add(type=binlogdata_pb2.BEGIN)
+    row_event = response.events.add(type=binlogdata_pb2.ROW)
+    row_event.row_event.table_name = 't'
+    for before, after in changes:
+      change = row_event.row_event.row_changes.add()
+      for image, row in ((change.before, before), (change.after, after)):
+        if row is not None:
+          image.CopyFrom(make_query_result(FIELDS, [row]).rows[0])
+    vgtid_event = response.events.add(type=binlogdata_pb2.VGTID)
+    vgtid_event.vgtid.shard_gtids.add(keyspace='ks', shard='0',
+                                      gtid='pos-%d' % i)
+    response.events.add(type=binlogdata_pb2.COMMIT, timestamp=100 + i)
+    responses.append(response)
+  return responses
+
+
+class TestVStreamDecoder(unittest.TestCase):
+
+  TRANSACTIONS = [
+      [(None, ROWS[0]), (ROWS[1], ROWS[2])],
+      [(ROWS[2], None)],
+  ]
+
+  def test_rows(self):
+    changes = list(proto3_encoding.VStreamDecoder().rows(
+        make_vstream_responses(self.TRANSACTIONS)))
+    self.assertEqual([c.op for c in changes], ['insert', 'update', 'delete'])
+    make_row = lambda row: tuple(proto3_encoding.make_row(
+        row, [proto3_encoding.conversions.get(t) for _, t in FIELDS]))
+    qr = make_query_result(FIELDS, ROWS)
+    self.assertEqual(changes[0].before, None)
+    self.assertEqual(changes[0].after, make_row(qr.rows[0]))
+    self.assertEqual(changes[1].before, make_row(qr.rows[1]))
+    self.assertEqual(changes[2].after, None)
+    self.assertEqual(changes[0].fields, FIELDS)
+    # The changes of the second transaction resume from the first.
+    self.assertEqual(changes[0].vgtid, None)
+    self.assertEqual(changes[2].vgtid.shard_gtids[0].gtid, 'pos-0')
+
+  def test_transactions(self):
+    transactions = list(proto3_encoding.VStreamDecoder().transactions(
+        make_vstream_responses(self.TRANSACTIONS)))
+    self.assertEqual([len(t) for t in transactions], [2, 1])
+    self.assertEqual([t.timestamp for t in transactions], [100, 101])
+    self.assertEqual(transactions[1].vgtid.shard_gtids[0].gtid, 'pos-1')
+    table = transactions[0].tables[0]
+    self.assertEqual(table.table_name, 't')
+    self.assertEqual(table.ops, ['insert', 'update'])
+    self.assertEqual(list(table.before[0]), [None, -2])
+    self.assertEqual(list(table.after[0]), [1, 3])
+    self.assertEqual(list(table.after[3]), ['alice', ''])
+
+  def test_missing_field_event(self):
+    responses = make_vstream_responses(self.TRANSACTIONS)
+    del responses[0].events[0]
+    self.assertRaises(dbexceptions.ProgrammingError, list,
+                      proto3_encoding.VStreamDecoder().rows(responses))
+
+  def test_request(self):
+    request = proto3_encoding.Proto3Connection().vstream_request(
+        'replica', [('ks', '-80', 'current')], [('t', 'select * from t')],
+        None)
+    self.assertEqual(request.vgtid.shard_gtids[0].shard, '-80')
+    self.assertEqual(request.filter.rules[0].match, 't')
+
+
+if __name__ == '__main__':
+  unittest.main()
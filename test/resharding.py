@@ -578,14 +578,18 @@ primary key (name)
                      'test_keyspace',
                      'custom_ksid_col', base_sharding.keyspace_id_type])
 
-    shard_0_master.init_tablet('replica', 'test_keyspace', '-80')
-    shard_0_replica.init_tablet('replica', 'test_keyspace', '-80')
-    shard_0_ny_rdonly.init_tablet('rdonly', 'test_keyspace', '-80')
-    shard_1_master.init_tablet('replica', 'test_keyspace', '80-')
-    shard_1_slave1.init_tablet('replica', 'test_keyspace', '80-')
-    shard_1_slave2.init_tablet('replica', 'test_keyspace', '80-')
-    shard_1_ny_rdonly.init_tablet('rdonly', 'test_keyspace', '80-')
-    shard_1_rdonly1.init_tablet('rdonly', 'test_keyspace', '80-')
+    utils.run_vtctl_all([
+        shard_0_master.init_tablet_command('replica', 'test_keyspace', '-80'),
+        shard_0_replica.init_tablet_command('replica', 'test_keyspace', '-80'),
+        shard_0_ny_rdonly.init_tablet_command('rdonly', 'test_keyspace',
+                                              '-80'),
+        shard_1_master.init_tablet_command('replica', 'test_keyspace', '80-'),
+        shard_1_slave1.init_tablet_command('replica', 'test_keyspace', '80-'),
+        shard_1_slave2.init_tablet_command('replica', 'test_keyspace', '80-'),
+        shard_1_ny_rdonly.init_tablet_command('rdonly', 'test_keyspace',
+                                              '80-'),
+        shard_1_rdonly1.init_tablet_command('rdonly', 'test_keyspace', '80-'),
+    ])
 
     utils.run_vtctl(['RebuildKeyspaceGraph', 'test_keyspace'], auto_log=True)
     ks = utils.run_vtctl_json(['GetSrvKeyspace', 'test_nj', 'test_keyspace'])
@@ -633,13 +637,19 @@ primary key (name)
       utils.run_vtctl(['RunHealthCheck', t.tablet_alias])
 
     # create the split shards
-    shard_2_master.init_tablet('replica', 'test_keyspace', '80-c0')
-    shard_2_replica1.init_tablet('replica', 'test_keyspace', '80-c0')
-    shard_2_replica2.init_tablet('replica', 'test_keyspace', '80-c0')
-    shard_2_rdonly1.init_tablet('rdonly', 'test_keyspace', '80-c0')
-    shard_3_master.init_tablet('replica', 'test_keyspace', 'c0-')
-    shard_3_replica.init_tablet('replica', 'test_keyspace', 'c0-')
-    shard_3_rdonly1.init_tablet('rdonly', 'test_keyspace', 'c0-')
+    utils.run_vtctl_all([
+        shard_2_master.init_tablet_command('replica', 'test_keyspace',
+                                           '80-c0'),
+        shard_2_replica1.init_tablet_command('replica', 'test_keyspace',
+                                             '80-c0'),
+        shard_2_replica2.init_tablet_command('replica', 'test_keyspace',
+                                             '80-c0'),
+        shard_2_rdonly1.init_tablet_command('rdonly', 'test_keyspace',
+                                            '80-c0'),
+        shard_3_master.init_tablet_command('replica', 'test_keyspace', 'c0-'),
+        shard_3_replica.init_tablet_command('replica', 'test_keyspace', 'c0-'),
+        shard_3_rdonly1.init_tablet_command('rdonly', 'test_keyspace', 'c0-'),
+    ])
 
     # start vttablet on the split shards (no db created,
     # so they're all not serving)
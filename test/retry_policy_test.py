@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for retry_policy."""
+
+import random
+import time
+import unittest
+
+from vtproto import vtgate_pb2
+
+from vtdb import dbexceptions
+from vtdb import retry_policy
+
+sleeps = []
+
+
+class FakeConnection(object):
+
+  def __init__(self, failures, exc=dbexceptions.TransientError, timeout=10):
+    self.failures = failures
+    self.exc = exc
+    self.calls = 0
+    self.timeouts = []
+    self.session = None
+    self.timeout = timeout
+
+  @retry_policy.retry((dbexceptions.TransientError,
+                       dbexceptions.ThrottledError), sleep=sleeps.append)
+  def method(self):
+    self.calls += 1
+    self.timeouts.append(retry_policy.rpc_timeout(self.timeout))
+    if self.calls <= self.failures:
+      raise self.exc('failure %d' % self.calls)
+    return self.calls
+
+
+class TestRetry(unittest.TestCase):
+
+  def setUp(self):
+    del sleeps[:]
+    retry_policy.retry_stats.clear()
+
+  def test_recovers(self):
+    conn = FakeConnection(2)
+    self.assertEqual(conn.method(), 3)
+    self.assertEqual(len(sleeps), 2)
+    self.assertTrue(all(t <= 10 for t in conn.timeouts))
+    stats = retry_policy.retry_stats.stats()['method']
+    self.assertEqual((stats['retries'], stats['recovered']), (2, 1))
+    # The deadline is only set during the call.
+    self.assertEqual(retry_policy.rpc_timeout(10), 10)
+
+  def test_exhausted(self):
+    conn = FakeConnection(10)
+    self.assertRaises(dbexceptions.TransientError, conn.method)
+    self.assertEqual(conn.calls, retry_policy.DEFAULT_POLICY.num_retries + 1)
+    self.assertEqual(retry_policy.retry_stats.stats()['method']['exhausted'],
+                     1)
+
+  def test_no_retry_in_transaction(self):
+    conn = FakeConnection(1)
+    conn.session = vtgate_pb2.Session(in_transaction=True)
+    self.assertRaises(dbexceptions.TransientError, conn.method)
+    self.assertEqual(conn.calls, 1)
+    # A session outside a transaction does not prevent retries.
+    conn = FakeConnection(1)
+    conn.session = vtgate_pb2.Session()
+    self.assertEqual(conn.method(), 2)
+
+  def test_deadline(self):
+    conn = FakeConnection(1)
+    self.assertRaises(dbexceptions.TransientError, conn.method,
+                      deadline=time.time() + 0.001)
+    self.assertEqual(conn.calls, 1)
+    self.assertTrue(conn.timeouts[0] <= 0.001)
+    self.assertEqual(
+        retry_policy.retry_stats.stats()['method']['deadline_exceeded'], 1)
+
+  def test_budget(self):
+    conn = FakeConnection(100)
+    conn.retry_policy = retry_policy.RetryPolicy(num_retries=100)
+    self.assertRaises(dbexceptions.TransientError, conn.method)
+    self.assertEqual(conn.calls, int(retry_policy.RETRY_BUDGET_TOKENS) + 1)
+    self.assertEqual(
+        retry_policy.retry_stats.stats()['method']['budget_exhausted'], 1)
+
+
+class TestPolicies(unittest.TestCase):
+
+  def test_decorrelated_jitter(self):
+    policy = retry_policy.RetryPolicy(initial_delay_ms=5, max_delay_ms=100,
+                                      rand=random.Random(1))
+    delays = []
+    for _ in xrange(100):
+      delay = 0
+      for _ in xrange(3):
+        delay = policy.next_delay_ms(delay, dbexceptions.TransientError())
+      delays.append(delay)
+    self.assertTrue(all(5 <= d <= 100 for d in delays))
+    self.assertTrue(len(set(delays)) > 50)
+
+  def test_throttled(self):
+    policy = retry_policy.RetryPolicy(throttled_delay_ms=50)
+    self.assertTrue(
+        policy.next_delay_ms(0, dbexceptions.ThrottledError()) >= 50)
+
+  def test_exponential_backoff(self):
+    policy = retry_policy.ExponentialBackoffPolicy()
+    delays = [policy.next_delay_ms(0, None)]
+    for _ in xrange(6):
+      delays.append(policy.next_delay_ms(delays[-1], None))
+    self.assertEqual(delays, [5, 10, 20, 40, 80, 100, 100])
+    self.assertEqual(policy.new_budget(), None)
+
+  def test_budget_refill(self):
+    budget = retry_policy.RetryBudget(max_tokens=2, tokens_per_second=0,
+                                      success_credit=0.5)
+    self.assertTrue(budget.try_acquire())
+    self.assertTrue(budget.try_acquire())
+    self.assertFalse(budget.try_acquire())
+    budget.record_success()
+    budget.record_success()
+    self.assertTrue(budget.try_acquire())
+
+
+if __name__ == '__main__':
+  unittest.main()
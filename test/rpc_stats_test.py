@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for rpc_stats, and the instrumentation of grpc_vtgate_client."""
+
+import unittest
+
+from vtproto import query_pb2
+from vtproto import vtgate_pb2
+from vtproto import vtrpc_pb2
+
+from vtdb import dbexceptions
+from vtdb import grpc_vtgate_client
+from vtdb import retry_policy
+from vtdb import rpc_stats
+
+
+class RecordingObserver(rpc_stats.RpcObserver):
+
+  def __init__(self):
+    self.events = []
+
+  def observe(self, event):
+    self.events.append(event)
+
+
+class TestHistogramObserver(unittest.TestCase):
+
+  def test_histogram(self):
+    histogram = rpc_stats.Histogram((1, 10, 100))
+    for value in (0, 1, 5, 50, 500):
+      histogram.add(value)
+    self.assertEqual(histogram.cumulative_counts(),
+                     [(1, 2), (10, 3), (100, 4), (float('inf'), 5)])
+    self.assertEqual(histogram.sum, 556)
+    self.assertEqual(histogram.quantile(0.5), 10)
+    self.assertEqual(histogram.quantile(1), float('inf'))
+
+  def test_prometheus_text(self):
+    observer = rpc_stats.HistogramObserver(time_buckets=(0.01, 0.1),
+                                           size_buckets=(10,))
+    observer.observe(rpc_stats.RpcEvent(
+        'ExecuteShards', 'ks', 'replica', build_time=0.001, wire_time=0.05,
+        decode_time=0.002, rows=20, retries=1))
+    observer.observe(rpc_stats.RpcEvent(
+        'ExecuteShards', 'ks', 'replica', wire_time=0.5,
+        error=dbexceptions.TimeoutError('slow')))
+    self.assertEqual(
+        observer.histogram('ExecuteShards', 'ks', 'replica',
+                           'wire_time').counts, [0, 1, 1])
+    self.assertIsNone(observer.histogram('Execute', None, None, 'rows'))
+
+    text = observer.prometheus_text()
+    labels = 'method="ExecuteShards",keyspace="ks",tablet_type="replica"'
+    for line in (
+        '# TYPE vtdb_rpc_wire_time_seconds histogram',
+        'vtdb_rpc_wire_time_seconds_bucket{%s,le="0.01"} 0' % labels,
+        'vtdb_rpc_wire_time_seconds_bucket{%s,le="0.1"} 1' % labels,
+        'vtdb_rpc_wire_time_seconds_bucket{%s,le="+Inf"} 2' % labels,
+        'vtdb_rpc_wire_time_seconds_count{%s} 2' % labels,
+        'vtdb_rpc_rows_bucket{%s,le="10.0"} 1' % labels,
+        'vtdb_rpc_rows_sum{%s} 20.0' % labels,
+        'vtdb_rpc_retries_total{%s} 1' % labels,
+        'vtdb_rpc_errors_total{%s} 1' % labels):
+      self.assertIn(line + '\n', text)
+
+
+def _result(num_rows):
+  result = query_pb2.QueryResult()
+  field = result.fields.add()
+  field.name = 'id'
+  field.type = query_pb2.INT64
+  for i in xrange(num_rows):
+    row = result.rows.add()
+    row.lengths.append(len(str(i)))
+    row.values = str(i)
+  return result
+
+
+class FakeStub(object):
+
+  def __init__(self, failures=0):
+    self.failures = failures
+
+  def ExecuteShards(self, unused_request, unused_timeout):
+    response = vtgate_pb2.ExecuteShardsResponse()
+    if self.failures:
+      self.failures -= 1
+      response.error.code = vtrpc_pb2.UNAVAILABLE
+      response.error.message = 'no serving tablet'
+      return response
+    response.result.CopyFrom(_result(3))
+    return response
+
+  def StreamExecuteShards(self, unused_request, unused_timeout):
+    first = vtgate_pb2.StreamExecuteShardsResponse()
+    first.result.fields.extend(_result(0).fields)
+    responses = [first]
+    for num_rows in (2, 5):
+      response = vtgate_pb2.StreamExecuteShardsResponse()
+      response.result.rows.extend(_result(num_rows).rows)
+      responses.append(response)
+    return iter(responses)
+
+
+class TestGRPCVTGateConnection(unittest.TestCase):
+
+  def setUp(self):
+    self.observer = RecordingObserver()
+    rpc_stats.register_observer(self.observer)
+    self.conn = grpc_vtgate_client.GRPCVTGateConnection('localhost:1', 10)
+    self.conn.retry_policy = retry_policy.RetryPolicy(
+        initial_delay_ms=1, max_delay_ms=1)
+
+  def tearDown(self):
+    rpc_stats.unregister_observer(self.observer)
+
+  def test_execute(self):
+    self.conn.stub = FakeStub(failures=1)
+    results, _, _, _ = self.conn._execute(
+        'select id from t', {}, 'REPLICA', keyspace_name='ks',
+        shards=['-80'])
+    self.assertEqual(results, [(0,), (1,), (2,)])
+
+    self.assertEqual(len(self.observer.events), 2)
+    failed, event = self.observer.events
+    self.assertIsInstance(failed.error, dbexceptions.TransientError)
+    self.assertEqual(failed.retries, 0)
+    self.assertEqual(event.method, 'ExecuteShards')
+    self.assertEqual(event.keyspace, 'ks')
+    self.assertEqual(event.tablet_type, 'replica')
+    self.assertEqual(event.retries, 1)
+    self.assertEqual(event.rows, 3)
+    self.assertIsNone(event.error)
+    self.assertGreater(event.bytes_sent, 0)
+    self.assertGreater(event.bytes_received, 0)
+    for t in (event.build_time, event.wire_time, event.decode_time):
+      self.assertGreaterEqual(t, 0)
+
+  def test_retries_total(self):
+    observer = rpc_stats.HistogramObserver()
+    rpc_stats.register_observer(observer)
+    try:
+      self.conn.stub = FakeStub(failures=3)
+      self.conn._execute('select id from t', {}, 'replica',
+                         keyspace_name='ks', shards=['-80'])
+    finally:
+      rpc_stats.unregister_observer(observer)
+    # The call was retried 3 times, in 4 attempts.
+    labels = 'method="ExecuteShards",keyspace="ks",tablet_type="replica"'
+    text = observer.prometheus_text()
+    self.assertIn('vtdb_rpc_retries_total{%s} 3\n' % labels, text)
+    self.assertIn('vtdb_rpc_errors_total{%s} 3\n' % labels, text)
+
+  def test_stream_execute(self):
+    self.conn.stub = FakeStub()
+    rows, _ = self.conn._stream_execute(
+        'select id from t', {}, 'replica', keyspace_name='ks',
+        shards=['-80'])
+    self.assertEqual(self.observer.events, [])
+    self.assertEqual(len(list(rows)), 7)
+    event, = self.observer.events
+    self.assertEqual(event.method, 'StreamExecuteShards')
+    self.assertEqual(event.rows, 7)
+
+  def test_no_observer(self):
+    rpc_stats.unregister_observer(self.observer)
+    self.conn.stub = FakeStub()
+    self.conn._execute('select id from t', {}, 'replica',
+                       keyspace_name='ks', shards=['-80'])
+    self.assertEqual(self.observer.events, [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for srv_keyspace_cache, and the shard lookup of keyspace."""
+
+import random
+import time
+import unittest
+
+from vtdb import dbexceptions
+from vtdb import keyspace
+from vtdb import srv_keyspace_cache
+
+
+def make_keyspace(name, boundaries):
+  """Builds a keyspace.Keyspace with shards between the boundaries."""
+  shards = []
+  for start, end in zip(boundaries, boundaries[1:]):
+    shards.append({
+        'Name': '%s-%s' % (start.encode('hex'), end.encode('hex')),
+        'KeyRange': {'Start': start, 'End': end},
+    })
+  random.Random(1).shuffle(shards)
+  return keyspace.Keyspace(name, {
+      'Partitions': {'master': {'ShardReferences': shards}}})
+
+
+def linear_shard_name(ks, keyspace_id, db_type):
+  """Finds the shard of a keyspace_id with a linear scan."""
+  pkid = keyspace.pack_keyspace_id(keyspace_id)
+  for shard in ks.get_shards(db_type):
+    start = shard['KeyRange']['Start']
+    end = shard['KeyRange']['End']
+    if start <= pkid and (not end or pkid < end):
+      return shard['Name']
+
+
+class FakeConnection(object):
+
+  def __init__(self):
+    self.calls = 0
+    self.error = None
+
+  def get_srv_keyspace(self, name):
+    self.calls += 1
+    if self.error:
+      raise self.error
+    return make_keyspace(name, ['', '\x80', ''])
+
+
+class TestShardLookup(unittest.TestCase):
+
+  def test_same_as_linear_scan(self):
+    boundaries = [''] + [chr(i) for i in xrange(1, 256)] + ['']
+    ks = make_keyspace('ks', boundaries)
+    rnd = random.Random(2)
+    kids = [rnd.randint(1, (1 << 64) - 1) for _ in xrange(1000)]
+    names = ks.keyspace_ids_to_shard_names_for_db_type(kids, 'master')
+    for kid, name in zip(kids, names):
+      self.assertEqual(name, linear_shard_name(ks, kid, 'master'))
+      self.assertEqual(
+          ks.keyspace_id_to_shard_name_for_db_type(kid, 'master'), name)
+      self.assertEqual(ks.keyspace_id_to_shard_name_for_db_type(
+          keyspace.pack_keyspace_id(kid), 'master'), name)
+
+  def test_missing_shard(self):
+    ks = keyspace.Keyspace('ks', {'Partitions': {'master': {
+        'ShardReferences': [
+            {'Name': '40-80', 'KeyRange': {'Start': '\x40', 'End': '\x80'}}
+        ]}}})
+    self.assertEqual(ks.keyspace_id_to_shard_name_for_db_type(
+        0x6000000000000000, 'master'), '40-80')
+    for kid in (0x2000000000000000, 0x8000000000000000):
+      self.assertRaises(ValueError, ks.keyspace_id_to_shard_name_for_db_type,
+                        kid, 'master')
+    self.assertRaises(ValueError, ks.keyspace_id_to_shard_name_for_db_type,
+                      0x6000000000000000, 'replica')
+
+  def test_unsharded(self):
+    ks = keyspace.Keyspace('ks', {'Partitions': {'master': {
+        'ShardReferences': [{'Name': '0'}]}}})
+    self.assertEqual(ks.keyspace_ids_to_shard_names_for_db_type(
+        [1, (1 << 64) - 1], 'master'), ['0', '0'])
+
+
+class TestSrvKeyspaceCache(unittest.TestCase):
+
+  def setUp(self):
+    self.conn = FakeConnection()
+    self.cache = srv_keyspace_cache.SrvKeyspaceCache(
+        self.conn, ttl=60, refresh_interval=0.05)
+
+  def tearDown(self):
+    self.cache.close()
+
+  def test_get(self):
+    ks = self.cache.get('ks')
+    self.assertIs(self.cache.get('ks'), ks)
+    self.assertEqual(self.conn.calls, 1)
+    self.assertEqual(self.cache.keyspace_ids_to_shard_names(
+        'ks', [1, 0x9000000000000000], 'master'), ['-80', '80-'])
+    stats = self.cache.stats()
+    self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+  def test_expired(self):
+    self.cache.ttl = 0
+    self.cache.get('ks')
+    self.conn.error = dbexceptions.TransientError('no vtgate')
+    self.assertRaises(dbexceptions.TransientError, self.cache.get, 'ks')
+
+  def test_background_refresh(self):
+    ks = self.cache.get('ks')
+    self.cache.start()
+    deadline = time.time() + 5
+    while self.cache.get('ks') is ks and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertIsNot(self.cache.get('ks'), ks)
+    self.assertEqual(self.cache.stats()['misses'], 1)
+
+    # Refresh errors keep the previous entry.
+    self.conn.error = dbexceptions.TransientError('no vtgate')
+    ks = self.cache.get('ks')
+    while not self.cache.refresh_errors and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertIs(self.cache.get('ks'), ks)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -390,6 +390,27 @@ class Tablet(object):
                   include_mysql_port=True, external_mysql=False, **kwargs):
     """Initialize a tablet's record in topology."""
 
+    utils.run_vtctl(self.init_tablet_command(
+        tablet_type, keyspace, shard, tablet_index=tablet_index,
+        dbname=dbname, parent=parent, include_mysql_port=include_mysql_port,
+        external_mysql=external_mysql))
+    if start:
+      if not wait_for_start:
+        expected_state = None
+      elif tablet_type == 'master':
+        expected_state = 'SERVING'
+      else:
+        expected_state = 'NOT_SERVING'
+      self.start_vttablet(wait_for_state=expected_state, **kwargs)
+
+  def init_tablet_command(self, tablet_type, keyspace, shard,
+                          tablet_index=None, dbname=None, parent=True,
+                          include_mysql_port=True, external_mysql=False):
+    """Returns the InitTablet vtctl command, to run with others.
+
+    The tablet attributes are set as in init_tablet.
+    """
+
     self.tablet_type = tablet_type
     self.keyspace = keyspace
     self.shard = shard
@@ -413,15 +434,7 @@ class Tablet(object):
     if shard:
       args.extend(['-shard', shard])
     args.extend([self.tablet_alias, tablet_type])
-    utils.run_vtctl(args)
-    if start:
-      if not wait_for_start:
-        expected_state = None
-      elif tablet_type == 'master':
-        expected_state = 'SERVING'
-      else:
-        expected_state = 'NOT_SERVING'
-      self.start_vttablet(wait_for_state=expected_state, **kwargs)
+    return args
 
   @property
   def tablet_dir(self):
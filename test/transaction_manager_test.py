@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for transaction_manager, and the session reuse of grpc_vtgate_client.
+"""
+
+import unittest
+
+from vtproto import vtgate_pb2
+
+from vtdb import dbexceptions
+from vtdb import grpc_vtgate_client
+from vtdb import proto3_encoding
+from vtdb import transaction_manager
+
+
+class FakeVTGate(object):
+  """A channel serving raw requests, adding a shard session per Execute."""
+
+  def __init__(self):
+    self.requests = []
+    self.fail_sql = None
+
+  def unary_unary(self, method):
+    method_name = method.split('/')[-1]
+    request_class = getattr(vtgate_pb2, method_name + 'Request')
+
+    def call(data, unused_timeout):
+      request = request_class.FromString(data)
+      self.requests.append((method_name, request))
+      if method_name == 'Begin':
+        return vtgate_pb2.BeginResponse(
+            session=vtgate_pb2.Session(in_transaction=True)
+        ).SerializeToString()
+      if method_name in ('Commit', 'Rollback'):
+        return getattr(vtgate_pb2, method_name + 'Response')(
+        ).SerializeToString()
+      response = vtgate_pb2.ExecuteResponse()
+      response.session.CopyFrom(request.session)
+      if request.query.sql == self.fail_sql:
+        response.error.code = 3  # INVALID_ARGUMENT
+        response.error.message = 'syntax error'
+      else:
+        shard_session = response.session.shard_sessions.add()
+        shard_session.target.shard = str(len(response.session.shard_sessions))
+        shard_session.transaction_id = 12345
+        response.result.rows_affected = 1
+      return response.SerializeToString()
+    return call
+
+
+def make_connection(vtgate):
+  conn = grpc_vtgate_client.GRPCVTGateConnection('localhost:1', 10)
+  conn._channel = vtgate  # pylint: disable=protected-access
+  conn.stub = object()
+  return conn
+
+
+class FakePool(object):
+
+  def __init__(self, conns):
+    self.idle = list(conns)
+    self.checkins = []
+
+  def checkout(self):
+    return 'endpoint', self.idle.pop()
+
+  def checkin(self, endpoint, conn, error=None):
+    self.checkins.append(error)
+    self.idle.append(conn)
+
+
+class TestSessionWireFormat(unittest.TestCase):
+
+  def test_session_field(self):
+    session = vtgate_pb2.Session(in_transaction=True)
+    session.shard_sessions.add(transaction_id=7)
+    request = vtgate_pb2.ExecuteRequest()
+    request.query.sql = 'select 1'
+    data = request.SerializeToString() + proto3_encoding.session_field(
+        vtgate_pb2.ExecuteRequest, session.SerializeToString())
+    request.session.CopyFrom(session)
+    self.assertEqual(vtgate_pb2.ExecuteRequest.FromString(data), request)
+
+  def test_extract_session_bytes(self):
+    response = vtgate_pb2.ExecuteResponse()
+    response.error.code = 2
+    response.session.in_transaction = True
+    response.result.rows_affected = 300
+    response.result.rows.add(lengths=[1], values='x')
+    data = response.SerializeToString()
+    self.assertEqual(
+        proto3_encoding.extract_session_bytes(vtgate_pb2.ExecuteResponse,
+                                              data),
+        response.session.SerializeToString())
+    self.assertEqual(proto3_encoding.extract_session_bytes(
+        vtgate_pb2.ExecuteResponse, ''), None)
+    self.assertFalse(proto3_encoding.has_session_field(
+        vtgate_pb2.CommitResponse))
+
+
+class TestTransactionManager(unittest.TestCase):
+
+  def setUp(self):
+    self.vtgate = FakeVTGate()
+    self.conns = [make_connection(self.vtgate) for _ in xrange(2)]
+    self.pool = FakePool(self.conns)
+    self.manager = transaction_manager.TransactionManager(self.pool)
+
+  def test_session_round_trip(self):
+    with self.manager.transaction() as tx:
+      for i in xrange(5):
+        cursor = tx.execute('update t set a = 1 where id = :id', {'id': i},
+                            keyspace='ks')
+        self.assertEqual(cursor.rowcount, 1)
+    executes = [r for name, r in self.vtgate.requests if name == 'Execute']
+    self.assertEqual([len(r.session.shard_sessions) for r in executes],
+                     range(5))
+    self.assertTrue(all(r.session.in_transaction for r in executes))
+    commit = self.vtgate.requests[-1]
+    self.assertEqual(commit[0], 'Commit')
+    self.assertEqual(len(commit[1].session.shard_sessions), 5)
+
+    self.assertEqual(tx.stats.statements, 5)
+    self.assertEqual(tx.stats.rpcs, 7)
+    self.assertTrue(tx.stats.bytes_sent > 0)
+    self.assertTrue(tx.stats.bytes_received > 0)
+    self.assertEqual(self.pool.checkins, [None])
+    self.assertEqual(len(self.pool.idle), 2)
+    self.assertFalse(any(conn.reuse_session for conn in self.conns))
+    self.assertEqual(self.conns[1].session, None)
+
+  def test_concurrent_transactions(self):
+    tx1 = self.manager.begin()
+    tx2 = self.manager.begin()
+    self.assertIsNot(tx1.conn, tx2.conn)
+    tx1.execute('insert into t values (1)', {}, keyspace='ks')
+    tx2.rollback()
+    tx1.commit()
+    stats = self.manager.stats()
+    self.assertEqual((stats['commits'], stats['rollbacks']), (1, 1))
+    self.assertRaises(dbexceptions.ProgrammingError, tx1.commit)
+
+  def test_rollback_on_error(self):
+    self.vtgate.fail_sql = 'bad'
+
+    def run():
+      with self.manager.transaction() as tx:
+        tx.execute('insert into t values (1)', {}, keyspace='ks')
+        tx.execute('bad', {}, keyspace='ks')
+
+    self.assertRaises(dbexceptions.ProgrammingError, run)
+    self.assertEqual(self.vtgate.requests[-1][0], 'Rollback')
+    self.assertEqual(self.manager.stats()['rollbacks'], 1)
+
+  def test_cursors_are_recycled(self):
+    for _ in xrange(3):
+      with self.manager.transaction() as tx:
+        cursor = tx.cursor(keyspace='ks')
+        tx.execute('insert into t values (1)', {}, keyspace='ks')
+    # The cursors are closed when the transaction ends.
+    self.assertRaises(dbexceptions.ProgrammingError, cursor.execute,
+                      'select 1', {})
+    stats = self.manager.stats()
+    self.assertEqual(stats['cursors_created'], 2)
+    self.assertEqual(stats['cursors_reused'], 4)
+
+  def test_single_connection(self):
+    manager = transaction_manager.TransactionManager(self.conns[0])
+    with manager.transaction() as tx:
+      tx.execute('insert into t values (1)', {}, keyspace='ks')
+    with manager.transaction() as tx:
+      tx.execute('insert into t values (1)', {}, keyspace='ks')
+    self.assertEqual(manager.stats()['commits'], 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for update_stream_consumer, against a fake connection."""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from vtproto import query_pb2
+
+from vtdb import dbexceptions
+from vtdb import update_stream_consumer
+
+
+class FakeConnection(object):
+  """Streams events with positions 1..num_events, breaking once."""
+
+  def __init__(self, num_events, break_at):
+    self.num_events = num_events
+    self.break_at = break_at
+    self.requests = []
+    self.lock = threading.Lock()
+
+  def update_stream(self, keyspace_name, tablet_type, timestamp=None,
+                    event=None, shard=None, effective_caller_id=None):
+    with self.lock:
+      self.requests.append((shard, event and event.position, timestamp))
+      first_open = len([r for r in self.requests if r[0] == shard]) == 1
+    start = int(event.position) + 1 if event else 1
+    return self._events(shard, start, first_open)
+
+  def _events(self, shard, start, first_open):
+    for position in xrange(start, self.num_events + 1):
+      if first_open and position == self.break_at:
+        raise dbexceptions.TransientError('vtgate restarted')
+      event = query_pb2.StreamEvent()
+      event.event_token.timestamp = 1000 + position
+      event.event_token.position = str(position)
+      event.statements.add(table_name=shard)
+      yield event, 1000 + position
+
+
+class TestUpdateStreamConsumer(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def consume(self, store, num_events, break_at=0):
+    conn = FakeConnection(num_events, break_at)
+    consumer = update_stream_consumer.UpdateStreamConsumer(
+        conn, 'ks', 'replica', store, shards=['-80', '80-'],
+        timestamp=1000, checkpoint_interval=0)
+    consumer.start()
+    events = {'-80': [], '80-': []}
+    for shard, event in consumer.events(timeout=0.5):
+      events[shard].append(int(event.event_token.position))
+    consumer.close()
+    return conn, consumer, events
+
+  def check_stores(self, store_factory):
+    conn, consumer, events = self.consume(store_factory(), 10, break_at=4)
+    # Each shard is in order, and resumed after the last event received.
+    self.assertEqual(events, {'-80': range(1, 11), '80-': range(1, 11)})
+    # The fake streams end after the last event, and are reopened
+    # until the consumer is closed.
+    for shard in ('-80', '80-'):
+      requests = [r for r in conn.requests if r[0] == shard]
+      self.assertEqual(requests[:3], [(shard, None, 1000), (shard, '3', None),
+                                      (shard, '10', None)])
+    self.assertEqual(consumer.stats['-80'].events, 10)
+
+    # A new consumer resumes from the saved checkpoints.
+    store = store_factory()
+    self.assertEqual(store.load('ks', '80-').position, '10')
+    conn, _, events = self.consume(store, 12)
+    self.assertEqual(events, {'-80': [11, 12], '80-': [11, 12]})
+    store.close()
+
+  def test_file_store(self):
+    path = os.path.join(self.tmpdir, 'checkpoints.json')
+    self.check_stores(
+        lambda: update_stream_consumer.FileCheckpointStore(path))
+
+  def test_sqlite_store(self):
+    path = os.path.join(self.tmpdir, 'checkpoints.db')
+    self.check_stores(
+        lambda: update_stream_consumer.SQLiteCheckpointStore(path))
+
+
+if __name__ == '__main__':
+  unittest.main()
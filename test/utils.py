@@ -37,12 +37,14 @@ from vtdb import prefer_vtroot_imports  # pylint: disable=unused-import
 from vtdb import vtgate_client
 
 import environment
+import vars_watcher
 from mysql_flavor import mysql_flavor
 from mysql_flavor import set_mysql_flavor
 import MySQLdb
 from protocols_flavor import protocols_flavor
 from topo_flavor.server import set_topo_server_flavor
 from vtctl import vtctl_client
+from vtctl import vtctl_runner
 from vtdb import keyrange_constants
 from vtgate_gateway_flavor.gateway import set_vtgate_gateway_flavor
 from vtgate_gateway_flavor.gateway import vtgate_gateway_flavor
@@ -224,10 +226,12 @@ def required_teardown():
   """Required cleanup steps that can't be skipped with --skip-teardown."""
   # We can't skip closing of gRPC connections, because the Python interpreter
   # won't let us die if any connections are left open.
-  global vtctld_connection, vtctld
+  global vtctld_connection, vtctld, vtctld_runner
   if vtctld_connection:
+    log_vtctl_stats()
     vtctld_connection.close()
     vtctld_connection = None
+    vtctld_runner = None
     vtctld = None
 
 
@@ -372,19 +376,18 @@ def wait_step(msg, timeout, sleep_time=0.1):
 
 
 # vars helpers
+# POLL_MAX_INTERVAL is the largest interval between two fetches of the
+# vars in poll_for_vars, short enough to see short-lived states.
+POLL_MAX_INTERVAL = 0.02
+
+
 def get_vars(port):
   """Returns the dict for vars from a vtxxx process. None if not available."""
+  watcher = vars_watcher.get_watcher(port)
   try:
-    url = 'http://localhost:%d/debug/vars' % int(port)
-    f = urllib2.urlopen(url)
-    data = f.read()
-    f.close()
-  except urllib2.URLError:
-    return None
-  try:
-    return json.loads(data)
+    return watcher.fetch()
   except ValueError:
-    print data
+    print watcher.last_data
     raise
 
 
@@ -398,33 +401,38 @@ def wait_for_vars(name, port, var=None, key=None, value=None, timeout=10.0):
     key: if specified, waits for vars[var][key]==value.
     value: if key if specified, waits for vars[var][key]==value.
     timeout: how long to wait.
+
+  Raises:
+    TestError: if the vars did not match in time.
   """
   text = 'waiting for http://localhost:%d/debug/vars of %s' % (port, name)
   if var:
     text += ' value %s' % var
     if key:
       text += ' key %s:%s' % (key, value)
-  while True:
-    display_text = text
-    v = get_vars(port)
-    if v:
-      if var is None:
-        break
-      if var in v:
-        if key is None:
-          break
-        if key in v[var]:
-          if v[var][key] == value:
-            break
-          else:
-            display_text += ' (current value:%s)' % v[var][key]
-        else:
-          display_text += ' (no current value)'
-      else:
-        display_text += ' (%s not in vars)' % var
+
+  def condition(v):
+    if var is None:
+      return True
+    if var not in v:
+      return False
+    if key is None:
+      return True
+    return key in v[var] and v[var][key] == value
+
+  try:
+    vars_watcher.get_watcher(port).wait_for(condition, timeout=timeout)
+  except vars_watcher.WaitTimeout as e:
+    v = e.last_vars
+    if v is None:
+      text += ' (no vars yet)'
+    elif var not in v:
+      text += ' (%s not in vars)' % var
+    elif key not in v[var]:
+      text += ' (no current value)'
     else:
-      display_text += ' (no vars yet)'
-    timeout = wait_step(display_text, timeout)
+      text += ' (current value:%s)' % v[var][key]
+    raise TestError('timeout waiting for condition "%s"' % text)
 
 
 def poll_for_vars(
@@ -432,7 +440,7 @@ def poll_for_vars(
     require_vars=False):
   """Polls for debug variables to exist or match specific conditions.
 
-  This function polls in a tight loop, with no sleeps. This is useful for
+  The vars are fetched at most POLL_MAX_INTERVAL apart. This is useful for
   variables that are expected to be short-lived (e.g., a 'Done' state
   immediately before a process exits).
 
@@ -456,25 +464,19 @@ def poll_for_vars(
 
   Returns:
     dict of debug variables
-
   """
-  start_time = time.time()
-  while True:
-    if (time.time() - start_time) >= timeout:
-      raise TestError(
-          'Timed out polling for vars from %s; condition "%s" not met' %
-          (name, condition_msg))
-    v = get_vars(port)
-    if v is None:
-      if require_vars:
-        raise TestError(
-            'Expected vars to exist on %s, but they do not; '
-            'process probably exited earlier than expected.' % (name,))
-      continue
-    if condition_fn is None:
-      return v
-    elif condition_fn(v):
-      return v
+  try:
+    return vars_watcher.get_watcher(port).wait_for(
+        condition_fn, timeout=timeout, require_vars=require_vars,
+        max_interval=POLL_MAX_INTERVAL)
+  except vars_watcher.WaitTimeout:
+    raise TestError(
+        'Timed out polling for vars from %s; condition "%s" not met' %
+        (name, condition_msg))
+  except vars_watcher.VarsUnavailable:
+    raise TestError(
+        'Expected vars to exist on %s, but they do not; '
+        'process probably exited earlier than expected.' % (name,))
 
 
 def apply_vschema(vschema):
@@ -817,7 +819,10 @@ VTCTL_RPC = 3
 def run_vtctl(clargs, auto_log=False, expect_fail=False,
               mode=VTCTL_AUTO, **kwargs):
   if mode == VTCTL_AUTO:
-    if not expect_fail and vtctld:
+    # vtctld reads the first argument as the command name, so the
+    # command lines starting with vtctl flags need the vtctl binary.
+    # Failing commands also use it, as tests check their stderr.
+    if not expect_fail and vtctld and not _has_vtctl_flags(clargs):
       mode = VTCTL_RPC
     else:
       mode = VTCTL_VTCTL
@@ -829,16 +834,59 @@ def run_vtctl(clargs, auto_log=False, expect_fail=False,
     result = vtctld.vtctl_client(clargs)
     return result, ''
   elif mode == VTCTL_RPC:
+    if isinstance(clargs, str):
+      clargs = shlex.split(clargs)
     if auto_log:
       logging.debug('vtctl: %s', ' '.join(clargs))
-    result = vtctl_client.execute_vtctl_command(vtctld_connection, clargs,
-                                                info_to_debug=True,
-                                                action_timeout=10)
-    return result, ''
+    if not expect_fail:
+      return vtctld_runner.run(clargs), ''
+    try:
+      result = vtctld_runner.run(clargs)
+    except vtctl_runner.CommandError as e:
+      return '', e.log
+    raise TestError('expected fail:', clargs, result)
 
   raise Exception('Unknown mode: %s', mode)
 
 
+def _has_vtctl_flags(clargs):
+  """Returns True if a command line starts with flags of the vtctl binary."""
+  if isinstance(clargs, str):
+    clargs = shlex.split(clargs)
+  return bool(clargs) and clargs[0].startswith('-')
+
+
+def run_vtctl_all(clargs_list, auto_log=False):
+  """Runs independent vtctl commands, concurrently when vtctld is up.
+
+  The commands must not depend on each other, as they may run in any
+  order.
+
+  Args:
+    clargs_list: list of command lines (lists of strings).
+    auto_log: if set, logs the commands.
+
+  Returns:
+    The list of the command outputs, in order.
+  """
+  if not vtctld or any(_has_vtctl_flags(clargs) for clargs in clargs_list):
+    return [run_vtctl(clargs, auto_log=auto_log)[0] for clargs in clargs_list]
+  if auto_log:
+    for clargs in clargs_list:
+      logging.debug('vtctl: %s', ' '.join(clargs))
+  return vtctld_runner.run_all(clargs_list)
+
+
+def log_vtctl_stats(count=10):
+  """Logs the vtctl commands that took the most time so far."""
+  if not vtctld_runner:
+    return
+  for name, stats in vtctld_runner.slowest_commands(count):
+    logging.info('vtctl %s: %d runs, %d failed, total %.3fs, mean %.3fs, '
+                 'max %.3fs', name, stats.count, stats.errors,
+                 stats.total_time, stats.mean_time, stats.max_time)
+
+
 def run_vtctl_vtctl(clargs, auto_log=False, expect_fail=False,
                     **kwargs):
   args = environment.binary_args('vtctl') + [
@@ -1192,9 +1240,11 @@ class VtctldError(Exception):
   pass
 
 # save the first running instance, and an RPC connection to it,
-# so we can use it to run remote vtctl commands
+# so we can use it to run remote vtctl commands. vtctld_runner runs
+# the commands on that connection, and records their latency.
 vtctld = None
 vtctld_connection = None
+vtctld_runner = None
 
 
 class Vtctld(object):
@@ -1262,11 +1312,13 @@ class Vtctld(object):
                           sleep_time=0.2)
 
     # save the running instance so vtctl commands can be remote executed now
-    global vtctld, vtctld_connection
+    global vtctld, vtctld_connection, vtctld_runner
     if not vtctld:
       vtctld = self
       protocol, endpoint = self.rpc_endpoint(python=True)
       vtctld_connection = vtctl_client.connect(protocol, endpoint, 30)
+      vtctld_runner = vtctl_runner.VtctlRunner(
+          vtctld_connection, action_timeout=10, info_to_debug=True)
 
     return self.proc
 
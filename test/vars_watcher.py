@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Watches the /debug/vars of the test processes, for many waiters.
+
+There is one VarsWatcher per process port. While waiters are subscribed,
+it fetches the vars from a background thread, over a persistent HTTP
+connection, and checks every fetch against the predicates of all the
+waiters: a single fetch can satisfy many of them.
+
+The interval between two fetches starts at MIN_INTERVAL when a waiter
+subscribes or is satisfied, and grows by INTERVAL_MULTIPLIER up to the
+smallest max_interval of the waiters while nothing changes for them.
+
+API usage -
+
+watcher = vars_watcher.get_watcher(port)
+v = watcher.wait_for(lambda v: v.get('WorkerState') == 'done', timeout=10)
+"""
+
+import httplib
+import json
+import socket
+import threading
+
+# MIN_INTERVAL is the initial interval between two fetches, in seconds.
+MIN_INTERVAL = 0.005
+# MAX_INTERVAL is the default largest interval between two fetches.
+MAX_INTERVAL = 0.1
+# INTERVAL_MULTIPLIER is the growth of the interval after each fetch
+# that satisfies no waiter.
+INTERVAL_MULTIPLIER = 1.5
+# HTTP_TIMEOUT is the timeout of a fetch, in seconds.
+HTTP_TIMEOUT = 5.0
+
+
+class WaitTimeout(Exception):
+  """Raised when the vars did not match in time.
+
+  Attributes:
+    last_vars: the last vars fetched, or None if none could be fetched.
+  """
+
+  def __init__(self, port, last_vars):
+    super(WaitTimeout, self).__init__(
+        'timeout waiting for the vars of port %d' % port)
+    self.last_vars = last_vars
+
+
+class VarsUnavailable(Exception):
+  """Raised when the vars are required, but cannot be fetched."""
+
+
+class _Waiter(object):
+
+  __slots__ = ('predicate', 'require_vars', 'max_interval', 'event', 'vars',
+               'error')
+
+  def __init__(self, predicate, require_vars, max_interval):
+    self.predicate = predicate
+    self.require_vars = require_vars
+    self.max_interval = max_interval
+    self.event = threading.Event()
+    self.vars = None
+    self.error = None
+
+
+class VarsWatcher(object):
+  """Fetches the vars of one process for its waiters, see the module doc."""
+
+  def __init__(self, port):
+    self.port = port
+    # fetches is the number of fetches, for tests and debugging.
+    self.fetches = 0
+    # last_data and last_vars are the last vars fetched, as text and
+    # as a dict.
+    self.last_data = None
+    self.last_vars = None
+    self._conn = None
+    self._conn_lock = threading.Lock()
+    self._waiters = []
+    self._thread = None
+    self._lock = threading.Lock()
+    self._wakeup = threading.Event()
+
+  def fetch(self):
+    """Returns the vars dict, or None if they are not available.
+
+    Raises:
+      ValueError: if the vars are not valid JSON.
+    """
+    data = self._fetch_data()
+    if data is None:
+      return None
+    self.last_data = data
+    v = json.loads(data)
+    self.last_vars = v
+    return v
+
+  def _fetch_data(self):
+    with self._conn_lock:
+      self.fetches += 1
+      # A kept-alive connection may have been closed by the process, or
+      # the process restarted on the same port: retry once on a new one.
+      for reused in (self._conn is not None, False):
+        if self._conn is None:
+          self._conn = httplib.HTTPConnection(
+              'localhost', self.port, timeout=HTTP_TIMEOUT)
+        try:
+          self._conn.request('GET', '/debug/vars')
+          response = self._conn.getresponse()
+          data = response.read()
+        except (httplib.HTTPException, socket.error):
+          self._close()
+          if reused:
+            continue
+          return None
+        if response.status != httplib.OK:
+          return None
+        return data
+
+  def close(self):
+    """Closes the HTTP connection. The next fetch opens a new one."""
+    with self._conn_lock:
+      self._close()
+
+  def _close(self):
+    if self._conn is not None:
+      self._conn.close()
+      self._conn = None
+
+  def wait_for(self, predicate=None, timeout=10.0, require_vars=False,
+               max_interval=MAX_INTERVAL):
+    """Waits for vars matching a predicate.
+
+    Args:
+      predicate: a function of the vars dict, returning True when they
+        match. If None, waits for the vars to be available.
+      timeout: how long to wait, in seconds.
+      require_vars: if True, fails as soon as the vars cannot be fetched,
+        e.g. because the process exited.
+      max_interval: the largest interval between two fetches, while
+        this waiter is subscribed.
+
+    Returns:
+      The first vars dict that matched.
+
+    Raises:
+      WaitTimeout: if no vars matched before the timeout.
+      VarsUnavailable: if require_vars is set, and a fetch failed.
+      Exception: the error raised by the predicate, or the ValueError of
+        invalid vars.
+    """
+    waiter = _Waiter(predicate, require_vars, max_interval)
+    with self._lock:
+      self._waiters.append(waiter)
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+      else:
+        self._wakeup.set()
+    waiter.event.wait(timeout)
+    with self._lock:
+      if not waiter.event.is_set():
+        self._waiters.remove(waiter)
+        raise WaitTimeout(self.port, self.last_vars)
+    if waiter.error is not None:
+      raise waiter.error  # pylint: disable=raising-bad-type
+    return waiter.vars
+
+  def _run(self):
+    interval = MIN_INTERVAL
+    while True:
+      self._wakeup.clear()
+      v = None
+      error = None
+      try:
+        v = self.fetch()
+      except ValueError as e:
+        error = e
+      satisfied = False
+      with self._lock:
+        remaining = []
+        for waiter in self._waiters:
+          if error is None and v is None:
+            if waiter.require_vars:
+              waiter.error = VarsUnavailable(
+                  'cannot get the vars of port %d' % self.port)
+            else:
+              remaining.append(waiter)
+              continue
+          elif error is None:
+            try:
+              if waiter.predicate is not None and not waiter.predicate(v):
+                remaining.append(waiter)
+                continue
+            except Exception as e:  # pylint: disable=broad-except
+              waiter.error = e
+            waiter.vars = v
+          else:
+            waiter.error = error
+          waiter.event.set()
+          satisfied = True
+        self._waiters = remaining
+        if not remaining:
+          self._thread = None
+          return
+        max_interval = min(waiter.max_interval for waiter in remaining)
+      if satisfied:
+        interval = MIN_INTERVAL
+      else:
+        interval = min(interval * INTERVAL_MULTIPLIER, max_interval)
+      if self._wakeup.wait(interval):
+        # a new waiter subscribed
+        interval = MIN_INTERVAL
+
+
+# _watchers maps a port to its VarsWatcher.
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def get_watcher(port):
+  """Returns the shared VarsWatcher of a port."""
+  port = int(port)
+  with _watchers_lock:
+    watcher = _watchers.get(port)
+    if watcher is None:
+      watcher = VarsWatcher(port)
+      _watchers[port] = watcher
+    return watcher
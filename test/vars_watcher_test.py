@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for vars_watcher, against a local HTTP server."""
+
+import BaseHTTPServer
+import json
+import socket
+import SocketServer
+import threading
+import unittest
+
+import vars_watcher
+
+
+class VarsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves the vars of the server, counting requests and connections."""
+
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.server.connections += 1
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    self.server.requests += 1
+    self.server.vars['Requests'] = self.server.requests
+    body = json.dumps(self.server.vars)
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+class VarsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+  daemon_threads = True
+
+  def __init__(self):
+    BaseHTTPServer.HTTPServer.__init__(self, ('localhost', 0), VarsHandler)
+    self.vars = {}
+    self.requests = 0
+    self.connections = 0
+
+
+class TestVarsWatcher(unittest.TestCase):
+
+  def setUp(self):
+    self.server = VarsServer()
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.watcher = vars_watcher.VarsWatcher(self.server.server_address[1])
+
+  def tearDown(self):
+    self.watcher.close()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def test_shared_fetches(self):
+    results = []
+
+    def wait(count):
+      results.append(self.watcher.wait_for(
+          lambda v: v['Requests'] >= count, timeout=5.0)['Requests'])
+
+    threads = [threading.Thread(target=wait, args=(count,))
+               for count in (3, 3, 3, 6, 6)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(len(results), 5)
+    for result in results:
+      self.assertIn(result, range(3, 12))
+    # The waiters shared the fetches, on a single connection.
+    self.assertLessEqual(self.server.requests, 12)
+    self.assertEqual(self.server.connections, 1)
+
+  def test_timeout(self):
+    self.server.vars['WorkerState'] = 'cloning'
+    with self.assertRaises(vars_watcher.WaitTimeout) as cm:
+      self.watcher.wait_for(lambda v: v['WorkerState'] == 'done',
+                            timeout=0.3)
+    self.assertEqual(cm.exception.last_vars['WorkerState'], 'cloning')
+    # The interval grew while nothing matched.
+    self.assertLess(self.server.requests, 20)
+
+    self.server.vars['WorkerState'] = 'done'
+    v = self.watcher.wait_for(lambda v: v['WorkerState'] == 'done')
+    self.assertEqual(v['WorkerState'], 'done')
+
+  def test_unavailable(self):
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    watcher = vars_watcher.VarsWatcher(sock.getsockname()[1])
+    sock.close()
+    self.assertIsNone(watcher.fetch())
+    self.assertRaises(vars_watcher.VarsUnavailable, watcher.wait_for,
+                      require_vars=True)
+    self.assertRaises(vars_watcher.WaitTimeout, watcher.wait_for,
+                      timeout=0.05)
+
+  def test_predicate_error(self):
+    self.assertRaises(KeyError, self.watcher.wait_for,
+                      lambda v: v['Missing'])
+
+
+if __name__ == '__main__':
+  unittest.main()
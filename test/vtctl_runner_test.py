@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for vtctl_runner."""
+
+import threading
+import time
+import unittest
+
+from vtctl import vtctl_client
+from vtctl import vtctl_runner
+
+
+class FakeClient(vtctl_client.VtctlClient):
+  """Sleeps for the time given after 'Sleep', fails on 'Fail'."""
+
+  def __init__(self):
+    self.active = 0
+    self.max_active = 0
+    self.lock = threading.Lock()
+
+  def execute_vtctl_command(self, args, action_timeout=30.0):
+    with self.lock:
+      self.active += 1
+      self.max_active = max(self.max_active, self.active)
+    name = vtctl_runner.command_name(args)
+    try:
+      yield vtctl_client.Event(None, vtctl_client.Event.INFO, 'f.go', 1,
+                               'running %s' % name)
+      if name == 'Fail':
+        raise ValueError('no such tablet')
+      if name == 'Sleep':
+        time.sleep(float(args[1]))
+      yield vtctl_client.Event(None, vtctl_client.Event.CONSOLE, '', 0,
+                               '%s done\n' % name)
+    finally:
+      with self.lock:
+        self.active -= 1
+
+
+class TestVtctlRunner(unittest.TestCase):
+
+  def setUp(self):
+    self.client = FakeClient()
+    self.runner = vtctl_runner.VtctlRunner(self.client, num_threads=4)
+
+  def test_run(self):
+    self.assertEqual(self.runner.run(['GetTablet', 'a']), 'GetTablet done\n')
+    with self.assertRaises(vtctl_runner.CommandError) as cm:
+      self.runner.run(['Fail'])
+    self.assertEqual(cm.exception.command, ['Fail'])
+    self.assertEqual(cm.exception.log, 'running Fail\nno such tablet\n')
+
+    stats = self.runner.stats()
+    self.assertEqual(sorted(stats), ['Fail', 'GetTablet'])
+    self.assertEqual(stats['Fail'].count, 1)
+    self.assertEqual(stats['Fail'].errors, 1)
+    self.assertEqual(stats['GetTablet'].errors, 0)
+
+  def test_command_name(self):
+    name = vtctl_runner.command_name
+    self.assertEqual(name(['-wait-time', '3s', 'RefreshState', 'a']),
+                     'RefreshState')
+    self.assertEqual(name(['-wait-time=3s', '--alsologtostderr',
+                           'ExecuteHook', 'a']), 'ExecuteHook')
+    self.assertEqual(name(['-wait-time']), '')
+
+  def test_run_all(self):
+    start = time.time()
+    outputs = self.runner.run_all([['Sleep', '0.1']] * 4)
+    self.assertLess(time.time() - start, 0.3)
+    self.assertEqual(outputs, ['Sleep done\n'] * 4)
+    self.assertEqual(self.client.max_active, 4)
+
+    name, stats = self.runner.slowest_commands(1)[0]
+    self.assertEqual(name, 'Sleep')
+    self.assertEqual(stats.count, 4)
+    self.assertGreaterEqual(stats.max_time, 0.1)
+    self.assertGreaterEqual(stats.total_time, 0.4)
+
+  def test_run_all_error(self):
+    self.assertRaises(vtctl_runner.CommandError, self.runner.run_all,
+                      [['Sleep', '0.05'], ['Fail'], ['InitTablet']])
+    # All the commands ran.
+    self.assertEqual(sorted(self.runner.stats()),
+                     ['Fail', 'InitTablet', 'Sleep'])
+    self.runner.reset_stats()
+    self.assertEqual(self.runner.stats(), {})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the row ordering helpers and cursors of vtgate_cursor."""
+
+import random
+import threading
+import unittest
+
+from vtdb import dbexceptions
+from vtdb import vtgate_cursor
+
+
+class FakeConnection(object):
+
+  def __init__(self, rows):
+    self.rows = rows
+    self.error = None
+
+  def _execute(self, *pargs, **kwargs):
+    return list(self.rows), len(self.rows), 0, []
+
+  def _stream_execute(self, *pargs, **kwargs):
+    if kwargs.get('chunked'):
+      return self._chunks(), [('id', 0)]
+    return (r for r in self.rows), []
+
+  def _chunks(self):
+    for i in xrange(0, len(self.rows), 7):
+      yield self.rows[i:i + 7]
+    if self.error:
+      raise self.error
+
+
+class BlockedStream(object):
+  """A chunk stream whose reads block until it is cancelled."""
+
+  def __init__(self):
+    self.cancelled = threading.Event()
+    self.closed = threading.Event()
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    self.cancelled.wait(5)
+    raise dbexceptions.OperationalError('cancelled')
+
+  def cancel(self):
+    self.cancelled.set()
+
+  def close(self):
+    self.closed.set()
+
+
+class TestOrdering(unittest.TestCase):
+
+  def setUp(self):
+    rnd = random.Random(1)
+    self.rows = [(rnd.randint(0, 5), rnd.choice('abc'), i)
+                 for i in xrange(200)]
+    self.order_by = ['c0', ['c1', 'DESC']]
+
+  def expected(self, limit):
+    rows = vtgate_cursor.sort_row_list_by_columns(
+        list(self.rows), ['c0', 'c1'], ['c1'])
+    return [row[2:] for row in rows[:limit]]
+
+  def test_fetch_aggregate(self):
+    cursor = vtgate_cursor.VTGateCursor(FakeConnection(self.rows), 'replica')
+    cursor.execute('select c0, c1, id from t', {})
+    self.assertEqual(cursor.fetch_aggregate(self.order_by, 17),
+                     self.expected(17))
+
+  def test_stream_fetch_aggregate(self):
+    cursor = vtgate_cursor.StreamVTGateCursor(
+        FakeConnection(self.rows), 'replica')
+    cursor.execute('select c0, c1, id from t', {})
+    self.assertEqual(cursor.fetch_aggregate(self.order_by, 50),
+                     self.expected(50))
+
+  def test_merge_sorted_rows(self):
+    key = vtgate_cursor.sort_key_func(self.order_by)
+    streams = [sorted(self.rows[i::3], key=key) for i in xrange(3)]
+    merged = list(vtgate_cursor.merge_sorted_rows(
+        streams, self.order_by, limit=100))
+    self.assertEqual(len(merged), 100)
+    keys = [row[:2] for row in merged]
+    self.assertEqual(keys, [row[:2] for row in
+                            sorted(self.rows, key=key)[:100]])
+    self.assertEqual(
+        len(list(vtgate_cursor.merge_sorted_rows(streams, self.order_by))),
+        200)
+    self.assertEqual(
+        list(vtgate_cursor.merge_sorted_rows([[], []], self.order_by)), [])
+
+
+class TestPrefetchStreamVTGateCursor(unittest.TestCase):
+
+  def setUp(self):
+    self.rows = [(i,) for i in xrange(50)]
+    self.conn = FakeConnection(self.rows)
+
+  def cursor(self):
+    cursor = vtgate_cursor.PrefetchStreamVTGateCursor(
+        self.conn, 'replica', prefetch_chunks=2)
+    cursor.execute('select id from t', {})
+    return cursor
+
+  def test_fetchone(self):
+    cursor = self.cursor()
+    self.assertEqual(list(iter(cursor.fetchone, None)), self.rows)
+    self.assertEqual(cursor.fetchone(), None)
+    self.assertEqual(cursor.prefetch_stats()['chunks'], 8)
+
+  def test_fetchmany(self):
+    cursor = self.cursor()
+    self.assertEqual(cursor.fetchmany(3), self.rows[:3])
+    # The rest of the current chunk.
+    self.assertEqual(cursor.fetchmany(), self.rows[3:7])
+    self.assertEqual(cursor.fetchmany(), self.rows[7:14])
+    self.assertEqual(cursor.fetchmany(10), self.rows[14:24])
+    self.assertEqual(cursor.fetchall(), self.rows[24:])
+    self.assertEqual(cursor.fetchmany(), [])
+    self.assertEqual(cursor.rownumber, 50)
+
+  def test_error(self):
+    self.conn.error = dbexceptions.TransientError('stream broke')
+    cursor = self.cursor()
+    self.assertRaises(dbexceptions.TransientError, cursor.fetchall)
+
+  def test_close_while_streaming(self):
+    cursor = self.cursor()
+    self.assertEqual(cursor.fetchone(), (0,))
+    cursor.close()
+    self.assertEqual(cursor.description, None)
+
+  def test_close_cancels_blocked_stream(self):
+    stream = BlockedStream()
+    self.conn._chunks = lambda: stream
+    cursor = self.cursor()
+    cursor.close()
+    self.assertTrue(stream.cancelled.is_set())
+    # The prefetch thread was unblocked, and closed the stream.
+    self.assertTrue(stream.closed.wait(1))
+
+  def test_stats_per_stream(self):
+    cursor = self.cursor()
+    old_stream = cursor._stream
+    cursor.execute('select id from t', {})
+    old_stream.stall_time += 10
+    self.assertLess(cursor.prefetch_stall_time, 10)
+    self.assertEqual(len(cursor.fetchall()), 50)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+# Copyright 2019 The Vitess Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for vtgate_pool, using a fake connection class."""
+
+import threading
+import unittest
+
+from vtdb import dbexceptions
+from vtdb import vtgate_client
+from vtdb import vtgate_cursor
+from vtdb import vtgate_pool
+
+
+class FakeSession(object):
+
+  def __init__(self):
+    self.in_transaction = True
+
+
+class BlockedStream(object):
+  """A chunk stream whose reads block until it is cancelled."""
+
+  def __init__(self):
+    self.cancelled = threading.Event()
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    self.cancelled.wait(5)
+    raise dbexceptions.OperationalError('cancelled')
+
+  def cancel(self):
+    self.cancelled.set()
+
+
+class FakeConnection(vtgate_client.VTGateClient):
+  """Records calls, and fails them while the address is in failing."""
+
+  failing = set()
+  calls = []
+  streams = []
+
+  def dial(self):
+    pass
+
+  def close(self):
+    pass
+
+  def begin(self, effective_caller_id=None, single_db=False):
+    self.session = FakeSession()
+
+  def commit(self, twopc=False):
+    self.session = None
+
+  def _execute(self, sql, bind_variables, tablet_type, **kwargs):
+    FakeConnection.calls.append((self.addr, sql))
+    if self.addr in FakeConnection.failing:
+      raise dbexceptions.TransientError('vtgate is down', self.addr)
+    return [(self.addr,)], 1, 0, [('addr', 0)]
+
+  def _stream_execute(self, sql, bind_variables, tablet_type, chunked=False,
+                      **kwargs):
+    if chunked:
+      stream = BlockedStream()
+      FakeConnection.streams.append(stream)
+      return stream, [('addr', 0)]
+    return iter([(self.addr,)]), [('addr', 0)]
+
+
+class TestVTGatePool(unittest.TestCase):
+
+  def setUp(self):
+    vtgate_client.register_conn_class('fake', FakeConnection)
+    FakeConnection.failing = set()
+    FakeConnection.calls = []
+    FakeConnection.streams = []
+    self.pool = vtgate_pool.connect(
+        'fake', ['a', 'b'], 1.0, size=2, eject_after=2, eject_interval=60,
+        max_eject_interval=600)
+
+  def endpoint(self, addr):
+    return [e for e in self.pool.endpoints if e.addr == addr][0]
+
+  def eject(self, addr):
+    """Fails the calls to addr until it is ejected."""
+    FakeConnection.failing.add(addr)
+    # The vtgate of each call is random: send calls until the failing
+    # one got enough of them.
+    for _ in xrange(100):
+      if self.endpoint(addr).state == vtgate_pool.EJECTED:
+        break
+      results, _, _, _ = self.pool._execute('select 1', {}, 'replica')
+      self.assertNotEqual(results, [(addr,)])
+    for _ in xrange(10):
+      results, _, _, _ = self.pool._execute('select 1', {}, 'replica')
+      self.assertNotEqual(results, [(addr,)])
+
+  def test_failover_and_ejection(self):
+    self.eject('a')
+    self.assertEqual(self.endpoint('a').state, vtgate_pool.EJECTED)
+    # Only the calls before the ejection were sent to 'a'.
+    self.assertEqual(len([c for c in FakeConnection.calls if c[0] == 'a']), 2)
+
+  def test_probe(self):
+    self.eject('a')
+    endpoint = self.endpoint('a')
+    endpoint.ejected_until = 0
+    # The failed probe doubles the ejection time.
+    FakeConnection.calls = []
+    self.pool._execute('select 1', {}, 'replica')
+    self.assertEqual(FakeConnection.calls[0][0], 'a')
+    self.assertEqual(endpoint.state, vtgate_pool.EJECTED)
+    self.assertEqual(endpoint.eject_interval, 120)
+    # A successful probe brings it back.
+    FakeConnection.failing = set()
+    endpoint.ejected_until = 0
+    results, _, _, _ = self.pool._execute('select 1', {}, 'replica')
+    self.assertEqual(results, [('a',)])
+    self.assertEqual(endpoint.state, vtgate_pool.HEALTHY)
+
+  def test_all_down(self):
+    FakeConnection.failing.update(['a', 'b'])
+    self.assertRaises(dbexceptions.TransientError,
+                      self.pool._execute, 'select 1', {}, 'replica')
+    self.assertRaises(dbexceptions.TransientError,
+                      self.pool._execute, 'select 1', {}, 'replica')
+    self.assertRaises(dbexceptions.OperationalError,
+                      self.pool._execute, 'select 1', {}, 'replica')
+
+  def test_least_loaded(self):
+    generator, _ = self.pool._stream_execute('select 1', {}, 'replica')
+    busy = generator.next()[0]
+    self.assertEqual(self.endpoint(busy).in_flight, 1)
+    # While the stream is open, calls go to the other vtgate.
+    for _ in xrange(5):
+      results, _, _, _ = self.pool._execute('select 1', {}, 'replica')
+      self.assertNotEqual(results, [(busy,)])
+    list(generator)
+    self.assertEqual(self.endpoint(busy).in_flight, 0)
+
+  def test_prefetch_cursor_close(self):
+    cursor = self.pool.cursor(
+        tablet_type='replica',
+        cursorclass=vtgate_cursor.PrefetchStreamVTGateCursor)
+    cursor.execute('select 1', {})
+    self.assertEqual(sum(e.in_flight for e in self.pool.endpoints), 1)
+    # Closing the cursor cancels the blocked stream, and releases its
+    # connection.
+    cursor.close()
+    stream, = FakeConnection.streams
+    self.assertTrue(stream.cancelled.is_set())
+    self.assertEqual([e.in_flight for e in self.pool.endpoints], [0, 0])
+    self.assertEqual([e.failures for e in self.pool.endpoints], [0, 0])
+
+  def test_transaction_is_pinned(self):
+    self.pool.begin()
+    self.assertTrue(self.pool.session.in_transaction)
+    addrs = set()
+    for _ in xrange(10):
+      results, _, _, _ = self.pool._execute('select 1', {}, 'master')
+      addrs.add(results[0][0])
+    self.assertEqual(len(addrs), 1)
+    self.pool.commit()
+    self.assertIsNone(self.pool.session)
+    self.assertEqual([e.in_flight for e in self.pool.endpoints], [0, 0])
+
+
+if __name__ == '__main__':
+  unittest.main()